@@ -0,0 +1,140 @@
+"""
+对话准入控制
+appTalk / modelTalk 开始转发前按用户、应用、模型三个维度检查令牌桶限速和并发流上限，
+计数保存在本地共享存储中，同一台机器上的所有 worker 共用一份；超出限制时立即返回 429 和 Retry-After，不占用 worker。
+每个放行的对话持有一个租约，流结束时释放；异常退出的 worker 遗留的租约在检查时清理
+"""
+import math
+import os
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from . import local_store
+from .interface.port_app import StreamResponse, on_response_close
+from .metrics import metrics
+
+
+class Rejected(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _limits(kind: str) -> tuple:
+    """
+    返回 (每分钟请求数, 突发上限, 并发流上限)，0 表示不限制
+    """
+    prefix = kind.upper()
+    rate = getattr(settings, f'ADMISSION_{prefix}_RATE')
+    burst = getattr(settings, f'ADMISSION_{prefix}_BURST') or rate
+    return rate, burst, getattr(settings, f'ADMISSION_{prefix}_CONCURRENCY')
+
+
+class Lease:
+    """
+    一次放行的对话占用的并发名额
+    """
+
+    def __init__(self, lease_id: str):
+        self.lease_id = lease_id
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            local_store.execute("DELETE FROM leases WHERE lease_id = ?", (self.lease_id,))
+
+    async def arelease(self):
+        # 写共享存储可能等待文件锁，放到线程池执行，不阻塞事件循环
+        if not self.released:
+            await sync_to_async(self.release, thread_sensitive=False)()
+
+    def hold(self, response):
+        """
+        流式响应在流结束时释放租约，其他响应立即释放
+        """
+        return on_response_close(response, self.release)
+
+    async def ahold(self, response):
+        """
+        hold 的异步版本；流结束时的回调已在线程池中执行
+        """
+        if isinstance(response, StreamResponse) and not response.handle.closed:
+            return on_response_close(response, self.release)
+        await self.arelease()
+        return response
+
+
+def admit(user: str, app: str = '', model: str = '') -> Lease:
+    """
+    检查并占用各维度的名额，超出任一限制时抛出 Rejected，不占用任何名额
+    """
+    scopes = [('user', user)]
+    if app:
+        scopes.append(('app', app))
+    if model:
+        scopes.append(('model', model))
+    now = time.time()
+    lease = Lease(uuid.uuid4().hex)
+    with local_store.transaction() as conn:
+        buckets = []
+        for kind, name in scopes:
+            key = f'{kind}:{name}'
+            rate, burst, concurrency = _limits(kind)
+            if concurrency and _active_leases(conn, key, now, concurrency) >= concurrency:
+                metrics.incr('admission_rejected_concurrency')
+                raise Rejected(f'并发对话数已达上限（{concurrency}）', settings.ADMISSION_RETRY_AFTER)
+            if rate:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row['tokens'] + (now - row['updated']) * rate / 60)
+                if tokens < 1:
+                    metrics.incr('admission_rejected_rate')
+                    raise Rejected(f'请求过于频繁（每分钟 {rate} 次）', (1 - tokens) * 60 / rate)
+                buckets.append((key, tokens - 1, now))
+            if concurrency:
+                conn.execute(
+                    "INSERT INTO leases (lease_id, key, pid, created) VALUES (?, ?, ?, ?)",
+                    (lease.lease_id, key, os.getpid(), now)
+                )
+        conn.executemany(
+            "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+            buckets
+        )
+    return lease
+
+
+async def aadmit(user: str, app: str = '', model: str = '') -> Lease:
+    """
+    admit 的异步版本，检查在线程池中执行（BEGIN IMMEDIATE 可能等待其他 worker 的写锁）
+    """
+    return await sync_to_async(admit, thread_sensitive=False)(user, app, model)
+
+
+def _active_leases(conn, key: str, now: float, limit: int) -> int:
+    count = conn.execute("SELECT COUNT(*) FROM leases WHERE key = ?", (key,)).fetchone()[0]
+    if count < limit:
+        return count
+    # 达到上限时才清理：超过 STREAM_REGISTRY_TTL 的租约，以及已退出的 worker 持有的租约
+    stale = [
+        row['pid'] for row in conn.execute("SELECT DISTINCT pid FROM leases WHERE key = ?", (key,))
+        if not local_store.pid_alive(row['pid'])
+    ]
+    conn.execute(
+        f"DELETE FROM leases WHERE created < ? OR pid IN ({', '.join('?' * len(stale)) or 'NULL'})",
+        (now - settings.STREAM_REGISTRY_TTL, *stale)
+    )
+    return conn.execute("SELECT COUNT(*) FROM leases WHERE key = ?", (key,)).fetchone()[0]
+
+
+def rejected_response(error: Rejected) -> JsonResponse:
+    response = JsonResponse({
+        'status': 'error',
+        'message': str(error)
+    }, status=429)
+    response['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class GptConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'GPT'
+
+    def ready(self):
+        # 注册缓存失效的信号处理函数
+        from . import signals
@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from .auth_cache import auth_cache
+from .db_router import primary
+
+UserModel = get_user_model()
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    与 ModelBackend 相同，但按用户 id 从进程内缓存解析已登录用户，
+    AuthenticationMiddleware 不必每个请求都查询 Member
+    """
+
+    def get_user(self, user_id):
+        user = auth_cache.get_user(user_id)
+        if user is None:
+            try:
+                # 刚修改的用户可能还没有同步到只读副本
+                with primary():
+                    user = UserModel._default_manager.get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            auth_cache.put_user(user)
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        user = await auth_cache.aget_user(user_id)
+        if user is None:
+            try:
+                with primary():
+                    user = await UserModel._default_manager.aget(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            auth_cache.put_user(user)
+        return user if self.user_can_authenticate(user) else None
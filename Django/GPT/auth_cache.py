@@ -0,0 +1,153 @@
+"""
+会话与登录用户的进程内 L1 缓存
+每个已登录请求原本要先查 django_session，再由 AuthenticationMiddleware 查一次 Member，
+两次查询都发生在视图执行之前。两者都在本 worker 内缓存 AUTH_CACHE_TTL 秒，数据库仍是各 worker 共享的存储。
+修改/停用/删除用户后递增共享版本号，各 worker 最多延迟 CONFIG_VERSION_CHECK_INTERVAL 秒清空缓存；
+登出或修改会话只记录该会话的失效标记，各 worker 在同样的延迟内只丢弃这一个会话
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import local_store
+
+VERSION_NAME = 'auth'
+
+
+class _TTLCache:
+    """
+    带过期时间的 LRU，超过 AUTH_CACHE_SIZE 项时淘汰最久未使用的
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl: float):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > settings.AUTH_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class AuthCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = _TTLCache()
+        self._users = _TTLCache()
+        self._version = None
+        self._tombstone = 0
+        self._checked = 0
+
+    def _is_fresh(self) -> bool:
+        return self._version is not None and time.monotonic() - self._checked < settings.CONFIG_VERSION_CHECK_INTERVAL
+
+    def _check_version(self):
+        if self._is_fresh():
+            return
+        version = local_store.get_version(VERSION_NAME)
+        tombstones = local_store.execute(
+            "SELECT seq, session_key FROM session_tombstones WHERE seq > ? ORDER BY seq", (self._tombstone,)
+        ).fetchall()
+        with self._lock:
+            if version != self._version:
+                self._sessions.clear()
+                self._users.clear()
+                self._version = version
+            for row in tombstones:
+                self._sessions.pop(row['session_key'])
+            if tombstones:
+                self._tombstone = tombstones[-1]['seq']
+            self._checked = time.monotonic()
+
+    def get_session(self, session_key: str):
+        """
+        返回缓存的会话数据（编码后的字符串），未命中返回 None
+        """
+        self._check_version()
+        with self._lock:
+            return self._sessions.get(session_key)
+
+    async def aget_session(self, session_key: str):
+        # 命中缓存时直接读取，不切换线程
+        if self._is_fresh():
+            with self._lock:
+                return self._sessions.get(session_key)
+        return await sync_to_async(self.get_session)(session_key)
+
+    def put_session(self, session_key: str, session_data: str, expire_date):
+        # 不超过会话本身的过期时间
+        ttl = min(settings.AUTH_CACHE_TTL, expire_date.timestamp() - time.time())
+        if ttl > 0:
+            with self._lock:
+                self._sessions.put(session_key, session_data, ttl)
+
+    def get_user(self, user_id):
+        """
+        返回缓存用户的副本，调用方修改返回的对象不会影响缓存；未命中返回 None
+        """
+        self._check_version()
+        with self._lock:
+            user = self._users.get(user_id)
+        return copy.copy(user) if user is not None else None
+
+    async def aget_user(self, user_id):
+        if self._is_fresh():
+            with self._lock:
+                user = self._users.get(user_id)
+            return copy.copy(user) if user is not None else None
+        return await sync_to_async(self.get_user)(user_id)
+
+    def put_user(self, user):
+        with self._lock:
+            self._users.put(user.pk, copy.copy(user), settings.AUTH_CACHE_TTL)
+
+    def invalidate_session(self, session_key: str):
+        """
+        会话修改或删除后调用，所有 worker 只丢弃该会话的缓存
+        """
+        now = time.time()
+        with local_store.transaction() as conn:
+            conn.execute(
+                "INSERT INTO session_tombstones (session_key, created) VALUES (?, ?)", (session_key, now)
+            )
+            # 缓存项最多保留 AUTH_CACHE_TTL 秒，更早的失效标记已经没有需要丢弃的缓存
+            conn.execute(
+                "DELETE FROM session_tombstones WHERE created < ?",
+                (now - settings.AUTH_CACHE_TTL - settings.CONFIG_VERSION_CHECK_INTERVAL,)
+            )
+        with self._lock:
+            self._sessions.pop(session_key)
+
+    def invalidate(self):
+        """
+        用户变化后调用，所有 worker 的缓存都会失效
+        """
+        local_store.bump_version(VERSION_NAME)
+        with self._lock:
+            self._sessions.clear()
+            self._users.clear()
+            self._version = None
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,87 @@
+"""
+应用与模型配置的进程内缓存
+对话接口每次请求都要读取 Application / Model_info，而这些数据只在管理员修改时才变化。
+首次使用时一次性加载全部配置，之后直接从内存读取；
+任一 worker 修改配置后递增本地共享存储中的版本号，其他 worker 最多延迟 CONFIG_VERSION_CHECK_INTERVAL 秒发现并重新加载
+"""
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import local_store
+from .db_router import primary
+from .models import Application, Model_info
+
+VERSION_NAME = 'config'
+
+
+class ConfigRegistry:
+    """
+    缓存的对象只读，需要修改时请通过 ORM 重新查询
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0
+        self._applications = {}
+        self._models = {}
+
+    def _is_fresh(self) -> bool:
+        return self._version is not None and time.monotonic() - self._checked < settings.CONFIG_VERSION_CHECK_INTERVAL
+
+    def _refresh(self):
+        """
+        检查版本号，配置有变化（或尚未加载）时重新加载
+        """
+        with self._lock:
+            if self._is_fresh():
+                return
+            version = local_store.get_version(VERSION_NAME)
+            if version != self._version:
+                # 从主库加载，副本可能还没有同步到刚修改的配置
+                with primary():
+                    self._applications = {app.name: app for app in Application.objects.all()}
+                    self._models = {model.show_name: model for model in Model_info.objects.all()}
+                self._version = version
+            self._checked = time.monotonic()
+
+    def get_application(self, name: str):
+        """
+        按名称获取应用，不存在时返回 None
+        """
+        if not self._is_fresh():
+            self._refresh()
+        return self._applications.get(name)
+
+    def get_model(self, show_name: str):
+        """
+        按显示名称获取模型，不存在时返回 None
+        """
+        if not self._is_fresh():
+            self._refresh()
+        return self._models.get(show_name)
+
+    async def aget_application(self, name: str):
+        # 缓存有效时直接读取，不切换线程
+        if not self._is_fresh():
+            await sync_to_async(self._refresh)()
+        return self._applications.get(name)
+
+    async def aget_model(self, show_name: str):
+        if not self._is_fresh():
+            await sync_to_async(self._refresh)()
+        return self._models.get(show_name)
+
+    def invalidate(self):
+        """
+        配置被修改后调用：递增共享版本号，并让当前进程在下次读取时立即重新加载
+        """
+        local_store.bump_version(VERSION_NAME)
+        with self._lock:
+            self._version = None
+
+
+config_registry = ConfigRegistry()
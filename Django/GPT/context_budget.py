@@ -0,0 +1,107 @@
+"""
+按模型上下文窗口裁剪对话
+Model_info.context_window 减去为回复预留的 token 数即为 messages 的预算。超出预算时从最早的对话轮次开始丢弃，
+开头的 system 消息和最后一条消息始终保留；这两部分本身就超出预算时直接拒绝，不调用上游。
+每条消息的 token 数按内容哈希缓存，长对话每轮重新提交的历史消息不需要重复计数
+"""
+import hashlib
+import json
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时按字符数估算
+    tiktoken = None
+
+# 每条消息除内容外的格式开销（role 和分隔符）
+MESSAGE_OVERHEAD = 4
+# 中日韩文字和全角符号大约一个字一个 token，其余文本大约 4 个字符一个 token
+_WIDE_RE = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+class ContextTooLarge(Exception):
+    def __init__(self, tokens: int, budget: int):
+        super().__init__(f'消息共约 {tokens} 个 token，超出模型上下文预算 {budget}')
+        self.tokens = tokens
+        self.budget = budget
+
+
+class TokenCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+        self._encoding = None
+
+    def _text_tokens(self, text: str) -> int:
+        if tiktoken is not None and settings.CONTEXT_TOKENIZER:
+            if self._encoding is None:
+                self._encoding = tiktoken.get_encoding(settings.CONTEXT_TOKENIZER)
+            return len(self._encoding.encode(text, disallowed_special=()))
+        wide = len(_WIDE_RE.findall(text))
+        return wide + math.ceil((len(text) - wide) / 4)
+
+    def count(self, message: dict) -> int:
+        """
+        单条消息的 token 数
+        """
+        content = message.get('content') or ''
+        if not isinstance(content, str):
+            # 多模态消息的 content 是列表，按序列化后的文本估算
+            content = json.dumps(content, ensure_ascii=False)
+        key = hashlib.blake2b(f"{message.get('role', '')}\0{content}".encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                return tokens
+        tokens = MESSAGE_OVERHEAD + self._text_tokens(content)
+        with self._lock:
+            self._counts[key] = tokens
+            while len(self._counts) > settings.CONTEXT_TOKEN_CACHE_SIZE:
+                self._counts.popitem(last=False)
+        return tokens
+
+
+token_counter = TokenCounter()
+
+
+def context_budget(window: int) -> int:
+    """
+    上下文窗口中留给 messages 的 token 数；预留部分不超过窗口的一半，
+    窗口不大于 CONTEXT_RESERVE_TOKENS 时预算不会变成 0 或负数而跳过裁剪
+    """
+    return max(window // 2, window - settings.CONTEXT_RESERVE_TOKENS)
+
+
+def fit_messages(messages: list, budget: int) -> tuple:
+    """
+    把 messages 裁剪到 budget 个 token 以内，返回 (裁剪后的 messages, 丢弃的条数)；budget 不大于 0 时不裁剪。
+    开头的 system 消息和最后一条消息合计超出预算时抛出 ContextTooLarge
+    """
+    if budget <= 0 or not messages:
+        return messages, 0
+    counts = [token_counter.count(message) for message in messages]
+    head = 0
+    while head < len(messages) - 1 and messages[head].get('role') == 'system':
+        head += 1
+    fixed = sum(counts[:head]) + counts[-1]
+    if fixed > budget:
+        raise ContextTooLarge(fixed, budget)
+    if sum(counts) <= budget:
+        return messages, 0
+
+    # 从最新的消息往前保留，直到预算用完
+    remaining = budget - fixed
+    start = len(messages) - 1
+    while start > head and counts[start - 1] <= remaining:
+        start -= 1
+        remaining -= counts[start]
+    # 保留部分不以回复开头，避免模型看到没有对应提问的回答
+    while start < len(messages) - 1 and messages[start].get('role') != 'user':
+        start += 1
+    return messages[:head] + messages[start:], start - head
@@ -0,0 +1,163 @@
+"""
+服务端对话历史
+modelTalk 转发的每轮对话（用户消息和模型回复）先放入进程内待写队列，由后台线程批量写入 ConversationTurn，
+转发流本身不等待数据库写入。读取历史时合并数据库中的消息和本进程尚未写入的消息；
+其他 worker 刚写入队列的消息要等它刷新（CONVERSATION_FLUSH_DELAY 秒内）后才能读到
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import uuid
+import zlib
+
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import Conversation, ConversationTurn
+from .write_queue import write_queue
+
+logger = logging.getLogger(__name__)
+
+
+def compress(content: str) -> bytes:
+    return zlib.compress(content.encode('utf-8'), 6)
+
+
+def decompress(content) -> str:
+    return zlib.decompress(bytes(content)).decode('utf-8')
+
+
+def write_turns(turns: list):
+    """
+    写入一批消息并更新所属对话的最后活动时间
+    """
+    # 写入前对话可能已被删除，跳过这些消息，避免整批写入因外键约束失败
+    existing = set(Conversation.objects.filter(
+        pk__in={turn.conversation_id for turn in turns}
+    ).values_list('pk', flat=True))
+    turns = [turn for turn in turns if turn.conversation_id in existing]
+    # 同一对话并发的两次请求会得到相同的 seq，后写入的一条被忽略
+    ConversationTurn.objects.bulk_create(turns, batch_size=500, ignore_conflicts=True)
+    updated = {}
+    for turn in turns:
+        updated[turn.conversation_id] = max(turn.created, updated.get(turn.conversation_id, turn.created))
+    for conversation_id, created in updated.items():
+        Conversation.objects.filter(pk=conversation_id, updated__lt=created).update(updated=created)
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class ConversationStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 待写入的消息，以及正在写入、尚未提交的消息（读取历史时两者都要合并）
+        self._pending = []
+        self._writing = []
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def create(self, member, model: str) -> str:
+        """
+        新建对话，返回对话 id
+        """
+        conversation = Conversation(id=uuid.uuid4().hex, member=member, model=model)
+        write_queue.run(conversation.save, force_insert=True)
+        return conversation.id
+
+    def history(self, conversation_id: str) -> list:
+        """
+        返回对话中的全部消息（OpenAI messages 格式），按 seq 排序
+        """
+        # 先取内存中的消息再查数据库：刷新线程提交后才清空 _writing，两边重复的消息按 seq 去重
+        with self._lock:
+            unsaved = [turn for turn in self._writing + self._pending if turn.conversation_id == conversation_id]
+        turns = {
+            seq: (role, decompress(content))
+            for seq, role, content in ConversationTurn.objects.filter(
+                conversation_id=conversation_id
+            ).order_by('seq').values_list('seq', 'role', 'content')
+        }
+        for turn in unsaved:
+            turns.setdefault(turn.seq, (turn.role, decompress(turn.content)))
+        return [{'role': role, 'content': content} for _, (role, content) in sorted(turns.items())]
+
+    def append(self, conversation_id: str, seq: int, messages: list):
+        """
+        追加消息，seq 为第一条消息的序号（即已有历史的条数）；只写入内存，可在事件循环中直接调用
+        """
+        now = timezone.now()
+        turns = [
+            ConversationTurn(
+                conversation_id=conversation_id,
+                seq=seq + offset,
+                role=message.get('role', 'user'),
+                content=compress(message.get('content') or ''),
+                created=now
+            )
+            for offset, message in enumerate(messages)
+        ]
+        with self._lock:
+            self._pending.extend(turns)
+        metrics.incr('conversation_turns_recorded', len(turns))
+        if settings.CONVERSATION_FLUSH_DELAY < 0 and not _in_event_loop():
+            # 关闭后台写入时直接写入（事件循环中仍交给后台线程）
+            self.flush()
+            return
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='conversation-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # 稍等片刻，把同时结束的多个对话合并成一次写入
+            if settings.CONVERSATION_FLUSH_DELAY > 0:
+                threading.Event().wait(settings.CONVERSATION_FLUSH_DELAY)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        把待写入的消息写入数据库，返回写入的条数；写入失败时消息放回队列，下次重试
+        """
+        with self._lock:
+            if self._writing:
+                # 另一个线程正在写入
+                return 0
+            turns, self._pending = self._pending, []
+            self._writing = turns
+        if not turns:
+            return 0
+        try:
+            write_queue.run(write_turns, turns)
+        except Exception:
+            logger.exception('对话消息写入失败')
+            metrics.incr('conversation_flush_failed')
+            with self._lock:
+                self._writing = []
+                self._pending = (turns + self._pending)[-settings.CONVERSATION_BUFFER_SIZE:]
+            return 0
+        with self._lock:
+            self._writing = []
+        metrics.incr('conversation_turns_flushed', len(turns))
+        return len(turns)
+
+
+conversation_store = ConversationStore()
+# 进程正常退出时写入剩余的消息
+atexit.register(conversation_store.flush)
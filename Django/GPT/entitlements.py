@@ -0,0 +1,137 @@
+"""
+用户应用权限的进程内缓存
+用户可访问的应用 = 直接授予该用户的应用 ∪ 授予其部门的应用 ∪ 授予其所在用户组的应用。
+每个用户的直接授权和所在组只在首次使用时查询一次，部门/组授权表整体缓存为一个映射，
+校验时用 request.user 上的部门在内存中合并，之后权限校验和应用列表都直接读内存。
+权限变化（授权/取消授权、删除应用）后递增共享版本号，各 worker 最多延迟 CONFIG_VERSION_CHECK_INTERVAL 秒清空缓存
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import local_store
+from .db_router import primary
+from .models import ApplicationGrant
+
+VERSION_NAME = 'entitlements'
+
+
+class EntitlementCache:
+    """
+    按用户 id 缓存 (直接授权的应用名, 所在用户组 id)，超过 ENTITLEMENT_CACHE_SIZE 个用户时淘汰最久未使用的
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # (部门 -> 应用名集合, 用户组 id -> 应用名集合)
+        self._grants = None
+        self._version = None
+        self._checked = 0
+
+    def _is_fresh(self) -> bool:
+        return self._version is not None and time.monotonic() - self._checked < settings.CONFIG_VERSION_CHECK_INTERVAL
+
+    def _check_version(self):
+        if self._is_fresh():
+            return
+        version = local_store.get_version(VERSION_NAME)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._grants = None
+                self._version = version
+            self._checked = time.monotonic()
+
+    def _cached(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+            return entry
+
+    def _put(self, user_id, entry):
+        with self._lock:
+            self._entries[user_id] = entry
+            while len(self._entries) > settings.ENTITLEMENT_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def _load(self, user):
+        # 缓存必须从主库加载，副本可能还没有同步到刚修改的授权
+        with primary():
+            entry = (
+                frozenset(user.application.values_list('name', flat=True)),
+                frozenset(user.groups.values_list('id', flat=True))
+            )
+        self._put(user.pk, entry)
+        return entry
+
+    def _load_grants(self):
+        departments = {}
+        groups = {}
+        with primary():
+            rows = list(ApplicationGrant.objects.values_list('department_name', 'group_id', 'application_id'))
+        for department_name, group_id, application_id in rows:
+            if group_id is None:
+                departments.setdefault(department_name, set()).add(application_id)
+            else:
+                groups.setdefault(group_id, set()).add(application_id)
+        grants = (
+            {name: frozenset(apps) for name, apps in departments.items()},
+            {group_id: frozenset(apps) for group_id, apps in groups.items()}
+        )
+        with self._lock:
+            self._grants = grants
+        return grants
+
+    def _resolve(self, user, entry, grants) -> frozenset:
+        direct, group_ids = entry
+        departments, groups = grants
+        applications = direct | departments.get(user.department_name, frozenset())
+        for group_id in group_ids:
+            applications |= groups.get(group_id, frozenset())
+        return applications
+
+    def applications(self, user) -> frozenset:
+        """
+        获取用户可访问的应用名集合
+        """
+        self._check_version()
+        entry = self._cached(user.pk)
+        if entry is None:
+            entry = self._load(user)
+        grants = self._grants
+        if grants is None:
+            grants = self._load_grants()
+        return self._resolve(user, entry, grants)
+
+    async def aapplications(self, user) -> frozenset:
+        # 命中缓存时直接读取，不切换线程
+        if self._is_fresh():
+            entry = self._cached(user.pk)
+            grants = self._grants
+            if entry is not None and grants is not None:
+                return self._resolve(user, entry, grants)
+        return await sync_to_async(self.applications)(user)
+
+    def has_application(self, user, name: str) -> bool:
+        return name in self.applications(user)
+
+    async def ahas_application(self, user, name: str) -> bool:
+        return name in await self.aapplications(user)
+
+    def invalidate(self):
+        """
+        权限变化后调用，所有 worker 的缓存都会失效
+        """
+        local_store.bump_version(VERSION_NAME)
+        with self._lock:
+            self._entries.clear()
+            self._grants = None
+            self._version = None
+
+
+entitlements = EntitlementCache()
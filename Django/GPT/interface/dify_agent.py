@@ -3,69 +3,152 @@ from django.contrib.auth import authenticate
 from django.middleware.csrf import get_token
 from django.contrib.auth.decorators import login_required
 import re
+import asyncio
 import requests
+import httpx
 import json
 from django.views.decorators.csrf import csrf_exempt,csrf_protect
 from django.core.exceptions import ObjectDoesNotExist
 from .port_app import PortApp
+from .http_pool import get_async_client, get_session
+from .stream_registry import abort_response, aguard_stream, guard_stream
+from .sse import CONVERSATION_ID_RE, TASK_ID_RE, arelay, iter_chunks, parse_event, relay, scan_field
 
 class DifyAgent(PortApp):
-    def __init__(self, url: str, api_key: str, data: dict, user: str):
-        super().__init__(url, api_key, data, user)
+    kind = 'dify_agent'
+
+    def __init__(self, url: str, api_key: str, data: dict, user: str, app: str = ''):
+        super().__init__(url, api_key, data, user, app)
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        self.task_id = None
+        self.conversation_id = None
+
+    def _payload(self):
+        print(self.data)
+        if "query" not in self.data:
+            raise ValueError("query is required in data")
+        return {
+            "inputs":self.data.get('inputs',{}),
+            "query":self.data.get('query',''),
+            "response_mode":'streaming',
+            "conversation_id":self.data.get('conversation_id',""),
+            "user":self.user,
+            "files":self.data.get('files',[])
+        }
+
+    def _scan_event(self, event: bytes):
+        """
+        从事件原始字节中提取 task_id 和 conversation_id，用于停止操作，首次取到时返回需要登记的字段；
+        从 message_end 事件中取出本次对话的 token 用量
+        """
+        fields = None
+        if self.task_id is None:
+            self.task_id = scan_field(TASK_ID_RE, event)
+            self.conversation_id = scan_field(CONVERSATION_ID_RE, event)
+            if self.task_id is not None:
+                fields = {'task_id': self.task_id, 'conversation_id': self.conversation_id}
+        message_end = parse_event('message_end', event)
+        if message_end is not None:
+            usage = (message_end.get('metadata') or {}).get('usage')
+            if usage:
+                self._record_usage(usage)
+        return fields
+
+    def _on_event(self, event: bytes):
+        fields = self._scan_event(event)
+        if fields:
+            self.handle.bind(**fields)
+
+    async def _aon_event(self, event: bytes):
+        fields = self._scan_event(event)
+        if fields:
+            await self.handle.abind(**fields)
+
+    def _stop_upstream(self):
+        """
+        流被停止时通知 Dify 停止生成，避免继续消耗上游 token
+        """
+        if self.task_id:
+            try:
+                self._stop_task(self.task_id)
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+
+    def _stop_task(self, task_id: str):
+        response = get_session(self.url, self.app).post(
+            f"{self.url}/chat-messages/{task_id}/stop",
+            json={"user": self.user},
+            headers=self.headers
+        )
+        response.raise_for_status()
+        return response.json()
 
     def talk(self):
         try:
-            print(self.data)
-            if "query" not in self.data:
-                raise ValueError("query is required in data")
-            info = {
-                "inputs":self.data.get('inputs',{}),
-                "query":self.data.get('query',''),
-                "response_mode":'streaming',
-                "conversation_id":self.data.get('conversation_id',""),
-                "user":self.user,
-                "files":self.data.get('files',[])
-            }
-            response = requests.post(
+            info = self._payload()
+            response = get_session(self.url, self.app).post(
                 f"{self.url}/chat-messages",
                 data=json.dumps(info),
                 headers=self.headers,
                 stream=True
             )
             response.raise_for_status()
-            def generate_stream():
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data = json.loads(line[6:])  # 去掉 'data: ' 前缀
-                            # 保存 task_id 用于停止操作
-                            if data.get('task_id'):
-                                self.task_id = data['task_id']
-                            
-                            # 返回 SSE 格式数据
-                            yield f"{json.dumps(data)}\n"
+            handle = self._register_stream()
+            handle.on_abort(lambda: abort_response(response))
+            handle.on_abort(self._stop_upstream)
 
-            return StreamingHttpResponse(
-                generate_stream(),
-                content_type='text/event-stream'
-            )
+            # 事件内容原样透传，不再逐行解码、解析再重新序列化
+            # 结束时关闭响应，归还连接到连接池
+            return self._stream_response(guard_stream(
+                relay(iter_chunks(response), self._on_event),
+                handle,
+                response.close
+            ))
 
         except requests.exceptions.RequestException as e:
             raise ValueError(f"Agent execution failed: {str(e)}")
 
+    async def atalk(self):
+        """
+        异步流式对话，上游连接由 httpx.AsyncClient 维护，不占用工作线程
+        """
+        try:
+            info = self._payload()
+            client = get_async_client(self.url, self.app)
+            request = client.build_request(
+                "POST",
+                f"{self.url}/chat-messages",
+                content=json.dumps(info),
+                headers=self.headers
+            )
+            response = await client.send(request, stream=True)
+            try:
+                response.raise_for_status()
+            except httpx.HTTPError:
+                await response.aclose()
+                raise
+        except httpx.HTTPError as e:
+            raise ValueError(f"Agent execution failed: {str(e)}")
+
+        handle = await self._aregister_stream()
+        loop = asyncio.get_running_loop()
+        # 停止回调可能在其他线程执行，需要切回事件循环关闭上游响应
+        handle.on_abort(lambda: loop.call_soon_threadsafe(asyncio.ensure_future, response.aclose()))
+        handle.on_abort(self._stop_upstream)
+        return self._stream_response(aguard_stream(
+            arelay(response.aiter_bytes(), self._aon_event),
+            handle,
+            response.aclose
+        ))
+
     def stop(self):
+        # 停止由网关转发的流：转发该流的 worker 会中断上游连接并通知 Dify 停止
+        if self._cancel_stream() is not None:
+            return {"result": "success"}
+
         if "task_id" not in self.data:
-            raise ValueError("task_id is required in data")
-        
-        response = requests.post(
-            f"{self.url}/chat-messages/{self.data['task_id']}/stop",
-            json={"user": self.user},
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
\ No newline at end of file
+            raise ValueError("task_id or stream_id is required in data")
+        return self._stop_task(self.data['task_id'])
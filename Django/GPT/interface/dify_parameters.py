@@ -0,0 +1,112 @@
+"""
+Dify 应用参数（/parameters）缓存
+应用参数只在 Dify 中修改应用配置时才会变化，却在每个用户每次打开应用时都要读取。
+缓存存放在本地共享存储中，所有 worker 共用：
+- 未超过 DIFY_PARAMETERS_TTL：直接返回缓存
+- 超过 TTL 但未超过 DIFY_PARAMETERS_STALE：先返回旧数据，同时由一个 worker 在后台刷新
+- 没有缓存或缓存过旧：同步请求上游，所有 worker 对同一应用的并发请求只由抢到拉取权的一个发起，其余轮询等待结果
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+
+from .. import local_store
+from .http_pool import get_session
+
+def _fetch(application) -> dict:
+    response = get_session(application.api_url, application.name).get(
+        f"{application.api_url}/parameters",
+        headers={
+            "Authorization": f"Bearer {application.api_key}",
+            "Content-Type": "application/json"
+        },
+        timeout=settings.DIFY_PARAMETERS_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def _store(name: str, data: dict):
+    local_store.execute(
+        "INSERT INTO app_parameters (app, body, fetched, refreshing) VALUES (?, ?, ?, NULL) "
+        "ON CONFLICT (app) DO UPDATE SET body = excluded.body, fetched = excluded.fetched, refreshing = NULL",
+        (name, json.dumps(data), time.time())
+    )
+
+
+def _cached(name: str):
+    return local_store.execute(
+        "SELECT body, fetched FROM app_parameters WHERE app = ?", (name,)
+    ).fetchone()
+
+
+def _claim_refresh(name: str) -> bool:
+    """
+    抢占刷新权，保证同一时间只有一个 worker 在请求同一个应用的参数；缓存仍在 TTL 内时不需要刷新。
+    没有缓存时先插入 fetched 为 0 的占位记录（视为过旧，不会被返回）
+    """
+    now = time.time()
+    with local_store.transaction() as conn:
+        conn.execute(
+            "INSERT INTO app_parameters (app, body, fetched, refreshing) VALUES (?, 'null', 0, NULL) "
+            "ON CONFLICT (app) DO NOTHING",
+            (name,)
+        )
+        cursor = conn.execute(
+            "UPDATE app_parameters SET refreshing = ? "
+            "WHERE app = ? AND fetched < ? AND (refreshing IS NULL OR refreshing < ?)",
+            (now, name, now - settings.DIFY_PARAMETERS_TTL, now - settings.DIFY_PARAMETERS_TIMEOUT)
+        )
+        return cursor.rowcount == 1
+
+
+def _release_refresh(name: str):
+    local_store.execute("UPDATE app_parameters SET refreshing = NULL WHERE app = ?", (name,))
+
+
+def _refresh(application):
+    try:
+        _store(application.name, _fetch(application))
+    except Exception:
+        # 刷新失败时继续使用旧数据，释放刷新权等待下次重试
+        _release_refresh(application.name)
+
+
+def get_parameters(application) -> dict:
+    """
+    获取应用参数，上游请求失败时抛出 requests.exceptions.RequestException
+    """
+    row = _cached(application.name)
+    if row is not None:
+        age = time.time() - row['fetched']
+        if age < settings.DIFY_PARAMETERS_TTL:
+            return json.loads(row['body'])
+        if age < settings.DIFY_PARAMETERS_STALE:
+            if _claim_refresh(application.name):
+                threading.Thread(target=_refresh, args=(application,), daemon=True).start()
+            return json.loads(row['body'])
+
+    while True:
+        if _claim_refresh(application.name):
+            try:
+                data = _fetch(application)
+            except Exception:
+                # 释放拉取权，等待中的请求会重新抢占并自行请求
+                _release_refresh(application.name)
+                raise
+            _store(application.name, data)
+            return data
+        # 其他请求正在拉取；拉取权超过 DIFY_PARAMETERS_TIMEOUT 未释放时可以重新抢占
+        time.sleep(settings.DIFY_PARAMETERS_POLL_INTERVAL)
+        row = _cached(application.name)
+        if row is not None and time.time() - row['fetched'] < settings.DIFY_PARAMETERS_TTL:
+            return json.loads(row['body'])
+
+
+def invalidate(name: str):
+    """
+    应用配置被修改或删除后丢弃缓存
+    """
+    local_store.execute("DELETE FROM app_parameters WHERE app = ?", (name,))
@@ -1,30 +1,88 @@
-from django.http import StreamingHttpResponse
+import asyncio
 import requests
+import httpx
 import json
 from .port_app import PortApp
+from .http_pool import get_async_client, get_session
+from .stream_registry import abort_response, aguard_stream, guard_stream
+from .sse import TASK_ID_RE, arelay, iter_chunks, parse_event, relay, scan_field
 
 class DifyWorkflow(PortApp):
-    def __init__(self, url: str, api_key: str, data: dict, user: str):
-        super().__init__(url, api_key, data, user)
+    kind = 'dify_workflow'
+    # 工作流通常是批量运行，排队时让位于交互式对话
+    priority = 'batch'
+
+    def __init__(self, url: str, api_key: str, data: dict, user: str, app: str = ''):
+        super().__init__(url, api_key, data, user, app)
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
         self.task_id = None
 
+    def _payload(self):
+        return {
+            "inputs": self.data.get('inputs',{}),
+            "response_mode": "streaming",  # 默认使用流式模式
+            "user": self.user
+        }
+
+    def _scan_event(self, event: bytes):
+        """
+        从事件原始字节中提取 task_id，用于停止操作，首次取到时返回需要登记的字段；
+        从 workflow_finished 事件中取出本次执行的 token 用量（Dify 只报告总数）
+        """
+        fields = None
+        if self.task_id is None:
+            self.task_id = scan_field(TASK_ID_RE, event)
+            if self.task_id is not None:
+                fields = {'task_id': self.task_id}
+        finished = parse_event('workflow_finished', event)
+        if finished is not None:
+            self._record_usage({'total_tokens': (finished.get('data') or {}).get('total_tokens') or 0})
+        return fields
+
+    def _on_event(self, event: bytes):
+        fields = self._scan_event(event)
+        if fields:
+            self.handle.bind(**fields)
+
+    async def _aon_event(self, event: bytes):
+        fields = self._scan_event(event)
+        if fields:
+            await self.handle.abind(**fields)
+
+    def _stop_upstream(self):
+        """
+        流被停止时通知 Dify 停止 workflow，避免继续消耗上游 token
+        """
+        if self.task_id:
+            try:
+                self._stop_task(self.task_id)
+            except ValueError:
+                pass
+
+    def _stop_task(self, task_id: str):
+        try:
+            response = get_session(self.url, self.app).post(
+                f"{self.url}/workflows/tasks/{task_id}/stop",
+                headers=self.headers,
+                json={"user": self.user}
+            )
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Failed to stop workflow: {str(e)}")
+
     def talk(self):
         """
         执行 workflow，支持流式和阻塞模式
         """
         try:
             # 准备请求数据
-            payload = {
-                "inputs": self.data.get('inputs',{}),
-                "response_mode": "streaming",  # 默认使用流式模式
-                "user": self.user
-            }
+            payload = self._payload()
             # 发送请求
-            response = requests.post(
+            response = get_session(self.url, self.app).post(
                 f"{self.url}/workflows/run",
                 headers=self.headers,
                 data=json.dumps(payload),
@@ -36,42 +94,63 @@ class DifyWorkflow(PortApp):
                 return response.json()
 
             # 流式模式处理
-            def generate_stream():
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data = json.loads(line[6:])  # 去掉 'data: ' 前缀
-                            
-                            # 保存 task_id 用于停止操作
-                            if data.get('task_id'):
-                                self.task_id = data['task_id']
-                            
-                            # 返回 SSE 格式数据
-                            yield f"{json.dumps(data)}\n"
-
-            return StreamingHttpResponse(
-                generate_stream(),
-                content_type='text/event-stream'
-            )
+            handle = self._register_stream()
+            handle.on_abort(lambda: abort_response(response))
+            handle.on_abort(self._stop_upstream)
+
+            # 事件内容原样透传，不再逐行解码、解析再重新序列化
+            # 结束时关闭响应，归还连接到连接池
+            return self._stream_response(guard_stream(
+                relay(iter_chunks(response), self._on_event),
+                handle,
+                response.close
+            ))
 
         except requests.exceptions.RequestException as e:
             raise ValueError(f"Workflow execution failed: {str(e)}")
 
-    def stop(self):
+    async def atalk(self):
         """
-        停止正在执行的 workflow
+        异步执行 workflow（流式模式），上游连接由 httpx.AsyncClient 维护
         """
-        if not self.task_id:
-            raise ValueError("No active task to stop")
-
         try:
-            response = requests.post(
-                f"{self.url}/workflows/{self.task_id}/stop",
+            client = get_async_client(self.url, self.app)
+            request = client.build_request(
+                "POST",
+                f"{self.url}/workflows/run",
                 headers=self.headers,
-                json={"user": self.user}
+                content=json.dumps(self._payload())
             )
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise ValueError(f"Failed to stop workflow: {str(e)}")
\ No newline at end of file
+            response = await client.send(request, stream=True)
+            try:
+                response.raise_for_status()
+            except httpx.HTTPError:
+                await response.aclose()
+                raise
+        except httpx.HTTPError as e:
+            raise ValueError(f"Workflow execution failed: {str(e)}")
+
+        handle = await self._aregister_stream()
+        loop = asyncio.get_running_loop()
+        # 停止回调可能在其他线程执行，需要切回事件循环关闭上游响应
+        handle.on_abort(lambda: loop.call_soon_threadsafe(asyncio.ensure_future, response.aclose()))
+        handle.on_abort(self._stop_upstream)
+        return self._stream_response(aguard_stream(
+            arelay(response.aiter_bytes(), self._aon_event),
+            handle,
+            response.aclose
+        ))
+
+    def stop(self):
+        """
+        停止正在执行的 workflow
+        停止命令通常由新建的实例处理，task_id 需要从 data 或流登记表中获取，而不是 self.task_id
+        """
+        # 停止由网关转发的流：转发该流的 worker 会中断上游连接并通知 Dify 停止
+        if self._cancel_stream() is not None:
+            return {"result": "success"}
+
+        task_id = self.data.get('task_id')
+        if not task_id:
+            raise ValueError("No active task to stop")
+        return self._stop_task(task_id)
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class _PoolEntry:
+    def __init__(self, session: requests.Session, adapter: HTTPAdapter):
+        self.session = session
+        self.adapter = adapter
+        self.last_used = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+
+class SessionRegistry:
+    """
+    进程内的上游连接池注册表
+    按 (应用名, 上游地址) 隔离连接池，避免某个应用的大量请求占满其他应用的连接
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _new_entry(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+            pool_block=settings.HTTP_POOL_BLOCK
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return _PoolEntry(session, adapter)
+
+    def get_session(self, url: str, app: str = '') -> requests.Session:
+        key = (app, _origin(url))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.last_used > settings.HTTP_POOL_KEEPALIVE:
+                # 空闲过久的连接大概率已被上游断开，直接重建连接池
+                entry.session.close()
+                hits, misses = entry.hits, entry.misses
+                entry = self._new_entry()
+                entry.hits, entry.misses = hits, misses + 1
+                self._entries[key] = entry
+            elif entry is None:
+                entry = self._new_entry()
+                entry.misses = 1
+                self._entries[key] = entry
+            else:
+                entry.hits += 1
+            entry.last_used = now
+            return entry.session
+
+    def stats(self):
+        """
+        连接池统计：hits/misses 为连接池查找的命中情况，
+        requests/connections 为实际发出的请求数与新建的 TCP 连接数，两者差值即复用的连接数
+        """
+        pools = []
+        with self._lock:
+            for (app, origin), entry in self._entries.items():
+                requests_count = 0
+                connections = 0
+                for pool_key in entry.adapter.poolmanager.pools.keys():
+                    pool = entry.adapter.poolmanager.pools.get(pool_key)
+                    if pool is not None:
+                        requests_count += pool.num_requests
+                        connections += pool.num_connections
+                pools.append({
+                    'application': app,
+                    'origin': origin,
+                    'hits': entry.hits,
+                    'misses': entry.misses,
+                    'requests': requests_count,
+                    'connections': connections,
+                    'idle_seconds': round(time.monotonic() - entry.last_used, 1)
+                })
+        return {
+            'hits': sum(pool['hits'] for pool in pools),
+            'misses': sum(pool['misses'] for pool in pools),
+            'pool_maxsize': settings.HTTP_POOL_MAXSIZE,
+            'pools': pools
+        }
+
+
+session_registry = SessionRegistry()
+
+# 异步客户端按事件循环分别保存（httpx 的连接池绑定在创建它的事件循环上）
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_session(url: str, app: str = '') -> requests.Session:
+    return session_registry.get_session(url, app)
+
+
+def get_async_client(url: str, app: str = '') -> httpx.AsyncClient:
+    """
+    获取当前事件循环中 (应用名, 上游地址) 对应的 httpx.AsyncClient，
+    避免每个流都重新创建客户端、SSL 上下文和 TCP 连接
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    key = (app, _origin(url))
+    client = clients.get(key)
+    if client is None or client.is_closed:
+        # 流式连接会长时间占用，连接数上限需要远大于同步模式
+        client = httpx.AsyncClient(
+            timeout=None,
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_POOL_ASYNC_MAXSIZE,
+                max_keepalive_connections=settings.HTTP_POOL_MAXSIZE,
+                keepalive_expiry=settings.HTTP_POOL_KEEPALIVE
+            )
+        )
+        clients[key] = client
+    return client
+
+
+def pool_stats():
+    stats = session_registry.stats()
+    stats['async_clients'] = sum(len(clients) for clients in list(_async_clients.values()))
+    return stats
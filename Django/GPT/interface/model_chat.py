@@ -3,14 +3,98 @@ import openai
 import json
 import ast
 import time
+import asyncio
+from django.conf import settings
+from ..context_budget import ContextTooLarge, context_budget, fit_messages
+from ..conversations import conversation_store
+from ..metrics import metrics
 from .port_app import PortApp
+from .openai_clients import get_client, get_async_client
 
 class ModelChat(PortApp):
-    def __init__(self,model_name: str, url: str, api_key: str, data: dict, user: str):
+    kind = 'model'
+
+    def __init__(self,model_name: str, url: str, api_key: str, data: dict, user: str,
+                 conversation_id: str = None, history_size: int = 0, context_window: int = 0):
         super().__init__(url, api_key, data, user)
         # 设置 OpenAI API key
         self.model_name = model_name
-        self.client = openai.OpenAI(base_url=self.url, api_key=self.api_key)
+        # 服务端保存的对话：messages 的前 history_size 条来自历史，最后一条是本轮的新消息
+        self.conversation_id = conversation_id
+        self.history_size = history_size
+        self.context_window = context_window
+        # 复用缓存的客户端及其连接池，首包时间不再包含建立连接的开销
+        self.client = get_client(self.url, self.api_key)
+
+    def _stream_scope(self) -> str:
+        # 模型对话没有应用名，按模型区分
+        return self.model_name
+
+    def _chunk_data(self, completion_id: str, content: str):
+        """
+        构造 OpenAI 兼容的 NDJSON 响应
+        """
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": self.model_name,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": content},
+                    "finish_reason": None
+                }
+            ]
+        }
+
+    def _stream_options(self):
+        # 要求上游在最后一个分块中返回本次请求的 usage
+        return {"stream_options": {"include_usage": True}} if settings.MODEL_STREAM_USAGE else {}
+
+    def _save_turn(self, messages: list, reply: list):
+        """
+        把本轮的新消息和模型回复放入对话写入队列，不等待数据库写入
+        """
+        if self.conversation_id is None or not reply:
+            return
+        conversation_store.append(self.conversation_id, self.history_size, [
+            messages[-1],
+            {"role": "assistant", "content": ''.join(reply)}
+        ])
+
+    def _fit_context(self, messages: list) -> list:
+        """
+        按模型上下文窗口裁剪较早的对话轮次，超出预算时抛出 ContextTooLarge
+        """
+        if not self.context_window:
+            return messages
+        messages, dropped = fit_messages(messages, context_budget(self.context_window))
+        if dropped:
+            metrics.incr('context_messages_trimmed', dropped)
+        return messages
+
+    def _context_too_large(self, error: ContextTooLarge):
+        metrics.incr('context_rejected')
+        return StreamingHttpResponse(
+            [json.dumps({
+                "status": "error",
+                "message": str(error)
+            })],
+            content_type='text/event-stream',
+            status=413
+        )
+
+    def _missing_messages(self):
+        return StreamingHttpResponse(
+            [json.dumps({
+                "status": "error",
+                "message": "Missing required field: messages"
+            })],
+            content_type='text/event-stream',
+            status=400
+        )
+
     def talk(self):
         """
         直接调用 OpenAI API 进行对话
@@ -20,53 +104,57 @@ class ModelChat(PortApp):
             messages = self.data.get("messages", "[]")
             temperature = self.data.get("temperature", 0.7)
             if not messages or len(messages) == 0:
-                return StreamingHttpResponse(
-                    [json.dumps({
-                        "status": "error",
-                        "message": "Missing required field: messages"
-                    })],
-                    content_type='text/event-stream',
-                    status=400
-                )
+                return self._missing_messages()
+            try:
+                messages = self._fit_context(messages)
+            except ContextTooLarge as error:
+                return self._context_too_large(error)
             print(self.model_name)
+            handle = self._register_stream()
             # 发送请求
             def generate_stream():
+                response = None
+                reply = []
                 try:
                     response = self.client.chat.completions.create(
                         model=self.model_name,
                         messages=messages,
                         temperature=temperature,
-                        stream=True
+                        stream=True,
+                        **self._stream_options()
                     )
+                    # 被停止时关闭上游连接，模型随即停止生成
+                    handle.on_abort(response.close)
                     completion_id = f"chatcmpl-{int(time.time())}"
                     for chunk in response:
-                        if chunk.choices[0].delta.content is not None:
+                        if handle.cancelled.is_set():
+                            break
+                        if chunk.usage is not None:
+                            self._record_usage(chunk.usage.model_dump(), self.model_name)
+                        # 携带 usage 的最后一个分块没有 choices
+                        if chunk.choices and chunk.choices[0].delta.content is not None:
                             content = chunk.choices[0].delta.content
-                            # 构造 OpenAI 兼容的 NDJSON 响应
-                            chunk_data = {
-                                "id": completion_id,
-                                "object": "chat.completion.chunk",
-                                "created": int(time.time()),
-                                "model": self.model_name,
-                                "choices": [
-                                    {
-                                        "index": 0,
-                                        "delta": {"content": content},
-                                        "finish_reason": None
-                                    }
-                                ]
-                            }
+                            reply.append(content)
+                            chunk_data = self._chunk_data(completion_id, content)
                             yield f"data: {json.dumps(chunk_data)}\n\n"
+                except GeneratorExit:
+                    # 客户端断开连接，关闭上游连接让模型停止生成
+                    handle.disconnect()
+                    raise
                 except Exception as stream_error:
-                    error_msg = json.dumps({
-                        "status": "error",
-                        "message": f"Stream Error: {str(stream_error)}"
-                    })
-                    yield f"data: {error_msg}\n\n"
-            return StreamingHttpResponse(
-                generate_stream(),
-                content_type='text/event-stream'
-            )
+                    # 被停止时上游连接已被关闭，读取报错属于预期情况
+                    if not handle.cancelled.is_set():
+                        error_msg = json.dumps({
+                            "status": "error",
+                            "message": f"Stream Error: {str(stream_error)}"
+                        })
+                        yield f"data: {error_msg}\n\n"
+                finally:
+                    if response is not None:
+                        response.close()
+                    handle.close()
+                    self._save_turn(messages, reply)
+            return self._stream_response(generate_stream())
 
         except openai.APIError as api_error:
             error_response = json.dumps({
@@ -89,8 +177,68 @@ class ModelChat(PortApp):
                 status=500
             )
 
+    async def atalk(self):
+        """
+        talk 的异步版本，使用 openai.AsyncOpenAI 流式读取模型输出
+        """
+        messages = self.data.get("messages", "[]")
+        temperature = self.data.get("temperature", 0.7)
+        if not messages or len(messages) == 0:
+            return self._missing_messages()
+        try:
+            messages = self._fit_context(messages)
+        except ContextTooLarge as error:
+            return self._context_too_large(error)
+        client = get_async_client(self.url, self.api_key)
+        handle = await self._aregister_stream()
+        loop = asyncio.get_running_loop()
+
+        async def generate_stream():
+            response = None
+            reply = []
+            try:
+                response = await client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    **self._stream_options()
+                )
+                # 停止回调可能在其他线程执行，需要切回事件循环关闭上游响应
+                handle.on_abort(lambda: loop.call_soon_threadsafe(asyncio.ensure_future, response.close()))
+                completion_id = f"chatcmpl-{int(time.time())}"
+                async for chunk in response:
+                    if handle.cancelled.is_set():
+                        break
+                    if chunk.usage is not None:
+                        self._record_usage(chunk.usage.model_dump(), self.model_name)
+                    if chunk.choices and chunk.choices[0].delta.content is not None:
+                        reply.append(chunk.choices[0].delta.content)
+                        chunk_data = self._chunk_data(completion_id, chunk.choices[0].delta.content)
+                        yield f"data: {json.dumps(chunk_data)}\n\n"
+            except (GeneratorExit, asyncio.CancelledError):
+                handle.disconnect()
+                raise
+            except Exception as stream_error:
+                if not handle.cancelled.is_set():
+                    error_msg = json.dumps({
+                        "status": "error",
+                        "message": f"Stream Error: {str(stream_error)}"
+                    })
+                    yield f"data: {error_msg}\n\n"
+            finally:
+                if response is not None:
+                    await response.close()
+                await handle.aclose()
+                self._save_turn(messages, reply)
+
+        return self._stream_response(generate_stream())
+
     def stop(self):
         """
-        停止当前对话（对于 OpenAI API，实际上不需要停止操作）
+        停止当前对话：OpenAI 兼容接口没有单独的停止接口，
+        由转发该流的 worker 关闭上游连接，模型随即停止生成
         """
-        return {"status": "success", "message": "Chat stopped"} 
\ No newline at end of file
+        if self._cancel_stream() is None:
+            return {"status": "error", "message": "Stream not found or already finished"}
+        return {"status": "success", "message": "Chat stopped"}
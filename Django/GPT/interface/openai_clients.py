@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+
+import openai
+from django.conf import settings
+
+
+class ClientCache:
+    """
+    按 (model_url, model_key) 缓存 OpenAI 客户端的 LRU 缓存
+    复用客户端内部的 httpx 连接池，避免每次对话都重新建立连接
+    被淘汰或失效的客户端只是不再复用，正在进行中的流式响应不受影响
+    """
+
+    def __init__(self, factory, maxsize: int):
+        self._factory = factory
+        self._maxsize = maxsize
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_url: str, model_key: str):
+        key = (model_url, model_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            client = self._factory(base_url=model_url, api_key=model_key)
+            self._clients[key] = client
+            while len(self._clients) > self._maxsize:
+                self._clients.popitem(last=False)
+            return client
+
+    def invalidate(self, model_url: str, model_key: str):
+        with self._lock:
+            self._clients.pop((model_url, model_key), None)
+
+    def __len__(self):
+        return len(self._clients)
+
+
+_sync_clients = ClientCache(openai.OpenAI, settings.OPENAI_CLIENT_CACHE_SIZE)
+# AsyncOpenAI 的连接池绑定在事件循环上，按事件循环分别缓存
+_async_clients = weakref.WeakKeyDictionary()
+_async_lock = threading.Lock()
+
+
+def get_client(model_url: str, model_key: str) -> openai.OpenAI:
+    return _sync_clients.get(model_url, model_key)
+
+
+def get_async_client(model_url: str, model_key: str) -> openai.AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    with _async_lock:
+        cache = _async_clients.get(loop)
+        if cache is None:
+            cache = ClientCache(openai.AsyncOpenAI, settings.OPENAI_CLIENT_CACHE_SIZE)
+            _async_clients[loop] = cache
+    return cache.get(model_url, model_key)
+
+
+def invalidate(model_url: str, model_key: str):
+    """
+    模型配置被修改或删除后，丢弃使用旧地址/密钥的客户端
+    """
+    _sync_clients.invalidate(model_url, model_key)
+    with _async_lock:
+        caches = list(_async_clients.values())
+    for cache in caches:
+        cache.invalidate(model_url, model_key)
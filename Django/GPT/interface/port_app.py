@@ -1,16 +1,162 @@
 from abc import ABC, abstractmethod
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+
+from ..usage import usage_meter
+from .stream_registry import stream_registry
+from .upstream_scheduler import UpstreamBusy, upstream_scheduler
+
+class StreamResponse(StreamingHttpResponse):
+    """
+    转发上游流的响应，响应关闭时注销流（即使生成器从未开始迭代）
+    """
+
+    def __init__(self, streaming_content, handle):
+        super().__init__(streaming_content, content_type='text/event-stream')
+        self.handle = handle
+        # 前端停止对话时需要带上 stream_id
+        self['X-Stream-Id'] = handle.stream_id
+
+    def close(self):
+        super().close()
+        if not self.handle.closed:
+            # 生成器没有运行到结束（未开始迭代，或异步生成器未被关闭），说明客户端已经离开
+            self.handle.disconnect()
+            self.handle.close()
+
+
+def on_response_close(response, callback):
+    """
+    转发流的响应在流结束时执行 callback，其他响应（参数错误等）立即执行
+    """
+    if isinstance(response, StreamResponse) and not response.handle.closed:
+        response.handle.on_close(callback)
+    else:
+        callback()
+    return response
+
+
 class PortApp(ABC):
-    def __init__(self, url: str, api_key: str, data: dict, user: str):
+    # 流类型，用于流登记表中区分不同的上游
+    kind = ''
+    # 上游槽位调度的优先级类别，权重见 UPSTREAM_CLASS_WEIGHTS
+    priority = 'interactive'
+
+    def __init__(self, url: str, api_key: str, data: dict, user: str, app: str = ''):
         self.url = url
         self.api_key = api_key
         self.data = data
         self.user = user
+        # 应用名，用于隔离上游连接池
+        self.app = app
+        self.handle = None
 
     @abstractmethod
     def talk(self):
         pass
 
+    @abstractmethod
+    async def atalk(self):
+        """
+        talk 的异步版本，供 ASGI 部署下的异步视图使用
+        """
+        pass
+
     @abstractmethod
     def stop(self):
-        pass
\ No newline at end of file
+        pass
+
+    def schedule_talk(self):
+        """
+        在上游槽位调度器中排队，得到槽位后调用 talk，流结束时归还槽位
+        """
+        try:
+            slot = upstream_scheduler.acquire(self.url.rstrip('/'), self.user, self.priority)
+        except UpstreamBusy as error:
+            return self._upstream_busy(error)
+        if slot is None:
+            return self.talk()
+        try:
+            response = self.talk()
+        except BaseException:
+            slot.release()
+            raise
+        return on_response_close(response, slot.release)
+
+    async def aschedule_talk(self):
+        """
+        schedule_talk 的异步版本
+        """
+        try:
+            slot = await upstream_scheduler.aacquire(self.url.rstrip('/'), self.user, self.priority)
+        except UpstreamBusy as error:
+            return self._upstream_busy(error)
+        if slot is None:
+            return await self.atalk()
+        try:
+            response = await self.atalk()
+        except BaseException:
+            await slot.arelease()
+            raise
+        return on_response_close(response, slot.release)
+
+    def _upstream_busy(self, error: UpstreamBusy):
+        response = JsonResponse({
+            'status': 'error',
+            'message': str(error)
+        }, status=503)
+        response['Retry-After'] = str(settings.LOAD_SHED_RETRY_AFTER)
+        return response
+
+    def _stream_scope(self) -> str:
+        """
+        流登记表中区分同一用户不同对话对象的名称，停止命令没有 stream_id 时按它查找最近的流
+        """
+        return self.app
+
+    def _register_stream(self):
+        """
+        在跨 worker 的流登记表中登记本次对话，停止命令可以由任意 worker 处理
+        """
+        self.handle = stream_registry.register(self.kind, self.user, self._stream_scope())
+        return self.handle
+
+    async def _aregister_stream(self):
+        """
+        _register_stream 的异步版本，登记在线程池中执行
+        """
+        self.handle = await sync_to_async(
+            stream_registry.register, thread_sensitive=False
+        )(self.kind, self.user, self._stream_scope())
+        return self.handle
+
+    def _record_usage(self, usage: dict, model: str = ''):
+        """
+        记录上游报告的 token 用量（OpenAI 格式的 usage 字典）
+        """
+        usage_meter.record(
+            username=self.user,
+            kind=self.kind,
+            app=self.app,
+            model=model,
+            prompt_tokens=usage.get('prompt_tokens', 0),
+            completion_tokens=usage.get('completion_tokens', 0),
+            total_tokens=usage.get('total_tokens', 0)
+        )
+
+    def _stream_response(self, stream):
+        return StreamResponse(stream, self.handle)
+
+    def _cancel_stream(self):
+        """
+        根据 data 中的 stream_id 取消正在转发的流，返回流的登记信息（没有对应的流时返回 None）；
+        既没有 stream_id 也没有 task_id 时取消当前用户在该应用（或模型）下最近的流
+        """
+        stream_id = self.data.get('stream_id')
+        if not stream_id and not self.data.get('task_id'):
+            stream_id = stream_registry.latest(self.kind, self.user, self._stream_scope())
+        if not stream_id:
+            return None
+        return stream_registry.cancel(stream_id, self.user)
@@ -0,0 +1,150 @@
+import json
+import re
+
+from django.conf import settings
+
+# 只需要从事件中取出少数几个字段，用正则扫描原始字节即可，无需完整解析 JSON
+TASK_ID_RE = re.compile(rb'"task_id"\s*:\s*"([^"]*)"')
+CONVERSATION_ID_RE = re.compile(rb'"conversation_id"\s*:\s*"([^"]*)"')
+EVENT_RE = re.compile(rb'"event"\s*:\s*"([^"]*)"')
+
+
+def scan_field(pattern, data: bytes):
+    """
+    在事件原始字节中查找字段值，找不到时返回 None
+    """
+    match = pattern.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode('utf-8')
+
+
+def parse_event(name: str, data: bytes):
+    """
+    data 是名为 name 的事件时返回解析后的 JSON，否则返回 None
+    先做字节查找，只有极少数事件需要完整解析
+    """
+    if f'"{name}"'.encode('ascii') not in data or scan_field(EVENT_RE, data) != name:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def _event_data(event: bytes):
+    """
+    取出一个 SSE 事件中 data 字段的原始字节，没有 data 字段（如 ping 事件）时返回 None
+    """
+    # 绝大多数事件只有一行 data，直接切片即可
+    if event.startswith(b'data: ') and b'\n' not in event:
+        return event[6:]
+    lines = []
+    for line in event.split(b'\n'):
+        if line.startswith(b'data:'):
+            line = line[5:]
+            lines.append(line[1:] if line.startswith(b' ') else line)
+    if not lines:
+        return None
+    return b'\n'.join(lines)
+
+
+class SSEParser:
+    """
+    增量 SSE 解析器
+    直接在字节缓冲区上按空行切分事件，不做解码，也不解析事件内容。
+    行尾可以是 \n、\r\n 或 \r，统一转换为 \n 后再切分
+    """
+
+    def __init__(self):
+        self._buffer = b''
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        写入一段上游数据，返回其中所有完整事件的 data 字段（原始字节）
+        """
+        buffer = self._buffer + chunk
+        tail = b''
+        if b'\r' in buffer:
+            if buffer.endswith(b'\r'):
+                # \r\n 可能被拆在两个分块中，末尾的 \r 留到下一个分块再判断，避免算成两次换行
+                buffer, tail = buffer[:-1], b'\r'
+            buffer = buffer.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        events = buffer.split(b'\n\n')
+        self._buffer = events.pop() + tail
+        result = []
+        for event in events:
+            data = _event_data(event)
+            if data is not None:
+                result.append(data)
+        return result
+
+    def flush(self) -> list:
+        """
+        上游结束时取出缓冲区中最后一个未以空行结尾的事件
+        """
+        buffer, self._buffer = self._buffer.strip(), b''
+        if not buffer:
+            return []
+        data = _event_data(buffer)
+        return [] if data is None else [data]
+
+
+def iter_chunks(response, size: int = None):
+    """
+    按到达顺序读取 requests 流式响应的原始数据
+    read1 有多少读多少，不会为了凑满缓冲区而阻塞，缓冲区大小只是单次读取的上限
+    """
+    size = size or settings.SSE_READ_SIZE
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:
+        # 旧版 urllib3 没有 read1，退回到按网络分块读取
+        yield from response.iter_content(chunk_size=None)
+        return
+    while True:
+        chunk = read1(size, decode_content=True)
+        if not chunk:
+            break
+        yield chunk
+
+
+def relay(chunks, on_event=None):
+    """
+    透传转发：把上游 SSE 事件的 data 原样转成前端使用的逐行 JSON（NDJSON）
+    on_event 会收到每个事件的原始字节，用于提取 task_id 等字段
+    同一个网络分块中的多个事件合并为一次输出
+    """
+    parser = SSEParser()
+    for chunk in chunks:
+        events = parser.feed(chunk)
+        if events:
+            if on_event is not None:
+                for event in events:
+                    on_event(event)
+            yield b'\n'.join(events) + b'\n'
+    events = parser.flush()
+    if events:
+        if on_event is not None:
+            for event in events:
+                on_event(event)
+        yield b'\n'.join(events) + b'\n'
+
+
+async def arelay(chunks, on_event=None):
+    """
+    relay 的异步版本，chunks 为异步迭代器，on_event 为协程函数
+    """
+    parser = SSEParser()
+    async for chunk in chunks:
+        events = parser.feed(chunk)
+        if events:
+            if on_event is not None:
+                for event in events:
+                    await on_event(event)
+            yield b'\n'.join(events) + b'\n'
+    events = parser.flush()
+    if events:
+        if on_event is not None:
+            for event in events:
+                await on_event(event)
+        yield b'\n'.join(events) + b'\n'
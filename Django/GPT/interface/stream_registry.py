@@ -0,0 +1,241 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .. import local_store
+from ..metrics import metrics
+
+
+def abort_response(response):
+    """
+    中断 requests 的流式响应：先关闭底层 socket 以唤醒阻塞在读取上的线程，再释放连接
+    """
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def guard_stream(chunks, handle, on_close):
+    """
+    包装同步的转发生成器：被停止后立即结束，结束时释放上游连接并注销流
+    """
+    try:
+        for chunk in chunks:
+            yield chunk
+            if handle.cancelled.is_set():
+                break
+    except GeneratorExit:
+        # 客户端断开后 WSGI 服务器写入失败，会关闭响应，生成器在 yield 处退出
+        handle.disconnect()
+        raise
+    except Exception:
+        # 被停止时上游连接已被强制关闭，读取报错属于预期情况
+        if not handle.cancelled.is_set():
+            raise
+    finally:
+        on_close()
+        handle.close()
+
+
+async def aguard_stream(chunks, handle, on_close):
+    """
+    guard_stream 的异步版本，on_close 为协程函数
+    """
+    try:
+        async for chunk in chunks:
+            yield chunk
+            if handle.cancelled.is_set():
+                break
+    except (GeneratorExit, asyncio.CancelledError):
+        # 客户端断开后 ASGI 处理器会取消响应任务；通知上游停止是阻塞请求，放到线程池执行
+        asyncio.get_running_loop().run_in_executor(None, handle.disconnect)
+        raise
+    except Exception:
+        if not handle.cancelled.is_set():
+            raise
+    finally:
+        await on_close()
+        await handle.aclose()
+
+
+class StreamHandle:
+    """
+    一个正在转发的流，在流结束时必须调用 close()
+    """
+
+    def __init__(self, registry, stream_id: str):
+        self.registry = registry
+        self.stream_id = stream_id
+        self.cancelled = threading.Event()
+        self._aborts = []
+        self._closers = []
+        self._closed = False
+
+    def bind(self, **fields):
+        """
+        记录上游的 task_id / conversation_id，供其他 worker 处理停止命令时查找
+        """
+        self.registry.bind(self.stream_id, **fields)
+
+    async def abind(self, **fields):
+        # 写共享存储可能等待文件锁，放到线程池执行，不阻塞事件循环
+        await sync_to_async(self.bind, thread_sensitive=False)(**fields)
+
+    def on_abort(self, callback):
+        """
+        注册被停止时执行的回调，例如关闭上游连接
+        """
+        self._aborts.append(callback)
+
+    def on_close(self, callback):
+        """
+        注册流结束时执行的回调，例如释放准入控制的并发名额
+        """
+        self._closers.append(callback)
+
+    def abort(self):
+        if self.cancelled.is_set():
+            return
+        self.cancelled.set()
+        for callback in self._aborts:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def disconnect(self):
+        """
+        客户端在流结束前断开了连接：立即中断上游，不再继续消耗 token
+        """
+        if self.cancelled.is_set():
+            return
+        metrics.incr('stream_aborted_by_client')
+        self.abort()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.registry.finish(self)
+            for callback in self._closers:
+                try:
+                    callback()
+                except Exception:
+                    pass
+
+    async def aclose(self):
+        """
+        close 的异步版本，注销流和释放名额的回调都在线程池中执行
+        """
+        if not self._closed:
+            await sync_to_async(self.close, thread_sensitive=False)()
+
+
+class StreamRegistry:
+    """
+    跨 worker 的流登记表
+    每个流在本地共享存储中登记 stream_id -> 上游任务，停止命令可能由任意 worker 处理：
+    处理停止命令的 worker 把记录标记为已取消，转发该流的 worker 由后台线程轮询发现后立即中断上游
+    """
+
+    def __init__(self):
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._last_cleanup = 0
+
+    def register(self, kind: str, user: str, app: str = '') -> StreamHandle:
+        stream_id = uuid.uuid4().hex
+        local_store.execute(
+            "INSERT INTO streams (stream_id, kind, app, user, pid, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (stream_id, kind, app, user, os.getpid(), time.time())
+        )
+        handle = StreamHandle(self, stream_id)
+        with self._lock:
+            self._handles[stream_id] = handle
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name='stream-registry', daemon=True)
+                self._watcher.start()
+        return handle
+
+    def bind(self, stream_id: str, task_id: str = None, conversation_id: str = None):
+        local_store.execute(
+            "UPDATE streams SET task_id = COALESCE(?, task_id), conversation_id = COALESCE(?, conversation_id) "
+            "WHERE stream_id = ?",
+            (task_id, conversation_id, stream_id)
+        )
+
+    def lookup(self, stream_id: str):
+        row = local_store.execute("SELECT * FROM streams WHERE stream_id = ?", (stream_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def latest(self, kind: str, user: str, app: str = ''):
+        """
+        指定用户在该应用（或模型）下最近开始、尚未取消的流的 stream_id，没有时返回 None
+        """
+        row = local_store.execute(
+            "SELECT stream_id FROM streams WHERE user = ? AND kind = ? AND app = ? AND cancelled = 0 "
+            "ORDER BY created DESC LIMIT 1",
+            (user, kind, app)
+        ).fetchone()
+        return row['stream_id'] if row is not None else None
+
+    def cancel(self, stream_id: str, user: str):
+        """
+        取消指定用户的流，返回流的登记信息（不存在或不属于该用户时返回 None）
+        """
+        entry = self.lookup(stream_id)
+        if entry is None or entry['user'] != user:
+            return None
+        local_store.execute("UPDATE streams SET cancelled = 1 WHERE stream_id = ?", (stream_id,))
+        metrics.incr('stream_cancelled_by_user')
+        # 流就在当前进程中时无需等待轮询
+        handle = self._handles.get(stream_id)
+        if handle is not None:
+            handle.abort()
+        return entry
+
+    def finish(self, handle: StreamHandle):
+        with self._lock:
+            self._handles.pop(handle.stream_id, None)
+        local_store.execute("DELETE FROM streams WHERE stream_id = ?", (handle.stream_id,))
+
+    def _watch(self):
+        pid = os.getpid()
+        while True:
+            time.sleep(settings.STREAM_CANCEL_POLL_INTERVAL)
+            try:
+                if self._handles:
+                    rows = local_store.execute(
+                        "SELECT stream_id FROM streams WHERE pid = ? AND cancelled = 1", (pid,)
+                    ).fetchall()
+                    for row in rows:
+                        handle = self._handles.get(row['stream_id'])
+                        if handle is not None:
+                            handle.abort()
+                now = time.time()
+                if now - self._last_cleanup > 60:
+                    # 清理异常退出的 worker 遗留的记录
+                    self._last_cleanup = now
+                    local_store.execute(
+                        "DELETE FROM streams WHERE created < ?", (now - settings.STREAM_REGISTRY_TTL,)
+                    )
+            except Exception:
+                pass
+
+
+stream_registry = StreamRegistry()
@@ -0,0 +1,236 @@
+"""
+上游并发槽位调度
+模型服务和本地 Ollama 只能同时生成少量回复，先到的请求原本会占满全部并发。
+每个上游（按 url 区分）最多同时转发 UPSTREAM_SLOTS 个对话，超出的请求排队，用加权公平队列（自计时公平队列 SCFQ）决定先后：
+每个 (优先级, 用户) 是一条队列流，请求的虚拟完成时间 = max(上游虚拟时间, 该流上一个请求的完成时间) + 1 / 优先级权重，
+空出槽位时交给完成时间最小的请求。同一优先级内各用户轮流得到槽位，交互式对话按权重优先于批量运行的工作流。
+排队超时或客户端断开的请求退还它在队列流上预先计入的完成时间，不影响该用户之后的请求。
+槽位和队列保存在本地共享存储中，同一台机器上的所有 worker 共用同一组槽位
+"""
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .. import local_store
+from ..metrics import metrics
+
+
+class UpstreamBusy(Exception):
+    pass
+
+
+def _in_thread(func):
+    # 不访问 Django ORM，不需要限定在同一个线程中执行
+    return sync_to_async(func, thread_sensitive=False)
+
+
+def _capacity(upstream: str) -> int:
+    return settings.UPSTREAM_SLOTS_OVERRIDES.get(upstream, settings.UPSTREAM_SLOTS)
+
+
+class Slot:
+    """
+    一个占用中的上游槽位，流结束时必须调用 release()
+    """
+
+    def __init__(self, scheduler, slot_id: str):
+        self.scheduler = scheduler
+        self.slot_id = slot_id
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self.slot_id)
+
+    async def arelease(self):
+        if not self.released:
+            self.released = True
+            await self.scheduler.arelease(self.slot_id)
+
+
+class UpstreamScheduler:
+    def __init__(self):
+        # 本进程归还槽位时唤醒本进程的排队请求，其他进程归还的槽位靠轮询发现
+        self._changed = threading.Condition()
+        self._last_reap = 0
+
+    def _free(self, conn, upstream: str, capacity: int) -> bool:
+        used = conn.execute("SELECT COUNT(*) FROM upstream_slots WHERE upstream = ?", (upstream,)).fetchone()[0]
+        return used < capacity
+
+    def _take(self, conn, upstream: str, slot_id: str, finish: float, now: float) -> str:
+        conn.execute(
+            "INSERT INTO upstream_slots (slot_id, upstream, pid, created) VALUES (?, ?, ?, ?)",
+            (slot_id, upstream, os.getpid(), now)
+        )
+        conn.execute(
+            "INSERT INTO upstream_vtime (upstream, vtime) VALUES (?, ?) "
+            "ON CONFLICT (upstream) DO UPDATE SET vtime = MAX(vtime, excluded.vtime)",
+            (upstream, finish)
+        )
+        # 完成时间不晚于虚拟时间的流已经空闲，下次按虚拟时间计算即可
+        conn.execute(
+            "DELETE FROM upstream_flows WHERE upstream = ? AND finish <= "
+            "(SELECT vtime FROM upstream_vtime WHERE upstream = ?)",
+            (upstream, upstream)
+        )
+        return slot_id
+
+    def _reap(self, conn, upstream: str, now: float):
+        """
+        清理异常退出的 worker 遗留的槽位和排队记录，每个进程每秒最多一次
+        """
+        if now - self._last_reap < 1:
+            return
+        self._last_reap = now
+        pids = {
+            row['pid'] for row in conn.execute(
+                "SELECT pid FROM upstream_slots WHERE upstream = ? UNION SELECT pid FROM upstream_queue WHERE upstream = ?",
+                (upstream, upstream)
+            )
+        }
+        stale = [pid for pid in pids if not local_store.pid_alive(pid)]
+        placeholders = ', '.join('?' * len(stale)) or 'NULL'
+        conn.execute(
+            f"DELETE FROM upstream_slots WHERE upstream = ? AND (created < ? OR pid IN ({placeholders}))",
+            (upstream, now - settings.STREAM_REGISTRY_TTL, *stale)
+        )
+        conn.execute(f"DELETE FROM upstream_queue WHERE pid IN ({placeholders})", stale)
+
+    def _enqueue(self, upstream: str, ticket: str, flow: str, weight: float, capacity: int) -> bool:
+        """
+        计算请求的虚拟完成时间；没有人排队且有空位时直接占用 slot_id 为 ticket 的槽位并返回 True，否则排队并返回 False
+        """
+        now = time.time()
+        with local_store.transaction() as conn:
+            row = conn.execute("SELECT vtime FROM upstream_vtime WHERE upstream = ?", (upstream,)).fetchone()
+            vtime = row['vtime'] if row is not None else 0
+            row = conn.execute(
+                "SELECT finish FROM upstream_flows WHERE upstream = ? AND flow = ?", (upstream, flow)
+            ).fetchone()
+            finish = max(vtime, row['finish'] if row is not None else 0) + 1 / weight
+            conn.execute(
+                "INSERT INTO upstream_flows (upstream, flow, finish) VALUES (?, ?, ?) "
+                "ON CONFLICT (upstream, flow) DO UPDATE SET finish = excluded.finish",
+                (upstream, flow, finish)
+            )
+            queued = conn.execute("SELECT 1 FROM upstream_queue WHERE upstream = ? LIMIT 1", (upstream,)).fetchone()
+            if queued is None and self._free(conn, upstream, capacity):
+                self._take(conn, upstream, ticket, finish, now)
+                return True
+            conn.execute(
+                "INSERT INTO upstream_queue (ticket, upstream, flow, cost, finish, enqueued, pid) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (ticket, upstream, flow, 1 / weight, finish, now, os.getpid())
+            )
+            return False
+
+    def _dispatch(self, upstream: str, ticket: str, capacity: int) -> bool:
+        """
+        排在最前面且有空位时占用 slot_id 为 ticket 的槽位并返回 True，否则返回 False
+        """
+        now = time.time()
+        with local_store.transaction() as conn:
+            head = conn.execute(
+                "SELECT ticket, finish FROM upstream_queue WHERE upstream = ? ORDER BY finish, enqueued LIMIT 1",
+                (upstream,)
+            ).fetchone()
+            if head is None or head['ticket'] != ticket or not self._free(conn, upstream, capacity):
+                self._reap(conn, upstream, now)
+                return False
+            conn.execute("DELETE FROM upstream_queue WHERE ticket = ?", (ticket,))
+            self._take(conn, upstream, ticket, head['finish'], now)
+            return True
+
+    def _abandon(self, ticket: str):
+        """
+        放弃排队：退还该请求计入队列流的完成时间，同一流中排在它后面的请求相应提前；
+        已经分到槽位（异步等待被取消时可能发生）则归还槽位
+        """
+        with local_store.transaction() as conn:
+            row = conn.execute(
+                "SELECT upstream, flow, cost, finish FROM upstream_queue WHERE ticket = ?", (ticket,)
+            ).fetchone()
+            if row is None:
+                conn.execute("DELETE FROM upstream_slots WHERE slot_id = ?", (ticket,))
+                return
+            conn.execute("DELETE FROM upstream_queue WHERE ticket = ?", (ticket,))
+            conn.execute(
+                "UPDATE upstream_queue SET finish = finish - ? WHERE upstream = ? AND flow = ? AND finish > ?",
+                (row['cost'], row['upstream'], row['flow'], row['finish'])
+            )
+            conn.execute(
+                "UPDATE upstream_flows SET finish = finish - ? WHERE upstream = ? AND flow = ?",
+                (row['cost'], row['upstream'], row['flow'])
+            )
+        with self._changed:
+            self._changed.notify_all()
+
+    def _admitted(self, priority: str, started: float):
+        metrics.observe(f'upstream_wait_seconds.{priority}', time.monotonic() - started)
+
+    def _timed_out(self, ticket: str, priority: str):
+        self._abandon(ticket)
+        metrics.incr(f'upstream_queue_timeout.{priority}')
+        raise UpstreamBusy('上游服务繁忙，排队超时')
+
+    def acquire(self, upstream: str, user: str, priority: str):
+        """
+        为 user 占用 upstream 的一个槽位，必要时排队；上游不限并发时返回 None，排队超时抛出 UpstreamBusy
+        """
+        capacity = _capacity(upstream)
+        if not capacity:
+            return None
+        started = time.monotonic()
+        weight = settings.UPSTREAM_CLASS_WEIGHTS.get(priority, 1)
+        ticket = uuid.uuid4().hex
+        taken = self._enqueue(upstream, ticket, f'{priority}:{user}', weight, capacity)
+        while not taken:
+            if time.monotonic() - started >= settings.UPSTREAM_QUEUE_TIMEOUT:
+                self._timed_out(ticket, priority)
+            with self._changed:
+                self._changed.wait(settings.UPSTREAM_POLL_INTERVAL)
+            taken = self._dispatch(upstream, ticket, capacity)
+        self._admitted(priority, started)
+        return Slot(self, ticket)
+
+    async def aacquire(self, upstream: str, user: str, priority: str):
+        """
+        acquire 的异步版本，排队时不占用事件循环；读写共享存储可能等待文件锁，都放到线程池执行
+        """
+        capacity = _capacity(upstream)
+        if not capacity:
+            return None
+        started = time.monotonic()
+        weight = settings.UPSTREAM_CLASS_WEIGHTS.get(priority, 1)
+        ticket = uuid.uuid4().hex
+        try:
+            taken = await _in_thread(self._enqueue)(upstream, ticket, f'{priority}:{user}', weight, capacity)
+            while not taken:
+                if time.monotonic() - started >= settings.UPSTREAM_QUEUE_TIMEOUT:
+                    await _in_thread(self._timed_out)(ticket, priority)
+                await asyncio.sleep(settings.UPSTREAM_POLL_INTERVAL)
+                taken = await _in_thread(self._dispatch)(upstream, ticket, capacity)
+        except asyncio.CancelledError:
+            # 客户端在排队时断开；被取消时线程中的占用可能已经完成，按 ticket 一并归还
+            await _in_thread(self._abandon)(ticket)
+            raise
+        self._admitted(priority, started)
+        return Slot(self, ticket)
+
+    def release(self, slot_id: str):
+        local_store.execute("DELETE FROM upstream_slots WHERE slot_id = ?", (slot_id,))
+        with self._changed:
+            self._changed.notify_all()
+
+    async def arelease(self, slot_id: str):
+        await _in_thread(self.release)(slot_id)
+
+
+upstream_scheduler = UpstreamScheduler()
@@ -0,0 +1,248 @@
+"""
+过载保护
+所有 worker 都在转发长时间的流时，新的对话请求原本会在 gunicorn backlog 中一直等到 --timeout。
+同一台机器上所有 worker 同时处理的对话数不超过 LOAD_SHED_MAX_ACTIVE，超出的请求进入有界队列按先后等待空位；
+队列已满，或者等待时间超过 LOAD_SHED_MAX_WAIT 时，请求立即返回 503 和 Retry-After，由客户端稍后重试，
+不会一起等到超时。等待时间也包括反向代理通过 X-Request-Start 报告的、请求在 backlog 中排队的时间。
+空位和队列保存在本地共享存储中，同步 worker 每个只处理一个请求，按进程计数永远不会达到上限
+"""
+import asyncio
+import os
+import threading
+import time
+import uuid
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from . import local_store
+from .interface.port_app import StreamResponse, on_response_close
+from .metrics import metrics
+
+
+class Overloaded(Exception):
+    pass
+
+
+def _in_thread(func):
+    # 读写共享存储可能等待文件锁，放到线程池执行，不阻塞事件循环
+    return sync_to_async(func, thread_sensitive=False)
+
+
+def request_queued_seconds(request) -> float:
+    """
+    反向代理写入 X-Request-Start（nginx: t=${msec}）到现在的秒数，没有该请求头时为 0
+    """
+    header = request.META.get('HTTP_X_REQUEST_START', '')
+    try:
+        started = float(header.removeprefix('t='))
+    except ValueError:
+        return 0.0
+    # 也接受毫秒和微秒时间戳
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, time.time() - started)
+
+
+class LoadShedder:
+    def __init__(self):
+        # 本进程让出空位时唤醒本进程的排队请求，其他进程让出的空位靠轮询发现
+        self._changed = threading.Condition()
+        self._last_reap = 0
+
+    def _reap(self, conn, now: float):
+        """
+        清理异常退出的 worker 遗留的空位和排队记录，每个进程每秒最多一次
+        """
+        if now - self._last_reap < 1:
+            return
+        self._last_reap = now
+        pids = {row['pid'] for row in conn.execute("SELECT pid FROM shed_active UNION SELECT pid FROM shed_queue")}
+        stale = [pid for pid in pids if not local_store.pid_alive(pid)]
+        placeholders = ', '.join('?' * len(stale)) or 'NULL'
+        conn.execute(
+            f"DELETE FROM shed_active WHERE created < ? OR pid IN ({placeholders})",
+            (now - settings.STREAM_REGISTRY_TTL, *stale)
+        )
+        conn.execute(f"DELETE FROM shed_queue WHERE pid IN ({placeholders})", stale)
+
+    def _take(self, conn, ticket: str, now: float):
+        conn.execute("INSERT INTO shed_active (ticket, pid, created) VALUES (?, ?, ?)", (ticket, os.getpid(), now))
+        metrics.gauge('load_shed_active', conn.execute("SELECT COUNT(*) FROM shed_active").fetchone()[0])
+
+    def _enter(self, ticket: str) -> bool:
+        """
+        有空位且没有人排队时直接占用并返回 True，否则排队并返回 False，队列已满时抛出 Overloaded
+        """
+        now = time.time()
+        with local_store.transaction() as conn:
+            self._reap(conn, now)
+            active = conn.execute("SELECT COUNT(*) FROM shed_active").fetchone()[0]
+            queued = conn.execute("SELECT COUNT(*) FROM shed_queue").fetchone()[0]
+            if not queued and active < settings.LOAD_SHED_MAX_ACTIVE:
+                self._take(conn, ticket, now)
+                return True
+            if queued >= settings.LOAD_SHED_QUEUE_DEPTH:
+                metrics.incr('load_shed_queue_full')
+                raise Overloaded('服务繁忙，排队人数已满')
+            conn.execute("INSERT INTO shed_queue (ticket, pid, enqueued) VALUES (?, ?, ?)", (ticket, os.getpid(), now))
+            metrics.gauge('load_shed_queue_depth', queued + 1)
+            return False
+
+    def _dispatch(self, ticket: str) -> bool:
+        """
+        排在最前面且有空位时占用空位并返回 True，否则返回 False
+        """
+        now = time.time()
+        with local_store.transaction() as conn:
+            head = conn.execute("SELECT ticket FROM shed_queue ORDER BY enqueued, rowid LIMIT 1").fetchone()
+            active = conn.execute("SELECT COUNT(*) FROM shed_active").fetchone()[0]
+            if head is None or head['ticket'] != ticket or active >= settings.LOAD_SHED_MAX_ACTIVE:
+                self._reap(conn, now)
+                return False
+            conn.execute("DELETE FROM shed_queue WHERE ticket = ?", (ticket,))
+            self._take(conn, ticket, now)
+            return True
+
+    def _leave(self, ticket: str):
+        """
+        放弃排队（超时或被取消）；已经分到空位（异步等待被取消时可能发生）则让出空位
+        """
+        with local_store.transaction() as conn:
+            conn.execute("DELETE FROM shed_queue WHERE ticket = ?", (ticket,))
+            conn.execute("DELETE FROM shed_active WHERE ticket = ?", (ticket,))
+            metrics.gauge('load_shed_queue_depth', conn.execute("SELECT COUNT(*) FROM shed_queue").fetchone()[0])
+        # 排在后面的请求可能因此到了队首
+        with self._changed:
+            self._changed.notify_all()
+
+    def _admitted(self, granted: bool, queued: float, started: float):
+        metrics.observe('load_shed_wait_seconds', queued + time.monotonic() - started)
+        if not granted:
+            metrics.incr('load_shed_timeout')
+            raise Overloaded('服务繁忙，排队超时')
+
+    def _deadline(self, queued: float) -> float:
+        deadline = settings.LOAD_SHED_MAX_WAIT - queued
+        if deadline <= 0:
+            # 请求在 backlog 中已经等了太久，客户端很可能已经放弃
+            metrics.incr('load_shed_expired')
+            metrics.observe('load_shed_wait_seconds', queued)
+            raise Overloaded('服务繁忙，排队超时')
+        return deadline
+
+    def acquire(self, queued: float = 0.0):
+        """
+        占用一个空位，必要时排队等待，返回结束时交给 release() 的 ticket；不限制时返回 None，
+        无法在期限内得到空位时抛出 Overloaded
+        """
+        deadline = self._deadline(queued)
+        if not settings.LOAD_SHED_MAX_ACTIVE:
+            return None
+        started = time.monotonic()
+        ticket = uuid.uuid4().hex
+        granted = self._enter(ticket)
+        while not granted:
+            remaining = deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                self._leave(ticket)
+                break
+            with self._changed:
+                self._changed.wait(min(settings.LOAD_SHED_POLL_INTERVAL, remaining))
+            granted = self._dispatch(ticket)
+        self._admitted(granted, queued, started)
+        return ticket
+
+    async def aacquire(self, queued: float = 0.0):
+        """
+        acquire 的异步版本，排队时不占用事件循环
+        """
+        deadline = self._deadline(queued)
+        if not settings.LOAD_SHED_MAX_ACTIVE:
+            return None
+        started = time.monotonic()
+        ticket = uuid.uuid4().hex
+        try:
+            granted = await _in_thread(self._enter)(ticket)
+            while not granted:
+                remaining = deadline - (time.monotonic() - started)
+                if remaining <= 0:
+                    await _in_thread(self._leave)(ticket)
+                    break
+                await asyncio.sleep(min(settings.LOAD_SHED_POLL_INTERVAL, remaining))
+                granted = await _in_thread(self._dispatch)(ticket)
+        except asyncio.CancelledError:
+            # 客户端在排队时断开；被取消时线程中的占用可能已经完成，按 ticket 一并让出
+            await _in_thread(self._leave)(ticket)
+            raise
+        self._admitted(granted, queued, started)
+        return ticket
+
+    def release(self, ticket):
+        if ticket is None:
+            return
+        local_store.execute("DELETE FROM shed_active WHERE ticket = ?", (ticket,))
+        with self._changed:
+            self._changed.notify_all()
+
+    async def arelease(self, ticket):
+        if ticket is not None:
+            await _in_thread(self.release)(ticket)
+
+
+load_shedder = LoadShedder()
+
+
+def overloaded_response(error: Overloaded) -> JsonResponse:
+    response = JsonResponse({
+        'status': 'error',
+        'message': str(error)
+    }, status=503)
+    response['Retry-After'] = str(settings.LOAD_SHED_RETRY_AFTER)
+    return response
+
+
+def shed_load(view_func):
+    """
+    对话视图的 talk 命令先排队占用空位，流结束时让出；stop 等其他命令不排队
+    """
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            if request.POST.get('command') != 'talk':
+                return await view_func(request, *args, **kwargs)
+            try:
+                ticket = await load_shedder.aacquire(request_queued_seconds(request))
+            except Overloaded as error:
+                return overloaded_response(error)
+            try:
+                response = await view_func(request, *args, **kwargs)
+            except BaseException:
+                await load_shedder.arelease(ticket)
+                raise
+            # 流结束时的回调已在线程池中执行，其他响应在这里让出空位
+            if isinstance(response, StreamResponse) and not response.handle.closed:
+                return on_response_close(response, partial(load_shedder.release, ticket))
+            await load_shedder.arelease(ticket)
+            return response
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if request.POST.get('command') != 'talk':
+            return view_func(request, *args, **kwargs)
+        try:
+            ticket = load_shedder.acquire(request_queued_seconds(request))
+        except Overloaded as error:
+            return overloaded_response(error)
+        try:
+            response = view_func(request, *args, **kwargs)
+        except BaseException:
+            load_shedder.release(ticket)
+            raise
+        return on_response_close(response, partial(load_shedder.release, ticket))
+    return wrapper
@@ -0,0 +1,204 @@
+"""
+网关本地共享存储
+同一台机器上的多个 gunicorn worker 通过同一个 SQLite 文件共享少量运行时状态（如进行中的流），
+与业务数据库分开，避免高频的小写入和业务数据争用同一把锁
+"""
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+
+SCHEMA = [
+    # 进行中的流：网关分配的 stream_id -> 上游任务
+    """
+    CREATE TABLE IF NOT EXISTS streams (
+        stream_id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        app TEXT NOT NULL DEFAULT '',
+        user TEXT NOT NULL,
+        task_id TEXT,
+        conversation_id TEXT,
+        pid INTEGER NOT NULL,
+        created REAL NOT NULL,
+        cancelled INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS streams_pid_cancelled ON streams (pid, cancelled)",
+    "CREATE INDEX IF NOT EXISTS streams_user_app ON streams (user, kind, app, created)",
+    # 各类进程内缓存的版本号，任一 worker 修改数据后递增，其他 worker 据此丢弃缓存
+    """
+    CREATE TABLE IF NOT EXISTS versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+    """,
+    # 被修改或删除的会话，各 worker 据此只丢弃对应会话的缓存；保留 AUTH_CACHE_TTL 秒后清理
+    """
+    CREATE TABLE IF NOT EXISTS session_tombstones (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_key TEXT NOT NULL,
+        created REAL NOT NULL
+    )
+    """,
+    # 准入控制：按用户/应用/模型的令牌桶，以及进行中对话占用的并发租约
+    """
+    CREATE TABLE IF NOT EXISTS buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS leases (
+        lease_id TEXT NOT NULL,
+        key TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        created REAL NOT NULL,
+        PRIMARY KEY (lease_id, key)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS leases_key ON leases (key)",
+    # 上游并发槽位：占用中的槽位、排队的请求（按加权公平队列的虚拟完成时间排序）、各上游的虚拟时间和各队列流最后的完成时间
+    """
+    CREATE TABLE IF NOT EXISTS upstream_slots (
+        slot_id TEXT PRIMARY KEY,
+        upstream TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        created REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS upstream_slots_upstream ON upstream_slots (upstream)",
+    """
+    CREATE TABLE IF NOT EXISTS upstream_queue (
+        ticket TEXT PRIMARY KEY,
+        upstream TEXT NOT NULL,
+        flow TEXT NOT NULL,
+        cost REAL NOT NULL,
+        finish REAL NOT NULL,
+        enqueued REAL NOT NULL,
+        pid INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS upstream_queue_order ON upstream_queue (upstream, finish, enqueued)",
+    """
+    CREATE TABLE IF NOT EXISTS upstream_flows (
+        upstream TEXT NOT NULL,
+        flow TEXT NOT NULL,
+        finish REAL NOT NULL,
+        PRIMARY KEY (upstream, flow)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS upstream_vtime (
+        upstream TEXT PRIMARY KEY,
+        vtime REAL NOT NULL
+    )
+    """,
+    # 过载保护：所有 worker 处理中的对话占用的空位，以及按先后等待空位的请求
+    """
+    CREATE TABLE IF NOT EXISTS shed_active (
+        ticket TEXT PRIMARY KEY,
+        pid INTEGER NOT NULL,
+        created REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS shed_queue (
+        ticket TEXT PRIMARY KEY,
+        pid INTEGER NOT NULL,
+        enqueued REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS shed_queue_order ON shed_queue (enqueued)",
+    # Dify 应用参数（/parameters）缓存
+    """
+    CREATE TABLE IF NOT EXISTS app_parameters (
+        app TEXT PRIMARY KEY,
+        body TEXT NOT NULL,
+        fetched REAL NOT NULL,
+        refreshing REAL
+    )
+    """,
+]
+
+_local = threading.local()
+
+
+def connection() -> sqlite3.Connection:
+    """
+    获取当前线程的本地存储连接（首次使用时建表）；GATEWAY_STORE_PATH 改变后（如测试中）重新连接
+    """
+    path = str(settings.GATEWAY_STORE_PATH)
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path != path:
+        conn.close()
+        conn = None
+    if conn is None:
+        conn = sqlite3.connect(
+            path,
+            timeout=settings.GATEWAY_STORE_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+
+def execute(sql: str, params=()):
+    return connection().execute(sql, params)
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    本机上的进程是否仍在运行，用于清理异常退出的 worker 遗留的记录
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def get_version(name: str) -> int:
+    row = execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+    return row['version'] if row is not None else 0
+
+
+def bump_version(name: str) -> int:
+    """
+    递增版本号并返回新值
+    """
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+            (name,)
+        )
+        return conn.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()['version']
+
+
+class transaction:
+    """
+    立即获取写锁的事务，保证多个进程间的读-改-写不会交错
+    """
+
+    def __enter__(self):
+        self.conn = connection()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
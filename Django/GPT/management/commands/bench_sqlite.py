@@ -0,0 +1,126 @@
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections
+
+PROFILES = {
+    'default': {'SQLITE_PRODUCTION': 'False', 'SQLITE_WRITE_QUEUE': 'False'},
+    'production': {'SQLITE_PRODUCTION': 'True', 'SQLITE_WRITE_QUEUE': 'True'},
+}
+
+
+class Command(BaseCommand):
+    help = '模拟多个 gunicorn worker 并发登录、登出和读取会话，对比默认 SQLite 配置与生产模式的吞吐和锁冲突'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='进程数，对应 gunicorn --workers')
+        parser.add_argument('--threads', type=int, default=4, help='每个进程的线程数，对应 gunicorn --threads')
+        parser.add_argument('--requests', type=int, default=500, help='每个线程的请求数')
+        parser.add_argument('--write-ratio', type=float, default=0.3, help='写请求（登录/登出）的比例')
+        parser.add_argument('--worker', action='store_true', help='内部使用：作为压测子进程运行')
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            return self.run_worker(options)
+
+        self.stdout.write(
+            f"{options['workers']} 个进程 × {options['threads']} 个线程，每个线程 {options['requests']} 个请求，"
+            f"写请求占 {options['write_ratio']:.0%}"
+        )
+        self.stdout.write(f"{'配置':<12}{'请求/秒':>10}{'锁冲突':>8}{'p50(ms)':>10}{'p99(ms)':>10}")
+        for name, profile in PROFILES.items():
+            with tempfile.TemporaryDirectory() as directory:
+                result = self.run_profile(directory, profile, options)
+            self.stdout.write(
+                f"{name:<12}{result['throughput']:>10.0f}{result['errors']:>8}"
+                f"{result['p50']:>10.1f}{result['p99']:>10.1f}"
+            )
+
+    def run_profile(self, directory: str, profile: dict, options: dict) -> dict:
+        env = dict(
+            os.environ, **profile,
+            SQLITE_PATH=os.path.join(directory, 'bench.sqlite3'),
+            GATEWAY_STORE_PATH=os.path.join(directory, 'gateway.sqlite3')
+        )
+        manage = [sys.executable, sys.argv[0]]
+        subprocess.run(manage + ['migrate', '--verbosity', '0'], env=env, check=True)
+        subprocess.run(manage + ['shell', '-c', (
+            "from GPT.models import Member;"
+            "Member.objects.create_user(username='bench', password='bench', department_name='bench')"
+        )], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        args = manage + [
+            'bench_sqlite', '--worker', '--threads', str(options['threads']),
+            '--requests', str(options['requests']), '--write-ratio', str(options['write_ratio'])
+        ]
+        start = time.perf_counter()
+        workers = [
+            subprocess.Popen(args, env=env, stdout=subprocess.PIPE, text=True)
+            for _ in range(options['workers'])
+        ]
+        results = [json.loads(worker.communicate()[0].strip().splitlines()[-1]) for worker in workers]
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(latency for result in results for latency in result['latencies'])
+        return {
+            'throughput': len(latencies) / elapsed,
+            'errors': sum(result['errors'] for result in results),
+            'p50': statistics.median(latencies) * 1000 if latencies else 0,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0,
+        }
+
+    def run_worker(self, options: dict):
+        from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY
+        from django.contrib.sessions.models import Session
+
+        from GPT.models import Member
+        from GPT.session_store import SessionStore
+
+        user = Member.objects.get(username='bench')
+        lock = threading.Lock()
+        latencies = []
+        errors = 0
+
+        def request():
+            if random.random() < options['write_ratio']:
+                # 登录写入新会话，随后登出删除
+                session = SessionStore()
+                session[SESSION_KEY] = str(user.pk)
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.save()
+                session.delete()
+            else:
+                # 已登录请求：读取会话和用户（不经过进程内缓存，模拟缓存未命中）
+                Session.objects.filter(session_key='missing').first()
+                Member.objects.get(pk=user.pk)
+
+        def run():
+            nonlocal errors
+            for _ in range(options['requests']):
+                start = time.perf_counter()
+                try:
+                    request()
+                except OperationalError:
+                    with lock:
+                        errors += 1
+                    continue
+                finally:
+                    # 与请求结束时相同：超过 CONN_MAX_AGE 的连接被关闭，默认配置下每个请求都重新连接
+                    close_old_connections()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=run) for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.stdout.write(json.dumps({'latencies': latencies, 'errors': errors}))
@@ -0,0 +1,116 @@
+import json
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+
+from GPT.interface.sse import TASK_ID_RE, iter_chunks, relay, scan_field
+
+
+class FakeRaw:
+    """
+    模拟上游连接：每次读取最多返回一个网络分块，行为与真实的流式响应一致
+    """
+
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+        self._current = b''
+
+    def _next(self, amt):
+        if not self._current:
+            if not self._chunks:
+                return b''
+            self._current = self._chunks.pop(0)
+        amt = amt or len(self._current)
+        data, self._current = self._current[:amt], self._current[amt:]
+        return data
+
+    def read(self, amt=None, decode_content=None):
+        return self._next(amt)
+
+    def read1(self, amt=None, decode_content=None):
+        return self._next(amt)
+
+
+def _response(chunks):
+    response = requests.Response()
+    response.raw = FakeRaw(chunks)
+    return response
+
+
+def legacy_relay(response):
+    """
+    优化前的转发方式：iter_lines 默认 512 字节分块、逐行解码、json.loads 后再 json.dumps
+    """
+    task_id = None
+    for line in response.iter_lines():
+        if line:
+            line = line.decode('utf-8')
+            if line.startswith('data: '):
+                data = json.loads(line[6:])
+                if data.get('task_id'):
+                    task_id = data['task_id']
+                yield f"{json.dumps(data)}\n"
+
+
+def passthrough_relay(response):
+    state = {'task_id': None}
+
+    def on_event(event):
+        if state['task_id'] is None:
+            state['task_id'] = scan_field(TASK_ID_RE, event)
+
+    yield from relay(iter_chunks(response), on_event)
+
+
+class Command(BaseCommand):
+    help = '对比 SSE 转发的单事件 CPU 开销：逐行解析重序列化 vs 字节级透传'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=20000, help='事件数量')
+        parser.add_argument('--answer-size', type=int, default=40, help='每个事件 answer 字段的字符数')
+        parser.add_argument('--events-per-chunk', type=int, default=1, help='每个网络分块包含的事件数')
+        parser.add_argument('--rounds', type=int, default=3, help='重复次数，取最好成绩')
+
+    def handle(self, *args, **options):
+        events = []
+        for i in range(options['events']):
+            event = {
+                "event": "message",
+                "conversation_id": "45701982-8118-4bc5-8e9b-64562b4555f2",
+                "message_id": "9da23599-e713-473b-982c-4328d4f5c78a",
+                "created_at": 1705398420,
+                "task_id": "e9a4f3b2-1b59-4a4b-9e6e-6e0d0c3f8b2a",
+                "id": "9da23599-e713-473b-982c-4328d4f5c78a",
+                "answer": ("回答" * options['answer_size'])[:options['answer_size']],
+                "from_variable_selector": None
+            }
+            events.append(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+        if options['events'] % 10 == 0:
+            # 穿插少量 ping 事件
+            events[::10] = [b"event: ping\n\n"] * len(events[::10])
+        per_chunk = options['events_per_chunk']
+        chunks = [b''.join(events[i:i + per_chunk]) for i in range(0, len(events), per_chunk)]
+        total_bytes = sum(len(chunk) for chunk in chunks)
+        self.stdout.write(
+            f"{len(events)} 个事件，{len(chunks)} 个网络分块，共 {total_bytes / 1024:.0f} KB"
+        )
+
+        results = {}
+        for name, relay_func in (('legacy', legacy_relay), ('passthrough', passthrough_relay)):
+            best = None
+            for _ in range(options['rounds']):
+                response = _response(chunks)
+                start = time.process_time()
+                output = sum(len(piece) for piece in relay_func(response))
+                elapsed = time.process_time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = (best, output)
+
+        self.stdout.write(f"{'方式':<14}{'CPU(s)':>10}{'每事件(us)':>14}{'输出(KB)':>12}")
+        for name, (elapsed, output) in results.items():
+            self.stdout.write(
+                f"{name:<14}{elapsed:>10.3f}{elapsed / len(events) * 1e6:>14.2f}{output / 1024:>12.0f}"
+            )
+        speedup = results['legacy'][0] / max(results['passthrough'][0], 1e-9)
+        self.stdout.write(f"透传方式单事件 CPU 开销降低为原来的 1/{speedup:.1f}")
@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import io
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+from GPT.interface.dify_agent import DifyAgent
+
+
+class FakeDifyHandler(BaseHTTPRequestHandler):
+    """
+    模拟 Dify 的 /chat-messages 接口，按固定间隔输出 SSE 事件
+    """
+    protocol_version = 'HTTP/1.1'
+    events = 50
+    interval = 0.02
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(self.events):
+            event = {
+                "event": "message",
+                "task_id": "bench-task",
+                "conversation_id": "bench-conversation",
+                "answer": f"token-{i} "
+            }
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            time.sleep(self.interval)
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = '对比同步（WSGI worker）与异步（ASGI）两种方式转发 Dify 流式响应的并发能力'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=200, help='并发流数量')
+        parser.add_argument('--events', type=int, default=50, help='每个流的事件数')
+        parser.add_argument('--interval', type=float, default=0.02, help='上游事件间隔（秒）')
+        parser.add_argument('--workers', type=int, default=4, help='同步模式下的 worker 数，对应 gunicorn --workers')
+
+    def handle(self, *args, **options):
+        FakeDifyHandler.events = options['events']
+        FakeDifyHandler.interval = options['interval']
+        ThreadingHTTPServer.request_queue_size = 1024
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDifyHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        streams = options['streams']
+        ideal = options['events'] * options['interval']
+        self.stdout.write(f"上游: {url}，{streams} 个流，每个流 {options['events']} 个事件，理想耗时 {ideal:.2f}s/流")
+        try:
+            # 适配器内部的调试输出会刷屏，压测期间丢弃
+            with contextlib.redirect_stdout(io.StringIO()):
+                sync_result = self.run_sync(url, streams, options['workers'])
+                async_result = self.run_async(url, streams)
+        finally:
+            server.shutdown()
+
+        self.stdout.write(f"{'模式':<8}{'并发':>8}{'总耗时(s)':>12}{'流/秒':>10}{'首包p50(ms)':>14}{'首包p99(ms)':>14}")
+        for name, concurrency, result in (
+            ('sync', options['workers'], sync_result),
+            ('async', streams, async_result),
+        ):
+            wall, first_bytes = result
+            first_bytes.sort()
+            p50 = statistics.median(first_bytes) * 1000
+            p99 = first_bytes[min(len(first_bytes) - 1, int(len(first_bytes) * 0.99))] * 1000
+            self.stdout.write(
+                f"{name:<8}{concurrency:>8}{wall:>12.2f}{streams / wall:>10.1f}{p50:>14.1f}{p99:>14.1f}"
+            )
+
+    def run_sync(self, url, streams, workers):
+        """
+        同步模式：每个 worker 在整个流结束前只能服务一个请求
+        """
+        def consume(submitted):
+            agent = DifyAgent(url=url, api_key='bench', data={"query": "hi"}, user='bench')
+            response = agent.talk()
+            first_byte = None
+            for _ in response.streaming_content:
+                if first_byte is None:
+                    first_byte = time.perf_counter() - submitted
+            return first_byte
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(consume, time.perf_counter()) for _ in range(streams)]
+            first_bytes = [future.result() for future in futures]
+        return time.perf_counter() - start, first_bytes
+
+    def run_async(self, url, streams):
+        """
+        异步模式：单个事件循环同时转发全部流
+        """
+        async def consume():
+            submitted = time.perf_counter()
+            agent = DifyAgent(url=url, api_key='bench', data={"query": "hi"}, user='bench')
+            response = await agent.atalk()
+            first_byte = None
+            async for _ in response.streaming_content:
+                if first_byte is None:
+                    first_byte = time.perf_counter() - submitted
+            return first_byte
+
+        async def main():
+            start = time.perf_counter()
+            first_bytes = await asyncio.gather(*(consume() for _ in range(streams)))
+            return time.perf_counter() - start, list(first_bytes)
+
+        return asyncio.run(main())
@@ -0,0 +1,62 @@
+"""
+网关运行指标（当前进程）
+计数器、当前值和耗时等分布只在内存中累加，通过 super.get_metrics 接口查看
+"""
+import os
+import threading
+import time
+
+
+class Metrics:
+    """
+    线程安全的计数器集合
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        """
+        记录当前值，例如排队人数
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """
+        记录一次观测值，例如排队等待的秒数，快照中给出次数、总和与最大值
+        """
+        with self._lock:
+            summary = self._summaries.get(name)
+            if summary is None:
+                summary = self._summaries[name] = {'count': 0, 'sum': 0, 'max': value}
+            summary['count'] += 1
+            summary['sum'] += value
+            summary['max'] = max(summary['max'], value)
+
+    def get(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            summaries = {name: dict(summary) for name, summary in self._summaries.items()}
+        return {
+            'pid': os.getpid(),
+            'uptime_seconds': round(time.time() - self._started, 1),
+            'counters': counters,
+            'gauges': gauges,
+            'summaries': summaries
+        }
+
+
+metrics = Metrics()
@@ -0,0 +1,79 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_memberships(apps, schema_editor):
+    """
+    把 Member.application 与 Application.member 两张关联表的并集写入 Membership
+    """
+    Member = apps.get_model('GPT', 'Member')
+    Application = apps.get_model('GPT', 'Application')
+    Membership = apps.get_model('GPT', 'Membership')
+    db_alias = schema_editor.connection.alias
+    pairs = set(
+        Member.application.through.objects.using(db_alias).values_list('member_id', 'application_id')
+    )
+    pairs.update(
+        Application.member.through.objects.using(db_alias).values_list('member_id', 'application_id')
+    )
+    Membership.objects.using(db_alias).bulk_create(
+        [Membership(member_id=member_id, application_id=application_id) for member_id, application_id in pairs],
+        batch_size=1000
+    )
+
+
+def split_memberships(apps, schema_editor):
+    """
+    回滚时把 Membership 写回原来的两张关联表
+    """
+    Member = apps.get_model('GPT', 'Member')
+    Application = apps.get_model('GPT', 'Application')
+    Membership = apps.get_model('GPT', 'Membership')
+    db_alias = schema_editor.connection.alias
+    pairs = list(Membership.objects.using(db_alias).values_list('member_id', 'application_id'))
+    Member.application.through.objects.using(db_alias).bulk_create(
+        [Member.application.through(member_id=m, application_id=a) for m, a in pairs], batch_size=1000
+    )
+    Application.member.through.objects.using(db_alias).bulk_create(
+        [Application.member.through(member_id=m, application_id=a) for m, a in pairs], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GPT', '0019_member_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Membership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granted_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='GPT.application')),
+                ('granted_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='granted_memberships', to=settings.AUTH_USER_MODEL)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['application', 'member'], name='membership_application_idx')],
+                'constraints': [models.UniqueConstraint(fields=('member', 'application'), name='membership_unique')],
+            },
+        ),
+        migrations.RunPython(merge_memberships, split_memberships),
+        migrations.RemoveField(
+            model_name='application',
+            name='member',
+        ),
+        migrations.RemoveField(
+            model_name='member',
+            name='application',
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='application',
+            field=models.ManyToManyField(related_name='member', through='GPT.Membership', through_fields=('member', 'application'), to='GPT.application'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:45
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GPT', '0020_membership'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApplicationGrant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('department_name', models.CharField(blank=True, default='', max_length=200)),
+                ('granted_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='grants', to='GPT.application')),
+                ('granted_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='granted_application_grants', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='application_grants', to='auth.group')),
+            ],
+            options={
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('group__isnull', True), models.Q(('department_name', ''), _negated=True)), models.Q(('group__isnull', False), ('department_name', '')), _connector='OR'), name='application_grant_one_target'), models.UniqueConstraint(condition=models.Q(('group__isnull', True)), fields=('department_name', 'application'), name='application_grant_department_unique'), models.UniqueConstraint(condition=models.Q(('group__isnull', False)), fields=('group', 'application'), name='application_grant_group_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:01
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GPT', '0021_application_grant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('username', models.CharField(max_length=150)),
+                ('kind', models.CharField(max_length=50)),
+                ('app', models.CharField(blank=True, default='', max_length=200)),
+                ('model', models.CharField(blank=True, default='', max_length=200)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('total_tokens', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created'], name='usage_event_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageHourly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('username', models.CharField(max_length=150)),
+                ('app', models.CharField(blank=True, default='', max_length=200)),
+                ('model', models.CharField(blank=True, default='', max_length=200)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('completion_tokens', models.PositiveBigIntegerField(default=0)),
+                ('total_tokens', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['username', 'hour'], name='usage_hourly_user_idx'), models.Index(fields=['app', 'hour'], name='usage_hourly_app_idx'), models.Index(fields=['model', 'hour'], name='usage_hourly_model_idx')],
+                'constraints': [models.UniqueConstraint(fields=('hour', 'username', 'app', 'model'), name='usage_hourly_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GPT', '0023_conversations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model_info',
+            name='context_window',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
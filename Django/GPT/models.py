@@ -1,9 +1,27 @@
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 class Member(AbstractUser):
     department_name = models.CharField(max_length=200)
-    application = models.ManyToManyField('Application', related_name='app')
+    application = models.ManyToManyField(
+        'Application',
+        through='Membership',
+        through_fields=('member', 'application'),
+        related_name='member'
+    )
+
+    class Meta(AbstractUser.Meta):
+        # 支撑用户列表的筛选、前缀搜索与游标分页（username 已有唯一索引）
+        indexes = [
+            models.Index(fields=['department_name', 'username'], name='member_department_idx'),
+            models.Index(fields=['is_active', 'username'], name='member_active_idx'),
+            models.Index(fields=['is_superuser', 'username'], name='member_superuser_idx'),
+            models.Index(fields=['email'], name='member_email_idx'),
+            models.Index(fields=['date_joined', 'id'], name='member_date_joined_idx'),
+        ]
+
     def __str__(self):
         return self.last_name+self.first_name
 
@@ -12,11 +30,65 @@ class Application(models.Model):
     api_url = models.CharField(max_length=500)
     api_key = models.CharField(max_length=100)
     type = models.CharField(max_length=100,default='')
-    member = models.ManyToManyField('Member', related_name='member')
     icon = models.CharField(max_length=100,default='Waypoints')
     def __str__(self):
         return self.name
 
+class Membership(models.Model):
+    """
+    用户-应用授权关系，Member.application 与 Application.member 两端共用这一张表
+    """
+    member = models.ForeignKey('Member', on_delete=models.CASCADE, related_name='memberships')
+    application = models.ForeignKey('Application', on_delete=models.CASCADE, related_name='memberships')
+    granted_at = models.DateTimeField(default=timezone.now)
+    granted_by = models.ForeignKey(
+        'Member', on_delete=models.SET_NULL, null=True, blank=True, related_name='granted_memberships'
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['member', 'application'], name='membership_unique'),
+        ]
+        indexes = [
+            # 按应用查成员（get_application_users、成员数统计）
+            models.Index(fields=['application', 'member'], name='membership_application_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.member_id}:{self.application_id}'
+
+class ApplicationGrant(models.Model):
+    """
+    按部门或用户组授予应用权限，一条记录覆盖整个部门/组，不随人数增长
+    department_name 与 group 二选一
+    """
+    department_name = models.CharField(max_length=200, blank=True, default='')
+    group = models.ForeignKey('auth.Group', on_delete=models.CASCADE, null=True, blank=True, related_name='application_grants')
+    application = models.ForeignKey('Application', on_delete=models.CASCADE, related_name='grants')
+    granted_at = models.DateTimeField(default=timezone.now)
+    granted_by = models.ForeignKey(
+        'Member', on_delete=models.SET_NULL, null=True, blank=True, related_name='granted_application_grants'
+    )
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=(Q(group__isnull=True) & ~Q(department_name='')) | (Q(group__isnull=False) & Q(department_name='')),
+                name='application_grant_one_target'
+            ),
+            models.UniqueConstraint(
+                fields=['department_name', 'application'], condition=Q(group__isnull=True),
+                name='application_grant_department_unique'
+            ),
+            models.UniqueConstraint(
+                fields=['group', 'application'], condition=Q(group__isnull=False),
+                name='application_grant_group_unique'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.department_name or self.group_id}:{self.application_id}'
+
 class Model_info(models.Model):
     show_name = models.CharField(max_length=200,unique=True)
     model_url = models.CharField(max_length=500)
@@ -25,5 +97,78 @@ class Model_info(models.Model):
     model_name = models.CharField(max_length=100,default='')
     model_provider = models.CharField(max_length=100,default='')
     model_providerId = models.CharField(max_length=100,default='')
+    # 模型的上下文窗口（token 数），0 表示不限制，不裁剪对话历史
+    context_window = models.PositiveIntegerField(default=0)
     def __str__(self):
-        return self.show_name
\ No newline at end of file
+        return self.show_name
+class UsageEvent(models.Model):
+    """
+    单次对话的 token 用量（上游在流结束时报告的 usage）
+    由 usage 模块在后台批量写入，查询统计请使用 UsageHourly
+    """
+    created = models.DateTimeField(default=timezone.now)
+    username = models.CharField(max_length=150)
+    kind = models.CharField(max_length=50)
+    app = models.CharField(max_length=200, blank=True, default='')
+    model = models.CharField(max_length=200, blank=True, default='')
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    total_tokens = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created'], name='usage_event_created_idx'),
+        ]
+
+class UsageHourly(models.Model):
+    """
+    按 小时 + 用户 + 应用 + 模型 汇总的用量，写入原始记录时同步累加
+    """
+    hour = models.DateTimeField()
+    username = models.CharField(max_length=150)
+    app = models.CharField(max_length=200, blank=True, default='')
+    model = models.CharField(max_length=200, blank=True, default='')
+    requests = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    total_tokens = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'username', 'app', 'model'], name='usage_hourly_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['username', 'hour'], name='usage_hourly_user_idx'),
+            models.Index(fields=['app', 'hour'], name='usage_hourly_app_idx'),
+            models.Index(fields=['model', 'hour'], name='usage_hourly_model_idx'),
+        ]
+
+class Conversation(models.Model):
+    """
+    服务端保存的模型对话，modelTalk 只需提交 conversation_id 和新消息
+    """
+    id = models.CharField(max_length=32, primary_key=True)
+    member = models.ForeignKey('Member', on_delete=models.CASCADE, related_name='conversations')
+    model = models.CharField(max_length=200)
+    created = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['member', '-updated'], name='conversation_member_idx'),
+        ]
+
+class ConversationTurn(models.Model):
+    """
+    对话中的一条消息，content 为 zlib 压缩后的 UTF-8 文本
+    """
+    conversation = models.ForeignKey('Conversation', on_delete=models.CASCADE, related_name='turns')
+    seq = models.PositiveIntegerField()
+    role = models.CharField(max_length=20)
+    content = models.BinaryField()
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='conversation_turn_unique'),
+        ]
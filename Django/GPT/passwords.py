@@ -0,0 +1,35 @@
+"""
+批量密码哈希
+PBKDF2 有意设计得很慢，批量导入几千个用户时逐个哈希要花上几十分钟。
+超过 PASSWORD_HASH_INLINE_LIMIT 个密码时交给进程池并行计算，充分利用多核
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+
+
+def _init_worker(settings_module: str):
+    # spawn 启动的子进程需要重新加载 Django 配置
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def hash_passwords(passwords: list) -> list:
+    """
+    返回与 passwords 一一对应的哈希值
+    """
+    workers = min(settings.PASSWORD_HASH_WORKERS or os.cpu_count() or 1, len(passwords))
+    if workers <= 1 or len(passwords) <= settings.PASSWORD_HASH_INLINE_LIMIT:
+        return [make_password(password) for password in passwords]
+    # 不使用 fork：当前进程中有后台线程（流登记表轮询等），fork 后的子进程可能卡在线程持有的锁上
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'backend.settings'),)
+    ) as pool:
+        return list(pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
@@ -0,0 +1,57 @@
+"""
+带进程内 L1 缓存的数据库会话引擎，SESSION_ENGINE = 'GPT.session_store'
+读会话先查本 worker 的缓存，未命中再查 django_session；修改或删除已有会话时让所有 worker 丢弃该会话的缓存。
+写入经过单写者队列（SQLITE_WRITE_QUEUE）
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+
+from .auth_cache import auth_cache
+from .db_router import primary
+from .write_queue import write_queue
+
+
+class SessionStore(DBStore):
+    def _cache(self, session):
+        if session is None:
+            return {}
+        auth_cache.put_session(session.session_key, session.session_data, session.expire_date)
+        return self.decode(session.session_data)
+
+    def load(self):
+        if self.session_key is not None:
+            session_data = auth_cache.get_session(self.session_key)
+            if session_data is not None:
+                return self.decode(session_data)
+        # 刚登录的会话可能还没有同步到只读副本
+        with primary():
+            return self._cache(self._get_session_from_db())
+
+    async def aload(self):
+        if self.session_key is not None:
+            session_data = await auth_cache.aget_session(self.session_key)
+            if session_data is not None:
+                return self.decode(session_data)
+        with primary():
+            return self._cache(await self._aget_session_from_db())
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            # create() 生成会话键后会再次调用 save(must_create=True)
+            return self.create()
+        write_queue.run(super().save, must_create)
+        # 新建的会话不可能已在其他 worker 的缓存中
+        if not must_create:
+            auth_cache.invalidate_session(self.session_key)
+
+    async def asave(self, must_create=False):
+        await sync_to_async(self.save)(must_create)
+
+    def delete(self, session_key=None):
+        if session_key is None and self.session_key is None:
+            return
+        write_queue.run(super().delete, session_key)
+        auth_cache.invalidate_session(session_key or self.session_key)
+
+    async def adelete(self, session_key=None):
+        await sync_to_async(self.delete)(session_key)
@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .auth_cache import auth_cache
+from .config_registry import config_registry
+from .entitlements import entitlements
+from .interface import dify_parameters
+from .models import Application, ApplicationGrant, Member, Membership, Model_info
+from .write_queue import write_queue
+
+
+@receiver(post_save, sender=Application)
+@receiver(post_delete, sender=Application)
+@receiver(post_save, sender=Model_info)
+@receiver(post_delete, sender=Model_info)
+def invalidate_config(sender, **kwargs):
+    """
+    应用或模型配置变化后，让所有 worker 的配置缓存失效
+    """
+    config_registry.invalidate()
+    if transaction.get_connection().in_atomic_block:
+        # 事务提交前其他 worker 可能重新加载到旧数据，提交后再失效一次
+        transaction.on_commit(config_registry.invalidate)
+
+
+@receiver(post_save, sender=Application)
+@receiver(post_delete, sender=Application)
+def invalidate_parameters(sender, instance, **kwargs):
+    """
+    应用地址或密钥可能已变化，丢弃该应用的参数缓存
+    """
+    dify_parameters.invalidate(instance.name)
+
+
+@receiver(m2m_changed, sender=Membership)
+@receiver(m2m_changed, sender=Member.groups.through)
+@receiver(post_delete, sender=Application)
+@receiver(post_save, sender=ApplicationGrant)
+@receiver(post_delete, sender=ApplicationGrant)
+def invalidate_entitlements(sender, **kwargs):
+    """
+    用户的应用授权、部门/组授权或用户所在组变化，以及应用被删除后，让所有 worker 的权限缓存失效
+    """
+    action = kwargs.get('action')
+    if action is not None and not action.startswith('post_'):
+        # m2m_changed 的 pre_add 等事件发生在修改之前
+        return
+    entitlements.invalidate()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(entitlements.invalidate)
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def invalidate_auth(sender, **kwargs):
+    """
+    用户密码、状态或权限变化后，让所有 worker 缓存的登录用户失效
+    """
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        # 每次登录都会更新 last_login，不影响已缓存的用户
+        return
+    auth_cache.invalidate()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(auth_cache.invalidate)
+
+
+def update_last_login(sender, user, **kwargs):
+    """
+    代替 django.contrib.auth 的同名处理函数：last_login 交给写队列异步更新，登录请求不必等待写锁
+    """
+    user.last_login = timezone.now()
+    write_queue.defer(Member.objects.filter(pk=user.pk).update, last_login=user.last_login)
+
+
+# 使用与 django.contrib.auth 相同的 dispatch_uid，无论哪个应用先加载，都只保留这里的处理函数
+user_logged_in.disconnect(dispatch_uid='update_last_login')
+user_logged_in.connect(update_last_login, dispatch_uid='update_last_login')
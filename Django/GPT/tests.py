@@ -1,3 +1,1609 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.http import JsonResponse
+from django.test import AsyncRequestFactory, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import local_store
+from .admission import Rejected, aadmit, admit
+from .auth_cache import AuthCache, auth_cache
+from .config_registry import ConfigRegistry, config_registry
+from .context_budget import ContextTooLarge, context_budget, fit_messages, token_counter
+from .conversations import conversation_store
+from .db_router import ReadReplicaRouter, primary, read_replica
+from .entitlements import EntitlementCache, entitlements
+from .interface import dify_parameters, openai_clients
+from .interface.dify_agent import DifyAgent
+from .interface.dify_workflow import DifyWorkflow
+from .interface.http_pool import SessionRegistry, get_async_client as get_pooled_async_client
+from .interface.model_chat import ModelChat
+from .interface.openai_clients import ClientCache
+from .interface.port_app import StreamResponse
+from .interface.sse import SSEParser
+from .interface.stream_registry import guard_stream, stream_registry
+from .interface.upstream_scheduler import UpstreamBusy, UpstreamScheduler
+from .load_shed import LoadShedder, Overloaded
+from .metrics import metrics
+from .models import Application, ConversationTurn, Member, Membership, Model_info, UsageEvent, UsageHourly
+from .usage import usage_meter
+from .view.application import appTalkAsync
+from .view.model import modelTalkAsync
+from .write_queue import WriteQueue
+
+
+def _isolate_gateway_store(test):
+    """
+    用例改用临时的本地共享存储，不读写 GATEWAY_STORE_PATH 指向的真实文件，结束后删除
+    """
+    directory = tempfile.TemporaryDirectory()
+    override = override_settings(GATEWAY_STORE_PATH=os.path.join(directory.name, 'gateway.sqlite3'))
+    override.enable()
+    _reset_caches()
+    test.addCleanup(directory.cleanup)
+    # 各缓存按存储中的版本号判断是否失效，换存储前后都要清空
+    test.addCleanup(_reset_caches)
+    test.addCleanup(override.disable)
+
+
+def _reset_caches():
+    for cache in (auth_cache, config_registry, entitlements):
+        cache.invalidate()
+
+
+# 测试中不需要安全的密码哈希，避免大量建用户拖慢测试
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AdminQueryBudgetTests(TestCase):
+    """
+    管理接口的查询次数不应随用户数、应用数增长
+    每个用例分别在少量数据和大量数据下调用同一接口，两次的查询次数必须相同且不超过预算
+    """
+
+    def setUp(self):
+        self.admin = Member.objects.create_superuser(
+            username='admin', password='admin', department_name='IT'
+        )
+        self.client.force_login(self.admin)
+
+    def _populate(self, users: int, apps: int):
+        start = Application.objects.count()
+        applications = [
+            Application.objects.create(
+                name=f'app-{start + i}', api_url='http://dify.local/v1', api_key='key', type='dify_agent'
+            )
+            for i in range(apps)
+        ]
+        start = Member.objects.filter(username__startswith='user-').count()
+        for i in range(users):
+            member = Member.objects.create_user(
+                username=f'user-{start + i}', password='password', department_name='研发部'
+            )
+            member.application.add(*applications)
+        return applications
+
+    def _count(self, request) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(context.captured_queries)
+
+    def assertQueryBudget(self, budget: int, request):
+        """
+        分别在少量数据和 20 倍数据量下调用 request(applications)，
+        applications 为本轮新建的应用名列表
+        """
+        applications = self._populate(users=2, apps=2)
+        small = self._count(lambda: request([app.name for app in applications]))
+        applications = self._populate(users=40, apps=40)
+        large = self._count(lambda: request([app.name for app in applications]))
+        self.assertEqual(small, large, '查询次数随数据量增长')
+        self.assertLessEqual(large, budget)
+
+    def _post(self, path: str, data: dict, method: str = 'post'):
+        return getattr(self.client, method)(path, json.dumps(data), content_type='application/json')
+
+    def test_get_all_apps(self):
+        self.assertQueryBudget(3, lambda apps: self.client.get('/GPT/getAllApps'))
+
+    def test_get_all_users(self):
+        self.assertQueryBudget(3, lambda apps: self.client.get('/GPT/get_all_users'))
+
+    def test_get_user_applications(self):
+        self.assertQueryBudget(4, lambda apps: self._post('/GPT/get_user_applications', {'username': 'user-0'}))
+
+    def test_get_application_users(self):
+        self.assertQueryBudget(4, lambda apps: self._post('/GPT/get_application_users', {'application_name': apps[0]}))
+
+    def test_manage_user_applications(self):
+        self.assertQueryBudget(12, lambda apps: self._post('/GPT/manage_user_applications', {
+            'username': 'admin', 'action': 'add', 'applications': apps
+        }))
+
+    def test_create_user(self):
+        def request(apps):
+            return self._post('/GPT/create_user', {
+                'username': f'new-{len(apps)}', 'password': 'password', 'department_name': '研发部',
+                'applications': apps
+            })
+        self.assertQueryBudget(9, request)
+
+    def test_update_user(self):
+        counts = []
+        for apps in (2, 40):
+            # 每轮都更新一个还没有任何应用的用户，保证两轮的写入操作相同
+            names = [app.name for app in self._populate(users=0, apps=apps)]
+            Member.objects.create_user(username=f'target-{apps}', password='password', department_name='研发部')
+            counts.append(self._count(lambda: self._post('/GPT/update_user', {
+                'username': f'target-{apps}', 'department_name': '市场部', 'applications': names
+            }, method='put')))
+        self.assertEqual(counts[0], counts[1], '查询次数随数据量增长')
+        self.assertLessEqual(counts[1], 9)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UserDirectoryTests(TestCase):
+    def setUp(self):
+        admin = Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        for i in range(25):
+            Member.objects.create_user(
+                username=f'user-{i:02d}', email=f'u{i:02d}@example.com', password='password',
+                department_name='研发部' if i % 2 else '市场部', is_active=i % 5 != 0
+            )
+        self.client.force_login(admin)
+
+    def _pages(self, **params):
+        usernames = []
+        cursor = None
+        while True:
+            query = dict(params, limit=7)
+            if cursor:
+                query['after'] = cursor
+            data = self.client.get('/GPT/get_all_users', query).json()
+            self.assertEqual(data['status'], 'success', data)
+            usernames += [user['username'] for user in data['users']]
+            cursor = data['next_cursor']
+            if not cursor:
+                return usernames
+
+    def test_cursor_pagination_visits_every_user_once(self):
+        expected = sorted(Member.objects.values_list('username', flat=True))
+        self.assertEqual(self._pages(), expected)
+        self.assertEqual(self._pages(ordering='-username'), expected[::-1])
+        self.assertEqual(sorted(self._pages(ordering='-date_joined')), expected)
+
+    def test_filters(self):
+        self.assertEqual(len(self._pages(department='研发部')), 12)
+        self.assertEqual(len(self._pages(is_active='false')), 5)
+        self.assertEqual(self._pages(is_superuser='true'), ['admin'])
+        self.assertEqual(self._pages(q='user-1'), [f'user-{i}' for i in range(10, 20)])
+        self.assertEqual(self._pages(q='u03@'), ['user-03'])
+
+
+class _FakeStream(list):
+    def close(self):
+        pass
+
+
+class _FakeCompletions:
+    """
+    记录收到的 messages，每次回复 "reply N"
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def create(self, messages, **kwargs):
+        self.calls.append(messages)
+        delta = SimpleNamespace(content=f'reply {len(self.calls)}')
+        return _FakeStream([SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])])
+
+
+class _FakeAsyncStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        pass
+
+
+class _FakeAsyncCompletions:
+    async def create(self, messages, **kwargs):
+        delta = SimpleNamespace(content='reply')
+        return _FakeAsyncStream([SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AsyncStreamingTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        self.user = Member.objects.create_user(username='judy', password='judy', department_name='IT')
+        application = Application.objects.create(
+            name='flow', api_url='http://dify.local/v1', api_key='key', type='dify_workflow'
+        )
+        Membership.objects.create(member=self.user, application=application)
+        Model_info.objects.create(show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+
+    def _request(self, path: str, data: dict):
+        request = AsyncRequestFactory().post(path, data)
+
+        async def auser():
+            return self.user
+        request.auser = auser
+        return request
+
+    async def test_app_talk_async_relays_events(self):
+        events = [
+            b'{"event": "workflow_started", "task_id": "t1"}',
+            b'{"event": "workflow_finished", "task_id": "t1", "data": {"total_tokens": 3}}',
+        ]
+        requests_seen = []
+
+        def upstream(request):
+            requests_seen.append(json.loads(request.content))
+            return httpx.Response(200, content=b''.join(b'data: ' + event + b'\n\n' for event in events))
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+        with mock.patch('GPT.interface.dify_workflow.get_async_client', return_value=client):
+            response = await appTalkAsync(self._request('/GPT/appTalk', {
+                'application_name': 'flow', 'command': 'talk', 'data': json.dumps({'inputs': {'q': 'hi'}})
+            }))
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(body.splitlines(), events)
+        self.assertEqual(requests_seen, [{'inputs': {'q': 'hi'}, 'response_mode': 'streaming', 'user': 'judy'}])
+        self.assertIsNone(stream_registry.lookup(response['X-Stream-Id']))
+        self.assertTrue(response.handle.closed)
+        # workflow_finished 中的用量被记录
+        self.assertEqual(await sync_to_async(usage_meter.flush)(), 1)
+        event = await UsageEvent.objects.aget(username='judy')
+        self.assertEqual((event.app, event.total_tokens), ('flow', 3))
+
+        response = await appTalkAsync(self._request('/GPT/appTalk', {
+            'application_name': 'missing', 'command': 'talk', 'data': '{}'
+        }))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_model_talk_async_streams_reply(self):
+        client = SimpleNamespace(chat=SimpleNamespace(completions=_FakeAsyncCompletions()))
+        with mock.patch('GPT.interface.model_chat.get_async_client', return_value=client):
+            response = await modelTalkAsync(self._request('/GPT/modelTalk', {
+                'name': 'gpt', 'command': 'talk', 'data': json.dumps({'messages': [{'role': 'user', 'content': 'hi'}]})
+            }))
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        chunk = json.loads(body.decode().removeprefix('data: '))
+        self.assertEqual(chunk['choices'][0]['delta']['content'], 'reply')
+        self.assertIsNone(stream_registry.lookup(response['X-Stream-Id']))
+        self.assertTrue(response.handle.closed)
+
+        response = await modelTalkAsync(self._request('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'pause', 'data': '{}'
+        }))
+        self.assertEqual(response.status_code, 400)
+
+
+class HttpPoolTests(TestCase):
+    def test_sessions_are_shared_per_application_and_origin(self):
+        registry = SessionRegistry()
+        session = registry.get_session('http://dify.local/v1', 'wiki')
+        self.assertIs(registry.get_session('http://dify.local/v1/chat-messages', 'wiki'), session)
+        self.assertIsNot(registry.get_session('http://dify.local/v1', 'report'), session)
+        self.assertIsNot(registry.get_session('https://dify.local/v1', 'wiki'), session)
+        stats = registry.stats()
+        self.assertEqual((stats['hits'], stats['misses'], len(stats['pools'])), (1, 3, 3))
+
+        # 空闲过久的连接池被重建
+        with override_settings(HTTP_POOL_KEEPALIVE=-1):
+            self.assertIsNot(registry.get_session('http://dify.local/v1', 'wiki'), session)
+        pool = next(pool for pool in registry.stats()['pools'] if pool['application'] == 'wiki' and pool['origin'] == 'http://dify.local')
+        self.assertEqual((pool['hits'], pool['misses']), (1, 2))
+
+    def test_async_clients_are_shared_within_an_event_loop(self):
+        async def clients():
+            first = get_pooled_async_client('http://dify.local/v1', 'wiki')
+            self.assertIs(get_pooled_async_client('http://dify.local/v1/workflows/run', 'wiki'), first)
+            self.assertIsNot(get_pooled_async_client('http://dify.local/v1', 'report'), first)
+            await first.aclose()
+            # 已关闭的客户端不再复用
+            self.assertIsNot(get_pooled_async_client('http://dify.local/v1', 'wiki'), first)
+
+        async_to_sync(clients)()
+
+
+class OpenAIClientCacheTests(TestCase):
+    def test_clients_are_reused_and_evicted_least_recently_used(self):
+        cache = ClientCache(SimpleNamespace, 2)
+        first = cache.get('http://a.local/v1', 'key')
+        self.assertIs(cache.get('http://a.local/v1', 'key'), first)
+        self.assertEqual((first.base_url, first.api_key), ('http://a.local/v1', 'key'))
+        self.assertIsNot(cache.get('http://a.local/v1', 'other-key'), first)
+        # a 刚被使用过，超出容量时淘汰的是 other-key
+        cache.get('http://a.local/v1', 'key')
+        cache.get('http://b.local/v1', 'key')
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('http://a.local/v1', 'key'), first)
+        cache.invalidate('http://a.local/v1', 'key')
+        self.assertIsNot(cache.get('http://a.local/v1', 'key'), first)
+
+    def test_model_chats_share_client_until_invalidated(self):
+        chat = ModelChat('gpt', 'http://reuse.local/v1', 'key', {}, 'alice')
+        self.assertIs(ModelChat('gpt', 'http://reuse.local/v1', 'key', {}, 'bob').client, chat.client)
+        openai_clients.invalidate('http://reuse.local/v1', 'key')
+        self.assertIsNot(ModelChat('gpt', 'http://reuse.local/v1', 'key', {}, 'alice').client, chat.client)
+
+
+class SSEParserTests(TestCase):
+    def _parse(self, *chunks) -> list:
+        parser = SSEParser()
+        events = []
+        for chunk in chunks:
+            events.extend(parser.feed(chunk))
+        return events + parser.flush()
+
+    def test_fields_and_comments(self):
+        stream = b': keep-alive\n\nevent: message\ndata: {"a": 1}\nid: 7\n\ndata:first\ndata: second\n\nevent: ping\n\n'
+        # 注释和没有 data 的事件被跳过，多行 data 以 \n 连接，冒号后的一个空格可以省略
+        self.assertEqual(self._parse(stream), [b'{"a": 1}', b'first\nsecond'])
+
+    def test_events_split_across_chunks(self):
+        stream = b'data: {"x": "one"}\n\ndata: {"x": "two"}\n\n'
+        expected = [b'{"x": "one"}', b'{"x": "two"}']
+        for size in range(1, len(stream)):
+            chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+            self.assertEqual(self._parse(*chunks), expected, size)
+
+    def test_line_endings(self):
+        expected = [b'one', b'two']
+        self.assertEqual(self._parse(b'data: one\r\n\r\ndata: two\r\n\r\n'), expected)
+        self.assertEqual(self._parse(b'data: one\r\rdata: two\r\r'), expected)
+        # \r\n 被拆在两个分块中时不算作两次换行，不会提前结束事件
+        self.assertEqual(self._parse(b'data: one\r', b'\ndata: more\r\n\r', b'\ndata: two\r\n\r\n'), [b'one\nmore', b'two'])
+
+    def test_flush_returns_unterminated_event(self):
+        parser = SSEParser()
+        self.assertEqual(parser.feed(b'data: one\n\ndata: last'), [b'one'])
+        self.assertEqual(parser.flush(), [b'last'])
+        self.assertEqual(parser.flush(), [])
+        self.assertEqual(self._parse(b'data: last\r'), [b'last'])
+        self.assertEqual(self._parse(b': only a comment\n'), [])
+
+
+class StreamRegistryTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+
+    def test_cancel_from_another_worker_aborts_the_stream(self):
+        agent = DifyWorkflow('http://dify.local/v1', 'key', {}, 'alice', app='flow')
+        handle = agent._register_stream()
+        aborted = threading.Event()
+        handle.on_abort(aborted.set)
+        handle.bind(task_id='task-1')
+        entry = stream_registry.lookup(handle.stream_id)
+        self.assertEqual((entry['kind'], entry['app'], entry['task_id']), ('dify_workflow', 'flow', 'task-1'))
+
+        # 只有发起对话的用户可以停止
+        self.assertIsNone(stream_registry.cancel(handle.stream_id, 'mallory'))
+        # 其他 worker 处理停止命令时只修改登记表，转发该流的 worker 轮询发现后中断上游
+        local_store.execute("UPDATE streams SET cancelled = 1 WHERE stream_id = ?", (handle.stream_id,))
+        self.assertTrue(aborted.wait(2))
+        self.assertTrue(handle.cancelled.is_set())
+
+        closed = []
+        handle.on_close(lambda: closed.append(True))
+        handle.close()
+        handle.close()
+        self.assertEqual(closed, [True])
+        self.assertIsNone(stream_registry.lookup(handle.stream_id))
+
+    def test_dify_stop_cancels_registered_stream(self):
+        agent = DifyWorkflow('http://dify.local/v1', 'key', {}, 'alice', app='flow')
+        handle = agent._register_stream()
+        stopped = []
+        handle.on_abort(lambda: stopped.append(handle.stream_id))
+        # 停止命令由新建的实例处理，在当前进程中的流立即中断，不需要请求上游
+        stop = DifyWorkflow('http://dify.local/v1', 'key', {'stream_id': handle.stream_id}, 'alice', app='flow')
+        with mock.patch.object(DifyWorkflow, '_stop_task') as stop_task:
+            self.assertEqual(stop.stop(), {'result': 'success'})
+        stop_task.assert_not_called()
+        self.assertEqual(stopped, [handle.stream_id])
+        handle.close()
+        with self.assertRaises(ValueError):
+            stop.stop()
+
+    def test_async_stream_registry_writes_run_off_the_event_loop(self):
+        threads = []
+        execute = local_store.execute
+
+        def record(*args):
+            threads.append(threading.get_ident())
+            return execute(*args)
+
+        agent = ModelChat('gpt', 'http://llm.local/v1', 'key', {'messages': [{'role': 'user', 'content': 'hi'}]}, 'alice')
+        client = SimpleNamespace(chat=SimpleNamespace(completions=_FakeAsyncCompletions()))
+
+        async def scenario():
+            threads.append(threading.get_ident())
+            with mock.patch.object(local_store, 'execute', record), \
+                    mock.patch('GPT.interface.model_chat.get_async_client', return_value=client):
+                response = await agent.atalk()
+                body = b''.join([chunk async for chunk in response.streaming_content])
+            return response, body
+
+        response, body = async_to_sync(scenario)()
+        self.assertIn(b'reply', body)
+        self.assertIsNone(stream_registry.lookup(response['X-Stream-Id']))
+        loop_thread, *writers = threads
+        # 登记和注销各写入一次，都不在事件循环所在的线程
+        self.assertGreaterEqual(len(writers), 2)
+        self.assertNotIn(loop_thread, writers)
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_stop_without_stream_id_cancels_latest_stream(self):
+        for name in ('grace', 'heidi'):
+            Member.objects.create_user(username=name, password=name, department_name='IT')
+        Model_info.objects.create(show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+        self.client.login(username='grace', password='grace')
+        other = Client()
+        other.login(username='heidi', password='heidi')
+        completions = _FakeCompletions()
+        talk = {'name': 'gpt', 'command': 'talk', 'data': json.dumps({'messages': [{'role': 'user', 'content': 'hi'}]})}
+        stop = {'name': 'gpt', 'command': 'stop', 'data': '{}'}
+        with mock.patch(
+            'GPT.interface.model_chat.get_client',
+            return_value=SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        ):
+            response = self.client.post('/GPT/modelTalk', talk)
+            stream_id = response['X-Stream-Id']
+            # 其他用户的停止命令找不到这个流
+            self.assertEqual(other.post('/GPT/modelTalk', stop).status_code, 404)
+            self.assertEqual(self.client.post('/GPT/modelTalk', stop).status_code, 200)
+            self.assertEqual(stream_registry.lookup(stream_id)['cancelled'], 1)
+            self.assertNotIn(b'reply', b''.join(response.streaming_content))
+        self.assertIsNone(stream_registry.lookup(stream_id))
+        self.assertEqual(self.client.post('/GPT/modelTalk', stop).status_code, 404)
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_malformed_data_is_a_server_error(self):
+        Member.objects.create_user(username='grace', password='grace', department_name='IT')
+        Model_info.objects.create(show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+        self.client.login(username='grace', password='grace')
+        response = self.client.post('/GPT/modelTalk', {'name': 'gpt', 'command': 'talk', 'data': '{'})
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('An error occurred', b''.join(response.streaming_content).decode())
+
+
+class ClientDisconnectTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+
+    def test_generator_closed_mid_stream_aborts_upstream(self):
+        handle = stream_registry.register('dify_agent', 'alice', 'wiki')
+        aborted, closed = [], []
+        handle.on_abort(lambda: aborted.append(True))
+        count = metrics.get('stream_aborted_by_client')
+        stream = guard_stream(iter([b'one', b'two']), handle, lambda: closed.append(True))
+        self.assertEqual(next(stream), b'one')
+        # WSGI 服务器写入失败后关闭响应
+        stream.close()
+        self.assertEqual((aborted, closed), ([True], [True]))
+        self.assertEqual(metrics.get('stream_aborted_by_client'), count + 1)
+        self.assertIsNone(stream_registry.lookup(handle.stream_id))
+
+    def test_response_closed_before_iteration_aborts_upstream(self):
+        handle = stream_registry.register('dify_agent', 'alice', 'wiki')
+        aborted = []
+        handle.on_abort(lambda: aborted.append(True))
+        response = StreamResponse(guard_stream(iter([b'one']), handle, lambda: None), handle)
+        response.close()
+        self.assertEqual(aborted, [True])
+        self.assertTrue(handle.closed)
+
+        # 正常结束的流不算客户端断开
+        handle = stream_registry.register('dify_agent', 'alice', 'wiki')
+        handle.on_abort(lambda: aborted.append(False))
+        response = StreamResponse(guard_stream(iter([b'one']), handle, lambda: None), handle)
+        self.assertEqual(b''.join(response.streaming_content), b'one')
+        response.close()
+        self.assertEqual(aborted, [True])
+
+    @override_settings(MODEL_STREAM_USAGE=False)
+    def test_model_chat_closes_upstream_when_client_leaves(self):
+        upstream = mock.Mock()
+        delta = SimpleNamespace(content='reply')
+        upstream.__iter__ = mock.Mock(return_value=iter([SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])] * 3))
+        completions = SimpleNamespace(create=mock.Mock(return_value=upstream))
+        with mock.patch('GPT.interface.model_chat.get_client', return_value=SimpleNamespace(chat=SimpleNamespace(completions=completions))):
+            agent = ModelChat('gpt', 'http://llm.local/v1', 'key', {'messages': [{'role': 'user', 'content': 'hi'}]}, 'alice')
+            response = agent.talk()
+        content = iter(response.streaming_content)
+        next(content)
+        response.close()
+        self.assertTrue(upstream.close.called)
+        self.assertTrue(agent.handle.cancelled.is_set())
+        self.assertIsNone(stream_registry.lookup(response['X-Stream-Id']))
+
+
+@override_settings(CONFIG_VERSION_CHECK_INTERVAL=60)
+class ConfigRegistryTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        Model_info.objects.create(show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+        Application.objects.create(name='wiki', api_url='http://dify.local/v1', api_key='key', type='dify_agent')
+
+    def test_config_is_read_from_memory(self):
+        self.assertEqual(config_registry.get_model('gpt').model_name, 'gpt')
+        with self.assertNumQueries(0):
+            self.assertEqual(config_registry.get_application('wiki').type, 'dify_agent')
+            self.assertIsNone(config_registry.get_model('missing'))
+
+    def test_changes_reach_other_workers(self):
+        worker = ConfigRegistry()
+        self.assertEqual(worker.get_model('gpt').model_url, 'http://llm.local/v1')
+        Model_info.objects.filter(show_name='gpt').update(model_url='http://stale.local/v1')
+        # 绕过信号的修改在版本检查间隔内不可见
+        self.assertEqual(worker.get_model('gpt').model_url, 'http://llm.local/v1')
+
+        model = Model_info.objects.get(show_name='gpt')
+        model.model_url = 'http://new.local/v1'
+        model.save()
+        Application.objects.get(name='wiki').delete()
+        # 当前进程立即重新加载，其他 worker 在下次版本检查时重新加载
+        self.assertEqual(config_registry.get_model('gpt').model_url, 'http://new.local/v1')
+        self.assertIsNone(config_registry.get_application('wiki'))
+        self.assertEqual(worker.get_model('gpt').model_url, 'http://llm.local/v1')
+        with override_settings(CONFIG_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(worker.get_model('gpt').model_url, 'http://new.local/v1')
+            self.assertIsNone(worker.get_application('wiki'))
+
+
+@override_settings(DIFY_PARAMETERS_TTL=60, DIFY_PARAMETERS_STALE=600)
+class DifyParametersTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        self.application = Application.objects.create(
+            name='wiki', api_url='http://dify.local/v1', api_key='key', type='dify_agent'
+        )
+        self.fetched = []
+
+        def fetch(application):
+            self.fetched.append(application.name)
+            time.sleep(0.05)
+            return {'version': len(self.fetched)}
+
+        patcher = mock.patch('GPT.interface.dify_parameters._fetch', side_effect=fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _age(self, seconds: float):
+        local_store.execute("UPDATE app_parameters SET fetched = ? WHERE app = 'wiki'", (time.time() - seconds,))
+
+    def test_fresh_and_stale_while_revalidate(self):
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 1})
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 1})
+        self.assertEqual(len(self.fetched), 1)
+
+        # 过期但仍可用：先返回旧数据，只有一个后台刷新
+        self._age(120)
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 1})
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 1})
+        for _ in range(100):
+            if local_store.execute("SELECT refreshing FROM app_parameters WHERE app = 'wiki'").fetchone()[0] is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 2})
+        self.assertEqual(len(self.fetched), 2)
+
+        # 过旧的缓存同步刷新
+        self._age(1200)
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 3})
+
+        # 修改应用后丢弃缓存
+        self.application.api_key = 'new-key'
+        self.application.save()
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 4})
+
+    def test_concurrent_misses_share_one_upstream_call(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(dify_parameters.get_parameters(self.application)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(results, [{'version': 1}] * 5)
+        self.assertEqual(self.fetched, ['wiki'])
+
+    def test_waits_for_another_worker_fetching(self):
+        # 另一个 worker 已经抢到拉取权，本进程轮询等待它写入结果，不再请求上游
+        local_store.execute(
+            "INSERT INTO app_parameters (app, body, fetched, refreshing) VALUES ('wiki', 'null', 0, ?)", (time.time(),)
+        )
+        timer = threading.Timer(0.1, dify_parameters._store, args=('wiki', {'version': 'other'}))
+        timer.start()
+        self.addCleanup(timer.join)
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 'other'})
+        self.assertEqual(self.fetched, [])
+
+    def test_failed_fetch_releases_the_claim(self):
+        with mock.patch('GPT.interface.dify_parameters._fetch', side_effect=ValueError('down')):
+            with self.assertRaises(ValueError):
+                dify_parameters.get_parameters(self.application)
+        self.assertEqual(dify_parameters.get_parameters(self.application), {'version': 1})
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], CONFIG_VERSION_CHECK_INTERVAL=60)
+class EntitlementCacheTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        for name in ('wiki', 'report'):
+            Application.objects.create(name=name, api_url='http://dify.local/v1', api_key='key', type='dify_agent')
+        self.user = Member.objects.create_user(username='alice', password='password', department_name='IT')
+        self.user.application.add('wiki')
+
+    def test_permission_checks_are_served_from_memory(self):
+        self.assertTrue(entitlements.has_application(self.user, 'wiki'))
+        with self.assertNumQueries(0):
+            self.assertFalse(entitlements.has_application(self.user, 'report'))
+            self.assertEqual(entitlements.applications(self.user), {'wiki'})
+        self.assertTrue(async_to_sync(entitlements.ahas_application)(self.user, 'wiki'))
+
+    def test_grant_changes_reach_other_workers(self):
+        worker = EntitlementCache()
+        self.assertEqual(worker.applications(self.user), {'wiki'})
+        self.user.application.add('report')
+        self.assertEqual(entitlements.applications(self.user), {'wiki', 'report'})
+        # 其他 worker 在下次版本检查时丢弃缓存
+        self.assertEqual(worker.applications(self.user), {'wiki'})
+        with override_settings(CONFIG_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(worker.applications(self.user), {'wiki', 'report'})
+            Application.objects.get(name='wiki').delete()
+            self.assertEqual(worker.applications(self.user), {'report'})
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], EXPORT_CHUNK_SIZE=2)
+class DirectoryExportTests(TestCase):
+    def setUp(self):
+        self.admin = Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        for name in ('wiki', 'report'):
+            Application.objects.create(name=name, api_url='http://dify.local/v1', api_key='secret', type='dify_agent')
+        for i in range(5):
+            user = Member.objects.create_user(username=f'user-{i}', password='password', department_name='研发部')
+            if i % 2 == 0:
+                Membership.objects.create(member=user, application_id='wiki', granted_by=self.admin)
+            if i == 4:
+                Membership.objects.create(member=user, application_id='report')
+        # 已删除用户的关联记录随用户一起删除，归并时不会错位
+        Member.objects.get(username='user-1').delete()
+        self.client.force_login(self.admin)
+
+    def _export(self, **params):
+        response = self.client.get('/GPT/export_directory', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_users_csv_merges_applications(self):
+        lines = self._export(kind='users').lstrip('\ufeff').splitlines()
+        self.assertEqual(lines[0], ','.join(['username', 'email', 'department_name', 'is_active', 'is_superuser', 'date_joined', 'last_login', 'applications']))
+        applications = {line.split(',')[0]: line.split(',')[-1] for line in lines[1:]}
+        self.assertEqual(applications, {
+            'admin': '', 'user-0': 'wiki', 'user-2': 'wiki', 'user-3': '', 'user-4': 'report;wiki'
+        })
+
+    def test_ndjson_exports(self):
+        users = [json.loads(line) for line in self._export(kind='users', format='ndjson').splitlines()]
+        self.assertEqual([user['username'] for user in users], ['admin', 'user-0', 'user-2', 'user-3', 'user-4'])
+        self.assertEqual(users[4]['applications'], ['report', 'wiki'])
+
+        applications = [json.loads(line) for line in self._export(kind='applications', format='ndjson').splitlines()]
+        self.assertEqual([(app['name'], app['member_count']) for app in applications], [('report', 1), ('wiki', 3)])
+        self.assertNotIn('api_key', applications[0])
+
+        memberships = [json.loads(line) for line in self._export(kind='memberships', format='ndjson').splitlines()]
+        self.assertEqual(
+            [(row['username'], row['application'], row['granted_by']) for row in memberships],
+            [('user-0', 'wiki', 'admin'), ('user-2', 'wiki', 'admin'), ('user-4', 'report', None), ('user-4', 'wiki', 'admin')]
+        )
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get('/GPT/export_directory', {'kind': 'secrets'}).status_code, 400)
+        self.assertEqual(self.client.get('/GPT/export_directory', {'format': 'xlsx'}).status_code, 400)
+        self.client.force_login(Member.objects.get(username='user-0'))
+        self.assertEqual(self.client.get('/GPT/export_directory').status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BulkUserTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        self.admin = Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        for name in ('wiki', 'report'):
+            Application.objects.create(name=name, api_url='http://dify.local/v1', api_key='key', type='dify_agent')
+        self.client.force_login(self.admin)
+
+    def _post(self, action, users):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/GPT/bulk_users', json.dumps({'action': action, 'users': users}), content_type='application/json')
+
+    def test_create_with_applications(self):
+        response = self._post('create', [
+            {'username': 'alice', 'password': 'pw', 'department_name': '研发部', 'applications': ['wiki', 'report']},
+            {'username': 'bob', 'password': 'pw', 'department_name': '研发部', 'is_active': 'false'},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['succeeded'], ['alice', 'bob'])
+        alice = Member.objects.get(username='alice')
+        self.assertTrue(alice.check_password('pw'))
+        self.assertEqual(sorted(alice.application.values_list('name', flat=True)), ['report', 'wiki'])
+        self.assertEqual(Membership.objects.get(member=alice, application_id='wiki').granted_by, self.admin)
+        self.assertFalse(Member.objects.get(username='bob').is_active)
+
+    def test_invalid_rows_do_not_block_valid_rows(self):
+        Member.objects.create_user(username='taken', password='pw', department_name='研发部')
+        response = self._post('create', [
+            {'username': 'taken', 'password': 'pw', 'department_name': '研发部'},
+            {'username': 'carol', 'password': 'pw', 'department_name': '研发部', 'applications': ['ghost']},
+            {'username': 'dave', 'password': '', 'department_name': '研发部'},
+            {'username': 'erin', 'password': 'pw', 'department_name': '研发部'},
+            {'username': 'erin', 'password': 'pw', 'department_name': '研发部'},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        self.assertEqual(data['succeeded'], ['erin'])
+        self.assertEqual([error['row'] for error in data['errors']], [1, 2, 3, 5])
+        self.assertFalse(Member.objects.filter(username__in=['carol', 'dave']).exists())
+
+    def test_update_replaces_applications(self):
+        user = Member.objects.create_user(username='alice', password='old', department_name='研发部')
+        Membership.objects.create(member=user, application_id='wiki')
+        response = self._post('update', [
+            {'username': 'alice', 'department_name': '市场部', 'password': 'new', 'applications': ['report']},
+            {'username': 'ghost', 'email': 'ghost@example.com'},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['errors'][0]['username'], 'ghost')
+        user.refresh_from_db()
+        self.assertEqual(user.department_name, '市场部')
+        self.assertTrue(user.check_password('new'))
+        self.assertEqual(list(user.application.values_list('name', flat=True)), ['report'])
+        self.assertTrue(entitlements.has_application(user, 'report'))
+        self.assertFalse(entitlements.has_application(user, 'wiki'))
+
+    def test_deactivate_and_delete(self):
+        for name in ('alice', 'bob'):
+            user = Member.objects.create_user(username=name, password='pw', department_name='研发部')
+            Membership.objects.create(member=user, application_id='wiki')
+        response = self._post('deactivate', [{'username': 'alice'}, {'username': 'admin'}])
+        self.assertEqual(response.json()['succeeded'], ['alice'])
+        # 不能停用当前登录的超级用户
+        self.assertEqual(response.json()['errors'][0]['row'], 2)
+        self.assertTrue(Member.objects.get(username='admin').is_active)
+        alice = Member.objects.get(username='alice')
+        self.assertFalse(alice.is_active)
+        self.assertEqual(alice.application.count(), 1)
+
+        self._post('delete', [{'username': 'bob'}])
+        bob = Member.objects.get(username='bob')
+        self.assertFalse(bob.is_active)
+        self.assertEqual(bob.application.count(), 0)
+
+    def test_csv_upload(self):
+        upload = SimpleUploadedFile(
+            'users.csv', '\ufeffusername,password,department_name,applications\nalice,pw,研发部,wiki;report\n'.encode('utf-8'),
+            content_type='text/csv'
+        )
+        response = self.client.post('/GPT/bulk_users', {'action': 'create', 'file': upload})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(Member.objects.get(username='alice').application.count(), 2)
+
+    def test_csv_update_keeps_blank_cells(self):
+        for name in ('alice', 'bob'):
+            user = Member.objects.create_user(username=name, password='pw', email=f'{name}@example.com', department_name='研发部')
+            Membership.objects.create(member=user, application_id='wiki')
+        upload = SimpleUploadedFile(
+            'users.csv', 'username,email,department_name,is_active,applications\nalice,,市场部,,\nbob,,,,-\n'.encode('utf-8'),
+            content_type='text/csv'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/GPT/bulk_users', {'action': 'update', 'file': upload})
+        self.assertEqual(response.json()['succeeded'], ['alice', 'bob'])
+        alice = Member.objects.get(username='alice')
+        self.assertEqual((alice.email, alice.department_name, alice.is_active), ('alice@example.com', '市场部', True))
+        self.assertEqual(list(alice.application.values_list('name', flat=True)), ['wiki'])
+        # applications 列填 - 才清空授权
+        self.assertEqual(Member.objects.get(username='bob').application.count(), 0)
+
+    def test_update_cannot_deactivate_self_or_superuser(self):
+        Member.objects.create_superuser(username='root', password='pw', department_name='IT')
+        response = self._post('update', [{'username': 'admin', 'is_active': False}, {'username': 'root', 'is_active': 'false'}])
+        self.assertEqual(response.json()['succeeded'], [])
+        self.assertEqual(len(response.json()['errors']), 2)
+        self.assertTrue(Member.objects.get(username='root').is_active)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self._post('rename', []).status_code, 400)
+        response = self.client.post('/GPT/bulk_users', json.dumps({'action': 'create', 'users': {}}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/GPT/bulk_users').status_code, 405)
+        self.client.force_login(Member.objects.create_user(username='alice', password='pw', department_name='研发部'))
+        self.assertEqual(self._post('create', []).status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DepartmentGrantTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        self.admin = Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        for name in ('wiki', 'report', 'direct'):
+            Application.objects.create(name=name, api_url='http://dify.local/v1', api_key='key', type='dify_agent')
+        self.user = Member.objects.create_user(username='alice', password='password', department_name='研发部')
+        self.user.application.add('direct')
+        self.client.force_login(self.admin)
+
+    def _grant(self, **data):
+        response = self.client.post(
+            '/GPT/manage_department_applications', json.dumps(data), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def _applications(self):
+        # 重新读取用户，部门以数据库为准
+        return entitlements.applications(Member.objects.get(pk=self.user.pk))
+
+    def test_department_and_group_grants_are_merged(self):
+        self.assertEqual(self._applications(), {'direct'})
+        self._grant(department_name='研发部', action='add', applications=['wiki'])
+        self.assertEqual(self._applications(), {'direct', 'wiki'})
+
+        group = Group.objects.create(name='报表')
+        self._grant(group='报表', action='add', applications=['report'])
+        self.assertEqual(self._applications(), {'direct', 'wiki'})
+        self.user.groups.add(group)
+        self.assertEqual(self._applications(), {'direct', 'wiki', 'report'})
+
+        # 换部门后不需要改授权表
+        Member.objects.filter(pk=self.user.pk).update(department_name='市场部')
+        self.assertEqual(self._applications(), {'direct', 'report'})
+
+        self._grant(group='报表', action='remove', applications=['report'])
+        self.assertEqual(self._applications(), {'direct'})
+
+    def test_resolution_is_cached(self):
+        self._grant(department_name='研发部', action='add', applications=['wiki'])
+        user = Member.objects.get(pk=self.user.pk)
+        entitlements.applications(user)
+        with self.assertNumQueries(0):
+            self.assertTrue(entitlements.has_application(user, 'wiki'))
+
+    def test_grant_requires_one_target(self):
+        response = self.client.post('/GPT/manage_department_applications', json.dumps({
+            'department_name': '研发部', 'group': '报表', 'action': 'add', 'applications': ['wiki']
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BulkMembershipTests(TestCase):
+    def setUp(self):
+        admin = Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        for name in ('wiki', 'report'):
+            Application.objects.create(name=name, api_url='http://dify.local/v1', api_key='key', type='dify_agent')
+        self.client.force_login(admin)
+        # 预热会话和登录用户缓存，各轮的查询次数才可比较
+        self.client.get('/GPT/getAllApps')
+
+    def _post(self, data):
+        return self.client.post('/GPT/bulk_memberships', json.dumps(data), content_type='application/json')
+
+    def _members(self, department: str, count: int):
+        Member.objects.bulk_create([
+            Member(username=f'{department}-{i}', department_name=department) for i in range(count)
+        ])
+
+    def test_query_count_does_not_grow_with_users(self):
+        counts = []
+        for department, count in (('small', 2), ('large', 200)):
+            self._members(department, count)
+            with CaptureQueriesContext(connection) as context:
+                response = self._post({
+                    'action': 'assign', 'applications': ['wiki', 'report'], 'filter': {'department': department}
+                })
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(response.json()['users'], count)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1], '查询次数随用户数增长')
+        self.assertEqual(Member.objects.get(username='large-7').application.count(), 2)
+
+    def test_assign_and_revoke_by_username(self):
+        self._members('dev', 3)
+        response = self._post({'action': 'assign', 'applications': ['wiki'], 'usernames': ['dev-0', 'dev-1']})
+        self.assertEqual(response.status_code, 200, response.content)
+        # 重复授权不报错
+        self._post({'action': 'assign', 'applications': ['wiki'], 'usernames': ['dev-0']})
+        self.assertEqual(Application.objects.get(name='wiki').member.count(), 2)
+
+        response = self._post({'action': 'revoke', 'applications': ['wiki'], 'usernames': ['dev-0']})
+        self.assertEqual(response.json()['memberships'], 1)
+        self.assertEqual(list(Application.objects.get(name='wiki').member.values_list('username', flat=True)), ['dev-1'])
+
+    def test_unknown_user_changes_nothing(self):
+        self._members('dev', 1)
+        response = self._post({'action': 'assign', 'applications': ['wiki'], 'usernames': ['dev-0', 'ghost']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Application.objects.get(name='wiki').member.count(), 0)
+
+    def test_create_app_with_grants(self):
+        self._members('dev', 2)
+        response = self.client.post('/GPT/createApp', json.dumps({
+            'name': 'new-app', 'api_url': 'http://dify.local/v1', 'api_key': 'key', 'type': 'dify_agent',
+            'usernames': ['dev-0'], 'department_names': ['市场部']
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(entitlements.has_application(Member.objects.get(username='dev-0'), 'new-app'))
+        self.assertFalse(entitlements.has_application(Member.objects.get(username='dev-1'), 'new-app'))
+        self.assertTrue(entitlements.has_application(Member(pk=-1, department_name='市场部'), 'new-app'))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        Member.objects.create_user(username='alice', password='password', department_name='研发部')
+        self.admin = Client()
+        self.admin.login(username='admin', password='admin')
+        self.client.login(username='alice', password='password')
+
+    def _authenticated(self, client=None) -> bool:
+        response = (client or self.client).get('/GPT/getApps')
+        return response.wsgi_request.user.is_authenticated
+
+    def test_cached_request_skips_session_and_user_queries(self):
+        self.assertTrue(self._authenticated())
+        with self.assertNumQueries(0):
+            self.assertTrue(self._authenticated())
+
+    def test_logout_revokes_session(self):
+        self.assertTrue(self._authenticated())
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.client.post('/GPT/logout')
+        # 重放登出前的 Cookie
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+        self.assertFalse(self._authenticated())
+
+    def test_reset_password_revokes_session(self):
+        self.assertTrue(self._authenticated())
+        self.admin.post('/GPT/reset_password', json.dumps({
+            'username': 'alice', 'new_password': 'new-password'
+        }), content_type='application/json')
+        self.assertFalse(self._authenticated())
+
+    def test_delete_user_revokes_session(self):
+        self.assertTrue(self._authenticated())
+        self.admin.delete('/GPT/delete_user', json.dumps({'username': 'alice'}), content_type='application/json')
+        self.assertFalse(self._authenticated())
+
+    @override_settings(CONFIG_VERSION_CHECK_INTERVAL=0)
+    def test_session_changes_only_drop_that_session(self):
+        self.assertTrue(self._authenticated())
+        version = local_store.get_version('auth')
+        # 登录和登出都不清空其他会话和用户的缓存
+        Client().login(username='alice', password='password')
+        self.assertEqual(local_store.get_version('auth'), version)
+
+        # 另一个 worker 的缓存只丢弃被登出的会话
+        worker = AuthCache()
+        alice_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        admin_key = self.admin.cookies[settings.SESSION_COOKIE_NAME].value
+        expires = timezone.now() + timezone.timedelta(hours=1)
+        self.assertIsNone(worker.get_session(alice_key))
+        worker.put_session(alice_key, 'alice-data', expires)
+        worker.put_session(admin_key, 'admin-data', expires)
+        self.client.post('/GPT/logout')
+        self.assertEqual(local_store.get_version('auth'), version)
+        self.assertIsNone(worker.get_session(alice_key))
+        self.assertEqual(worker.get_session(admin_key), 'admin-data')
+
+
+@override_settings(SQLITE_WRITE_QUEUE=True)
+class WriteQueueTests(TransactionTestCase):
+    # 写线程使用自己的数据库连接，用例不能包在 TestCase 的事务中
+    def setUp(self):
+        self.queue = WriteQueue()
+
+    def _create(self, name: str, fail: bool = False):
+        Application.objects.create(name=name, api_url='http://dify.local/v1', api_key='key', type='dify_agent')
+        if fail:
+            raise ValueError(name)
+        return threading.current_thread().name
+
+    def test_runs_on_writer_thread(self):
+        self.assertEqual(self.queue.run(self._create, 'wiki'), 'sqlite-writer')
+        self.assertTrue(Application.objects.filter(name='wiki').exists())
+        with self.assertRaises(ValueError):
+            self.queue.run(self._create, 'report', fail=True)
+        self.assertFalse(Application.objects.filter(name='report').exists())
+
+    def test_failed_job_does_not_affect_batch(self):
+        # 第一个写入阻塞写线程，后面的写入在同一个事务中提交
+        started, release = threading.Event(), threading.Event()
+        blocker = self.queue.submit(lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(5))
+        futures = [
+            self.queue.submit(self._create, 'a'),
+            self.queue.submit(self._create, 'b', fail=True),
+            self.queue.submit(self._create, 'c'),
+        ]
+        release.set()
+        self.assertTrue(blocker.result(5))
+        self.assertEqual(futures[0].result(5), 'sqlite-writer')
+        self.assertIsInstance(futures[1].exception(5), ValueError)
+        self.assertEqual(futures[2].result(5), 'sqlite-writer')
+        self.assertEqual(sorted(Application.objects.values_list('name', flat=True)), ['a', 'c'])
+
+    def test_defer_logs_failures(self):
+        with self.assertLogs('GPT.write_queue', 'ERROR') as logs:
+            self.queue.defer(self._create, 'wiki', fail=True)
+            # 同一个写线程按顺序执行，等后面的写入完成即可
+            self.queue.run(self._create, 'report')
+        self.assertIn('延迟写入失败', logs.output[0])
+        self.assertEqual(list(Application.objects.values_list('name', flat=True)), ['report'])
+
+    def test_inline_inside_atomic_or_disabled(self):
+        with transaction.atomic():
+            self.assertEqual(self.queue.run(self._create, 'wiki'), threading.current_thread().name)
+        with override_settings(SQLITE_WRITE_QUEUE=False):
+            self.assertEqual(self.queue.submit(self._create, 'report').result(), threading.current_thread().name)
+        self.assertIsNone(self.queue._thread)
+
+
+class ReadReplicaRoutingTests(TestCase):
+    """
+    测试环境中没有真正的副本：配置中加入 replica 别名但不创建连接，
+    查询一旦发往副本就会报错，由此判断路由结果
+    """
+
+    def setUp(self):
+        Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        Model_info.objects.create(show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+        self.client.login(username='admin', password='admin')
+
+    @contextmanager
+    def _replica(self):
+        with warnings.catch_warnings():
+            # 只改配置不改连接，Django 对覆盖 DATABASES 的警告在这里不适用
+            warnings.simplefilter('ignore')
+            with override_settings(DATABASES=dict(settings.DATABASES, replica={})):
+                yield
+
+    def test_router(self):
+        router = ReadReplicaRouter()
+
+        @read_replica
+        def view(request):
+            with primary():
+                in_primary = router.db_for_read(Member)
+            return router.db_for_read(Member), in_primary
+
+        self.assertEqual(view(None), (None, None))
+        with self._replica():
+            self.assertEqual(view(None), ('replica', None))
+            self.assertIsNone(router.db_for_read(Member))
+            self.assertIsNone(router.db_for_write(Member))
+            self.assertFalse(router.allow_migrate('replica', 'GPT'))
+
+    def test_read_only_endpoint_reads_replica(self):
+        with self._replica():
+            response = self.client.get('/GPT/get_model_info')
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('replica', response.json()['message'])
+
+    def test_caches_load_from_primary(self):
+        auth_cache.invalidate()
+        entitlements.invalidate()
+        with self._replica():
+            response = self.client.get('/GPT/getApps')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(response.wsgi_request.user.is_authenticated)
+
+
+@override_settings(USAGE_FLUSH_INTERVAL=0, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UsageMeteringTests(TestCase):
+    def setUp(self):
+        Member.objects.create_superuser(username='admin', password='admin', department_name='IT')
+        self.client.login(username='admin', password='admin')
+
+    def _dify_events(self, agent, *events):
+        agent._register_stream()
+        try:
+            for event in events:
+                agent._on_event(json.dumps(event).encode('utf-8'))
+        finally:
+            agent.handle.close()
+
+    def test_dify_usage_is_captured_and_rolled_up(self):
+        agent = DifyAgent('http://dify.local/v1', 'key', {'query': 'hi'}, 'alice', app='wiki')
+        usage = {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+        for _ in range(2):
+            self._dify_events(
+                agent,
+                {'event': 'message', 'task_id': 't', 'conversation_id': 'c', 'answer': 'message_end'},
+                {'event': 'message_end', 'task_id': 't', 'metadata': {'usage': usage}}
+            )
+            # 两次写入分别累加到同一条小时汇总
+            self.assertEqual(usage_meter.flush(), 1)
+        workflow = DifyWorkflow('http://dify.local/v1', 'key', {}, 'bob', app='report')
+        self._dify_events(
+            workflow,
+            {'event': 'workflow_started', 'task_id': 'w'},
+            {'event': 'workflow_finished', 'task_id': 'w', 'data': {'total_tokens': 7}}
+        )
+        usage_meter.flush()
+
+        self.assertEqual(UsageEvent.objects.count(), 3)
+        rollup = UsageHourly.objects.get(username='alice')
+        self.assertEqual((rollup.app, rollup.requests, rollup.prompt_tokens, rollup.total_tokens), ('wiki', 2, 20, 30))
+
+        data = self.client.get('/GPT/get_usage', {'group_by': 'app'}).json()
+        self.assertEqual(data['status'], 'success', data)
+        self.assertEqual(
+            [(row['app'], row['requests'], row['total_tokens']) for row in data['usage']],
+            [('wiki', 2, 30), ('report', 1, 7)]
+        )
+        self.assertEqual(data['totals']['total_tokens'], 37)
+
+        data = self.client.get('/GPT/get_usage', {'group_by': 'user,day', 'username': 'bob'}).json()
+        self.assertEqual([(row['username'], row['total_tokens']) for row in data['usage']], [('bob', 7)])
+        self.assertEqual(self.client.get('/GPT/get_usage', {'group_by': 'nope'}).status_code, 400)
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    CONVERSATION_FLUSH_DELAY=-1, MODEL_STREAM_USAGE=False
+)
+class ConversationStoreTests(TestCase):
+    def setUp(self):
+        Member.objects.create_user(username='alice', password='alice', department_name='IT')
+        Member.objects.create_user(username='bob', password='bob', department_name='IT')
+        Model_info.objects.create(show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+        self.client.login(username='alice', password='alice')
+        self.completions = _FakeCompletions()
+        patcher = mock.patch(
+            'GPT.interface.model_chat.get_client',
+            return_value=SimpleNamespace(chat=SimpleNamespace(completions=self.completions))
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _talk(self, client, **payload):
+        response = client.post('/GPT/modelTalk', {'name': 'gpt', 'command': 'talk', 'data': json.dumps(payload)})
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def test_history_is_rebuilt_server_side(self):
+        response = self._talk(self.client, message='hi')
+        conversation_id = response['X-Conversation-Id']
+        self._talk(self.client, conversation_id=conversation_id, message={'role': 'user', 'content': 'again'})
+        self.assertEqual(self.completions.calls[1], [
+            {'role': 'user', 'content': 'hi'},
+            {'role': 'assistant', 'content': 'reply 1'},
+            {'role': 'user', 'content': 'again'},
+        ])
+        turns = ConversationTurn.objects.filter(conversation_id=conversation_id).order_by('seq')
+        self.assertEqual([turn.seq for turn in turns], [0, 1, 2, 3])
+        # 内容压缩保存
+        self.assertNotIn(b'again', bytes(turns[2].content))
+
+        # 其他用户不能读取或续写该对话
+        other = Client()
+        other.login(username='bob', password='bob')
+        self.assertEqual(self._talk(other, conversation_id=conversation_id, message='x').status_code, 404)
+
+        # 不带 message 时沿用前端提交的完整 messages，不保存对话
+        response = self._talk(self.client, messages=[{'role': 'user', 'content': 'legacy'}])
+        self.assertNotIn('X-Conversation-Id', response)
+        self.assertEqual(ConversationTurn.objects.count(), 4)
+
+    def test_unflushed_turns_are_visible_to_history(self):
+        conversation_id = self._talk(self.client, message='hi')['X-Conversation-Id']
+        with mock.patch.object(conversation_store, 'flush'):
+            self._talk(self.client, conversation_id=conversation_id, message='again')
+        # 第二轮尚未写入数据库，读取历史时从待写队列合并
+        self.assertEqual(ConversationTurn.objects.count(), 2)
+        self.assertEqual(len(conversation_store.history(conversation_id)), 4)
+        self.assertEqual(conversation_store.flush(), 2)
+        self.assertEqual(
+            [turn['content'] for turn in conversation_store.history(conversation_id)],
+            ['hi', 'reply 1', 'again', 'reply 2']
+        )
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    CONTEXT_TOKENIZER='', CONTEXT_RESERVE_TOKENS=100, MODEL_STREAM_USAGE=False
+)
+class ContextBudgetTests(TestCase):
+    def setUp(self):
+        Member.objects.create_user(username='alice', password='alice', department_name='IT')
+        Model_info.objects.create(
+            show_name='gpt', model_url='http://llm.local/v1', model_key='key', model_name='gpt', context_window=300
+        )
+        self.client.login(username='alice', password='alice')
+        self.completions = _FakeCompletions()
+        patcher = mock.patch(
+            'GPT.interface.model_chat.get_client',
+            return_value=SimpleNamespace(chat=SimpleNamespace(completions=self.completions))
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _turns(self, count: int) -> list:
+        # 每条消息 4 + 40 个 token
+        return [
+            {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'{i:02d}' + 'x' * 158}
+            for i in range(count)
+        ]
+
+    def test_oldest_turns_are_dropped(self):
+        messages = [{'role': 'system', 'content': 'y' * 160}] + self._turns(7)
+        trimmed, dropped = fit_messages(messages, 200)
+        # system 和最后一条占 88，剩余预算再保留两条
+        self.assertEqual(dropped, 4)
+        self.assertEqual([m['content'][:2] for m in trimmed[1:]], ['04', '05', '06'])
+        self.assertEqual(trimmed[0]['role'], 'system')
+        self.assertEqual(fit_messages(messages, 0), (messages, 0))
+        with self.assertRaises(ContextTooLarge):
+            fit_messages(messages, 80)
+
+    def test_counts_are_cached_by_content(self):
+        message = {'role': 'user', 'content': '缓存' + 'z' * 1000}
+        with mock.patch.object(token_counter, '_text_tokens', wraps=token_counter._text_tokens) as text_tokens:
+            first = token_counter.count(message)
+            self.assertEqual(token_counter.count(dict(message)), first)
+        self.assertEqual(text_tokens.call_count, 1)
+        self.assertEqual(first, 4 + 2 + 250)
+
+    def test_model_talk_trims_and_rejects_before_upstream(self):
+        response = self.client.post('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'talk', 'data': json.dumps({'messages': self._turns(9)})
+        })
+        b''.join(response.streaming_content)
+        # 预算 300 - 100 可以保留 4 条，但第一条是回复，从其后的提问开始保留
+        self.assertEqual([m['content'][:2] for m in self.completions.calls[0]], ['06', '07', '08'])
+
+        response = self.client.post('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'talk', 'data': json.dumps({'messages': [{'role': 'user', 'content': 'x' * 1000}]})
+        })
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(len(self.completions.calls), 1)
+
+    @override_settings(CONTEXT_RESERVE_TOKENS=400)
+    def test_reserve_larger_than_window_still_trims(self):
+        # 预留超过窗口时按窗口的一半作为预算，仍然裁剪和拒绝
+        self.assertEqual(context_budget(300), 150)
+        response = self.client.post('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'talk', 'data': json.dumps({'messages': self._turns(9)})
+        })
+        b''.join(response.streaming_content)
+        self.assertEqual([m['content'][:2] for m in self.completions.calls[0]], ['06', '07', '08'])
+        response = self.client.post('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'talk', 'data': json.dumps({'messages': [{'role': 'user', 'content': 'x' * 1000}]})
+        })
+        self.assertEqual(response.status_code, 413)
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    MODEL_STREAM_USAGE=False, ADMISSION_USER_RATE=0, ADMISSION_USER_CONCURRENCY=0
+)
+class AdmissionTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        Member.objects.create_user(username='carol', password='carol', department_name='IT')
+        Model_info.objects.create(show_name='limited', model_url='http://llm.local/v1', model_key='key', model_name='gpt')
+        self.client.login(username='carol', password='carol')
+        self.completions = _FakeCompletions()
+        patcher = mock.patch(
+            'GPT.interface.model_chat.get_client',
+            return_value=SimpleNamespace(chat=SimpleNamespace(completions=self.completions))
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _talk(self):
+        return self.client.post('/GPT/modelTalk', {
+            'name': 'limited', 'command': 'talk', 'data': json.dumps({'messages': [{'role': 'user', 'content': 'hi'}]})
+        })
+
+    @override_settings(ADMISSION_USER_RATE=60, ADMISSION_USER_BURST=2)
+    def test_token_bucket(self):
+        for _ in range(2):
+            b''.join(self._talk().streaming_content)
+        response = self._talk()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(len(self.completions.calls), 2)
+
+    @override_settings(ADMISSION_MODEL_CONCURRENCY=1)
+    def test_concurrent_streams_are_capped_until_released(self):
+        first = self._talk()
+        self.assertEqual(self._talk().status_code, 429)
+        # 被拒绝的请求没有调用上游
+        self.assertEqual(self.completions.calls, [])
+        b''.join(first.streaming_content)
+        b''.join(self._talk().streaming_content)
+        self.assertEqual(len(self.completions.calls), 2)
+
+        # 已退出的 worker 遗留的租约在达到上限时被清理
+        local_store.execute(
+            "INSERT INTO leases (lease_id, key, pid, created) VALUES ('stale', 'model:limited', ?, ?)",
+            (2 ** 22 + 1, time.time())
+        )
+        lease = admit('dave', model='limited')
+        with self.assertRaises(Rejected):
+            admit('carol', model='limited')
+        lease.release()
+        admit('carol', model='limited').release()
+
+    @override_settings(ADMISSION_MODEL_CONCURRENCY=1)
+    def test_async_admission_runs_off_the_event_loop(self):
+        threads = []
+        execute = local_store.execute
+
+        def record(*args):
+            threads.append(threading.get_ident())
+            return execute(*args)
+
+        async def scenario():
+            threads.append(threading.get_ident())
+            lease = await aadmit('carol', model='limited')
+            with self.assertRaises(Rejected):
+                await aadmit('carol', model='limited')
+            with mock.patch.object(local_store, 'execute', record):
+                await lease.ahold(JsonResponse({}))
+            return lease
+
+        self.assertTrue(async_to_sync(scenario)().released)
+        # 第一个是事件循环所在的线程，释放租约的写入不在该线程执行
+        loop_thread, *writers = threads
+        self.assertTrue(writers)
+        self.assertNotIn(loop_thread, writers)
+        admit('carol', model='limited').release()
+
+
+@override_settings(LOAD_SHED_MAX_ACTIVE=1, LOAD_SHED_QUEUE_DEPTH=1, LOAD_SHED_MAX_WAIT=2)
+@override_settings(LOAD_SHED_MAX_ACTIVE=1, LOAD_SHED_QUEUE_DEPTH=1, LOAD_SHED_MAX_WAIT=2)
+class LoadShedTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+
+    def _count(self, table: str) -> int:
+        return local_store.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def test_bounded_queue_hands_over_slots(self):
+        # 两个 LoadShedder 模拟同一台机器上的两个同步 worker
+        first, second = LoadShedder(), LoadShedder()
+        ticket = first.acquire()
+        admitted = []
+        waiting = threading.Thread(target=lambda: admitted.append(second.acquire()))
+        waiting.start()
+        while not self._count('shed_queue'):
+            time.sleep(0.01)
+        # 队列已满，立即拒绝
+        with self.assertRaises(Overloaded):
+            LoadShedder().acquire()
+        first.release(ticket)
+        waiting.join(1)
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(self._count('shed_active'), 1)
+
+        with override_settings(LOAD_SHED_MAX_WAIT=0.05), self.assertRaises(Overloaded):
+            first.acquire()
+        self.assertEqual(self._count('shed_queue'), 0)
+        second.release(admitted[0])
+        self.assertEqual(self._count('shed_active'), 0)
+
+    def test_async_wait_off_the_event_loop_and_cancel(self):
+        shedder = LoadShedder()
+        ticket = shedder.acquire()
+
+        async def cancel_while_queued():
+            task = asyncio.ensure_future(shedder.aacquire())
+            while not await sync_to_async(self._count, thread_sensitive=False)('shed_queue'):
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        async_to_sync(cancel_while_queued)()
+        self.assertEqual(self._count('shed_queue'), 0)
+        shedder.release(ticket)
+
+        async def acquire_and_release():
+            ticket = await shedder.aacquire()
+            await shedder.arelease(ticket)
+
+        async_to_sync(acquire_and_release)()
+        self.assertEqual(self._count('shed_active'), 0)
+
+    def test_slots_of_exited_workers_are_reaped(self):
+        local_store.execute("INSERT INTO shed_active (ticket, pid, created) VALUES ('dead', 2147483647, ?)", (time.time(),))
+        shedder = LoadShedder()
+        shedder.release(shedder.acquire())
+        self.assertEqual(self._count('shed_active'), 0)
+
+    @override_settings(LOAD_SHED_MAX_ACTIVE=0)
+    def test_unlimited_does_not_touch_the_store(self):
+        shedder = LoadShedder()
+        self.assertIsNone(shedder.acquire())
+        shedder.release(None)
+        self.assertEqual(self._count('shed_active'), 0)
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_request_queued_too_long_in_backlog_is_shed(self):
+        Member.objects.create_user(username='erin', password='erin', department_name='IT')
+        self.client.login(username='erin', password='erin')
+        count = metrics.get('load_shed_expired')
+        response = self.client.post('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'talk', 'data': '{}'
+        }, HTTP_X_REQUEST_START=f't={time.time() - 5:.3f}')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(settings.LOAD_SHED_RETRY_AFTER))
+        self.assertEqual(metrics.get('load_shed_expired'), count + 1)
+        self.assertGreaterEqual(metrics.snapshot()['summaries']['load_shed_wait_seconds']['max'], 5)
+        # stop 命令不排队
+        response = self.client.post('/GPT/modelTalk', {
+            'name': 'gpt', 'command': 'stop', 'data': '{}'
+        }, HTTP_X_REQUEST_START=f't={time.time() - 5:.3f}')
+        self.assertEqual(response.status_code, 404)
+
+
+UPSTREAM = 'http://upstream.test/v1'
+
+
+@override_settings(UPSTREAM_SLOTS=0, UPSTREAM_SLOTS_OVERRIDES={UPSTREAM: 1}, UPSTREAM_QUEUE_TIMEOUT=2)
+class UpstreamSchedulerTests(TestCase):
+    def setUp(self):
+        _isolate_gateway_store(self)
+        self.scheduler = UpstreamScheduler()
+
+    def _drain(self, slot, tickets: list) -> list:
+        """
+        依次归还槽位，返回排队请求得到槽位的先后
+        """
+        order = []
+        while tickets:
+            slot.release()
+            for name, ticket in tickets:
+                if self.scheduler._dispatch(UPSTREAM, ticket, 1):
+                    order.append(name)
+                    tickets.remove((name, ticket))
+                    slot = SimpleNamespace(release=lambda ticket=ticket: self.scheduler.release(ticket))
+                    break
+        slot.release()
+        return order
+
+    def test_users_and_classes_share_fairly(self):
+        slot = self.scheduler.acquire(UPSTREAM, 'alice', 'batch')
+        tickets = []
+        # alice 先连续提交三个批量请求，随后 bob 提交一个批量请求、carol 提交一个交互式请求
+        for name, user, priority in [
+            ('alice-1', 'alice', 'batch'), ('alice-2', 'alice', 'batch'), ('alice-3', 'alice', 'batch'),
+            ('bob', 'bob', 'batch'), ('carol', 'carol', 'interactive'),
+        ]:
+            ticket = f'{name}-ticket'
+            weight = {'batch': 1, 'interactive': 4}[priority]
+            self.assertFalse(self.scheduler._enqueue(UPSTREAM, ticket, f'{priority}:{user}', weight, 1))
+            tickets.append((name, ticket))
+        self.assertEqual(self._drain(slot, tickets), ['carol', 'alice-1', 'bob', 'alice-2', 'alice-3'])
+
+    def test_queue_timeout_and_per_class_latency(self):
+        slot = self.scheduler.acquire(UPSTREAM, 'alice', 'interactive')
+        self.assertIsNone(self.scheduler.acquire('http://unlimited.test/v1', 'alice', 'interactive'))
+        with override_settings(UPSTREAM_QUEUE_TIMEOUT=0.1), self.assertRaises(UpstreamBusy):
+            self.scheduler.acquire(UPSTREAM, 'bob', 'batch')
+        self.assertIsNone(local_store.execute("SELECT 1 FROM upstream_queue WHERE upstream = ?", (UPSTREAM,)).fetchone())
+
+        # 归还后排队的请求得到槽位，等待时间按类别记录
+        waiting = threading.Thread(target=lambda: self.scheduler.acquire(UPSTREAM, 'bob', 'batch').release())
+        waiting.start()
+        time.sleep(0.2)
+        slot.release()
+        waiting.join(2)
+        self.assertFalse(waiting.is_alive())
+        self.assertGreaterEqual(metrics.snapshot()['summaries']['upstream_wait_seconds.batch']['max'], 0.2)
+        self.assertEqual(local_store.execute("SELECT COUNT(*) FROM upstream_slots WHERE upstream = ?", (UPSTREAM,)).fetchone()[0], 0)
+
+    def _flow_finish(self, flow: str):
+        row = local_store.execute(
+            "SELECT finish FROM upstream_flows WHERE upstream = ? AND flow = ?", (UPSTREAM, flow)
+        ).fetchone()
+        return row['finish'] if row is not None else None
+
+    def test_abandoned_tickets_do_not_charge_their_flow(self):
+        slot = self.scheduler.acquire(UPSTREAM, 'alice', 'interactive')
+        self.scheduler._enqueue(UPSTREAM, 'bob-1', 'batch:bob', 1, 1)
+        charged = self._flow_finish('batch:bob')
+        with override_settings(UPSTREAM_QUEUE_TIMEOUT=0.05), self.assertRaises(UpstreamBusy):
+            self.scheduler.acquire(UPSTREAM, 'bob', 'batch')
+        self.assertEqual(self._flow_finish('batch:bob'), charged)
+
+        # 放弃排在前面的请求时，同一流中排在后面的请求相应提前
+        self.scheduler._enqueue(UPSTREAM, 'bob-2', 'batch:bob', 1, 1)
+        self.scheduler._abandon('bob-1')
+        self.assertEqual(self._flow_finish('batch:bob'), charged)
+        row = local_store.execute("SELECT finish FROM upstream_queue WHERE ticket = 'bob-2'").fetchone()
+        self.assertEqual(row['finish'], charged)
+        self.scheduler._abandon('bob-2')
+        slot.release()
+
+    def test_async_acquire_cancelled_while_queued(self):
+        slot = self.scheduler.acquire(UPSTREAM, 'alice', 'interactive')
+        threads = []
+        execute = local_store.execute
+
+        def record(*args):
+            threads.append(threading.get_ident())
+            return execute(*args)
+
+        async def scenario():
+            threads.append(threading.get_ident())
+            task = asyncio.ensure_future(self.scheduler.aacquire(UPSTREAM, 'bob', 'batch'))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            with mock.patch.object(local_store, 'execute', record):
+                await slot.arelease()
+
+        async_to_sync(scenario)()
+        loop_thread, *writers = threads
+        self.assertTrue(writers)
+        self.assertNotIn(loop_thread, writers)
+        self.assertIsNone(local_store.execute("SELECT 1 FROM upstream_queue WHERE upstream = ?", (UPSTREAM,)).fetchone())
+        self.assertEqual(local_store.execute("SELECT COUNT(*) FROM upstream_slots WHERE upstream = ?", (UPSTREAM,)).fetchone()[0], 0)
+        # 退还后该流的完成时间不晚于虚拟时间，即视为空闲
+        vtime = local_store.execute("SELECT vtime FROM upstream_vtime WHERE upstream = ?", (UPSTREAM,)).fetchone()['vtime']
+        self.assertLessEqual(self._flow_finish('batch:bob'), vtime)
+
+    @override_settings(
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        UPSTREAM_SLOTS_OVERRIDES={UPSTREAM: 1}, MODEL_STREAM_USAGE=False
+    )
+    def test_model_talk_holds_slot_until_stream_ends(self):
+        Member.objects.create_user(username='frank', password='frank', department_name='IT')
+        Model_info.objects.create(show_name='queued', model_url=UPSTREAM + '/', model_key='key', model_name='gpt')
+        self.client.login(username='frank', password='frank')
+        completions = _FakeCompletions()
+        with mock.patch(
+            'GPT.interface.model_chat.get_client',
+            return_value=SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        ):
+            response = self.client.post('/GPT/modelTalk', {
+                'name': 'queued', 'command': 'talk', 'data': json.dumps({'messages': [{'role': 'user', 'content': 'hi'}]})
+            })
+            used = "SELECT COUNT(*) FROM upstream_slots WHERE upstream = ?"
+            self.assertEqual(local_store.execute(used, (UPSTREAM,)).fetchone()[0], 1)
+            b''.join(response.streaming_content)
+        self.assertEqual(local_store.execute(used, (UPSTREAM,)).fetchone()[0], 0)
+        self.assertEqual(len(completions.calls), 1)
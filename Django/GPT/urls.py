@@ -1,6 +1,16 @@
+from django.conf import settings
 from django.urls import path
 
-from .view import login,application,model,super
+from .view import login,application,model,super,export,bulk
+
+# ASGI 部署时使用异步对话视图，避免每个流式响应独占一个工作进程
+if settings.ASYNC_STREAMING:
+    app_talk_view = application.appTalkAsync
+    model_talk_view = model.modelTalkAsync
+else:
+    app_talk_view = application.appTalk
+    model_talk_view = model.modelTalk
+
 urlpatterns = [
     path("change_password",login.change_password,name="change_password"),
     path("validate",login.validate,name="validate"),
@@ -11,8 +21,8 @@ urlpatterns = [
     path("updateApp",application.updateApp,name="updateApp"),
     path("deleteApp",application.deleteApp,name="deleteApp"),
     path("get_application_info",application.get_application_info,name="get_application_info"),
-    path("appTalk",application.appTalk,name="appTalk"),
-    path("modelTalk",model.modelTalk,name="modelTalk"),
+    path("appTalk",app_talk_view,name="appTalk"),
+    path("modelTalk",model_talk_view,name="modelTalk"),
     # 超级用户管理相关路由
     path("get_model_info",super.get_model_info,name="get_model_info"),
     path("super_login",super.super_login,name="super_login"),
@@ -21,12 +31,19 @@ urlpatterns = [
     path("delete_user",super.delete_user,name="delete_user"),
     path("reset_password",super.reset_password,name="reset_password"),
     path("manage_user_applications",super.manage_user_applications,name="manage_user_applications"),
+    path("manage_department_applications",super.manage_department_applications,name="manage_department_applications"),
+    path("get_department_grants",super.get_department_grants,name="get_department_grants"),
     path("get_user_applications",super.get_user_applications,name="get_user_applications"),
     path("get_application_users",super.get_application_users,name="get_application_users"),
     path("get_all_users", super.get_all_users, name="get_all_users"),
+    path("bulk_users", bulk.bulk_users, name="bulk_users"),
+    path("bulk_memberships", bulk.bulk_memberships, name="bulk_memberships"),
     path("create_model",super.create_model,name="create_model"),
     path("update_model",super.update_model,name="update_model"),
     path("delete_model",super.delete_model,name="delete_model"),
+    path("get_metrics",super.get_metrics,name="get_metrics"),
+    path("get_usage",super.get_usage,name="get_usage"),
+    path("export_directory",export.export_directory,name="export_directory"),
     # 环境变量管理相关路由
     path("get_env_config",super.get_env_config,name="get_env_config"),
     path("update_frontend_env",super.update_frontend_env,name="update_frontend_env"),
@@ -0,0 +1,131 @@
+"""
+token 用量计量
+对话结束时上游报告的 usage 先记录到进程内缓冲区，由后台线程每 USAGE_FLUSH_INTERVAL 秒（或缓冲区满时）
+批量写入 UsageEvent，并在同一事务中累加到按小时汇总的 UsageHourly，请求本身不等待任何数据库写入
+"""
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import UsageEvent, UsageHourly
+from .write_queue import write_queue
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_KEY = ('hour', 'username', 'app', 'model')
+ROLLUP_SUMS = ('requests', 'prompt_tokens', 'completion_tokens', 'total_tokens')
+
+
+def _rollup_sql() -> str:
+    """
+    累加汇总的 upsert 语句（SQLite 3.24+ 与 PostgreSQL 语法相同）
+    """
+    quote = connection.ops.quote_name
+    columns = ROLLUP_KEY + ROLLUP_SUMS
+    return (
+        f'INSERT INTO {quote(UsageHourly._meta.db_table)} ({", ".join(quote(c) for c in columns)}) '
+        f'VALUES ({", ".join(["%s"] * len(columns))}) '
+        f'ON CONFLICT ({", ".join(quote(c) for c in ROLLUP_KEY)}) DO UPDATE SET '
+        + ', '.join(f'{quote(c)} = {quote(UsageHourly._meta.db_table)}.{quote(c)} + excluded.{quote(c)}' for c in ROLLUP_SUMS)
+    )
+
+
+def write_events(events: list):
+    """
+    写入一批用量记录并累加到小时汇总
+    """
+    UsageEvent.objects.bulk_create(events, batch_size=500)
+    rollups = defaultdict(lambda: [0, 0, 0, 0])
+    for event in events:
+        hour = event.created.replace(minute=0, second=0, microsecond=0)
+        sums = rollups[(hour, event.username, event.app, event.model)]
+        sums[0] += 1
+        sums[1] += event.prompt_tokens
+        sums[2] += event.completion_tokens
+        sums[3] += event.total_tokens
+    with connection.cursor() as cursor:
+        cursor.executemany(_rollup_sql(), [
+            (connection.ops.adapt_datetimefield_value(hour), username, app, model, *sums)
+            for (hour, username, app, model), sums in rollups.items()
+        ])
+
+
+class UsageMeter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, username: str, kind: str, app: str = '', model: str = '',
+               prompt_tokens: int = 0, completion_tokens: int = 0, total_tokens: int = 0):
+        """
+        记录一次对话的用量，只写入内存，可在事件循环中直接调用
+        """
+        event = UsageEvent(
+            created=timezone.now(),
+            username=username,
+            kind=kind,
+            app=app or '',
+            model=model or '',
+            prompt_tokens=prompt_tokens or 0,
+            completion_tokens=completion_tokens or 0,
+            total_tokens=total_tokens or (prompt_tokens or 0) + (completion_tokens or 0)
+        )
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= settings.USAGE_BUFFER_SIZE
+        metrics.incr('usage_events_recorded')
+        if settings.USAGE_FLUSH_INTERVAL <= 0:
+            # 关闭后台刷新时只在缓冲区满时写入
+            if full:
+                self.flush()
+            return
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='usage-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(settings.USAGE_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        把缓冲区中的记录写入数据库，返回写入的条数；写入失败时记录放回缓冲区，下次重试
+        """
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return 0
+        try:
+            write_queue.run(write_events, events)
+        except Exception:
+            logger.exception('用量写入失败')
+            metrics.incr('usage_flush_failed')
+            with self._lock:
+                # 数据库长时间不可用时只保留最近的记录，避免内存无限增长
+                self._events = (events + self._events)[-settings.USAGE_BUFFER_SIZE * 10:]
+            return 0
+        metrics.incr('usage_events_flushed', len(events))
+        return len(events)
+
+
+usage_meter = UsageMeter()
+# 进程正常退出时写入缓冲区中剩余的记录
+atexit.register(usage_meter.flush)
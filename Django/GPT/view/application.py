@@ -1,23 +1,38 @@
 from django.http import JsonResponse, StreamingHttpResponse
-from ..models import Application
+from ..models import Application, ApplicationGrant, Member
+from django.db.models import Count
+from django.db import transaction
 import json
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from ..interface.dify_agent import DifyAgent
 from ..interface.dify_workflow import DifyWorkflow
-from .login import login_check
+from ..interface.dify_parameters import get_parameters
+from ..admission import Rejected, aadmit, admit, rejected_response
+from ..config_registry import config_registry
+from ..load_shed import shed_load
+from ..entitlements import entitlements
+from .login import login_check, superuser_check
+from ..db_router import read_replica
+from .bulk import assign_memberships
 import requests
+from asgiref.sync import sync_to_async
 
 @csrf_protect
+@read_replica
 def getApps(request):
     if request.method == 'GET':
         try:
             # 直接使用已登录用户的信息
             user = request.user
             
-            # 获取用户关联的应用
-            applications = user.application.all()
+            # 获取用户关联的应用（权限与应用配置均来自缓存）
+            applications = []
+            for name in sorted(entitlements.applications(user)):
+                app = config_registry.get_application(name)
+                if app is not None:
+                    applications.append(app)
             
             # 构建应用列表，包含更多信息
             application_list = []
@@ -45,6 +60,8 @@ def getApps(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
+@read_replica
 def getAllApps(request):
     """
     获取所有应用列表接口（管理员专用）
@@ -56,15 +73,8 @@ def getAllApps(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
-        # 获取所有应用
-        applications = Application.objects.all()
+        # 获取所有应用，成员数量在同一条查询中统计
+        applications = Application.objects.annotate(member_count=Count('member'))
         
         # 构建应用列表
         application_list = []
@@ -74,7 +84,7 @@ def getAllApps(request):
                 'api_url': app.api_url,
                 'type': app.type,
                 'icon': app.icon,
-                'member_count': app.member.count()
+                'member_count': app.member_count
             }
             application_list.append(app_info)
         
@@ -105,46 +115,23 @@ def get_application_info(request):
                     "message": "缺少应用名称参数"
                 }, status=400)
             # 验证用户是否有权限访问该应用
-            if not request.user.application.filter(name=data['application_name']).exists():
+            if not entitlements.has_application(request.user, data['application_name']):
                 return JsonResponse({
                     "status": "error",
                     "message": "您没有权限访问该应用"
                 }, status=403)
 
             # 获取应用信息
-            try:
-                application = Application.objects.get(name=data['application_name'])
-            except Application.DoesNotExist:
+            application = config_registry.get_application(data['application_name'])
+            if application is None:
                 return JsonResponse({
                     "status": "error",
                     "message": "未找到该应用"
                 }, status=404)
 
-            # 创建请求头
-            headers = {
-                "Authorization": f"Bearer {application.api_key}",
-                "Content-Type": "application/json"
-            }
-            print({application.api_url})
-            print(application.api_key)
-            # 获取基本信息
-            info_response = requests.get(
-                f"{application.api_url}/parameters",
-                headers=headers
-            )
-            info_response.raise_for_status()
-            info_data = info_response.json()
+            # 应用参数在所有 worker 间共享缓存，不再每次打开应用都请求上游
+            params_data = get_parameters(application)
 
-            # 获取参数信息
-            params_response = requests.get(
-                f"{application.api_url}/parameters", 
-                headers=headers
-            )
-            params_response.raise_for_status()
-            params_data = params_response.json()
-            for key,value in info_data.items():
-                params_data[key] = value
-            
             # 整合返回数据
             return JsonResponse({
                 "status": "success",
@@ -167,10 +154,31 @@ def get_application_info(request):
             "message": "仅支持GET请求"
         }, status=405)
 
+def _create_agent(application, data, username):
+    """
+    根据应用类型创建相应的代理实例，不支持的类型返回 None
+    """
+    agent_classes = {
+        "dify_agent": DifyAgent,
+        "dify_workflow": DifyWorkflow,
+    }
+    agent_class = agent_classes.get(application.type)
+    if agent_class is None:
+        return None
+    return agent_class(
+        url=application.api_url,
+        api_key=application.api_key,
+        data=data,
+        user=username,
+        app=application.name
+    )
+
 @csrf_exempt
 @login_check
 @require_http_methods(['POST'])
+@shed_load
 def appTalk(request):
+    lease = None
     try:
         data = request.POST.dict()
         # 验证必要参数
@@ -183,57 +191,122 @@ def appTalk(request):
                 }], status=400)
         
         # 获取应用信息
-        try:
-            application = Application.objects.get(name=data['application_name'])
-        except Application.DoesNotExist:
+        application = config_registry.get_application(data['application_name'])
+        if application is None:
             return StreamingHttpResponse([{
                 "status": "error",
                 "message": "Application not found"
             }], status=404)
+        # 验证用户是否有权限访问该应用
+        if not entitlements.has_application(request.user, application.name):
+            return StreamingHttpResponse([{
+                "status": "error",
+                "message": "Permission denied"
+            }], status=403)
         
         # 根据应用类型创建相应的代理实例
-        if application.type == "dify_agent":
-            agent = DifyAgent(
-                url=application.api_url,
-                api_key=application.api_key,
-                data=json.loads(data.get('data')),
-                user=request.user.username
-            )
-        elif application.type == "dify_workflow":
-            agent = DifyWorkflow(
-                url=application.api_url,
-                api_key=application.api_key,
-                data=json.loads(data.get('data')),
-                user=request.user.username
-            )
-        else:
+        agent = _create_agent(application, json.loads(data.get('data')), request.user.username)
+        if agent is None:
             return StreamingHttpResponse([{
                 "status": "error",
                 "message": "Unsupported application type"
             }], status=400)
         # 根据命令执行相应操作
         if data['command'] == 'talk':
-            response = agent.talk()
-            return response
+            try:
+                # 在调用上游之前检查限速和并发数，流结束时释放并发名额
+                lease = admit(request.user.username, app=application.name)
+            except Rejected as error:
+                return rejected_response(error)
+            response = agent.schedule_talk()
+            return lease.hold(response)
         elif data['command'] == 'stop':
-            response = agent.stop()
-            return response
+            return JsonResponse(agent.stop())
         else:
             return StreamingHttpResponse([{
                 "status": "error",
                 "message": "Invalid command"
             }], status=400)
     except Exception as e:
+        if lease is not None:
+            lease.release()
         return StreamingHttpResponse([{
             "status": "error",
             "message": f"An error occurred: {str(e)}"
         }], status=500)
 
+@csrf_exempt
+@login_check
+@require_http_methods(['POST'])
+@shed_load
+async def appTalkAsync(request):
+    """
+    appTalk 的异步版本，ASGI 部署时由 urls.py 替换 appTalk 路由
+    一个 worker 即可同时转发大量 SSE 流
+    """
+    lease = None
+    try:
+        data = request.POST.dict()
+        # 验证必要参数
+        required_fields = ['application_name', 'data', 'command']
+        for field in required_fields:
+            if field not in data:
+                return JsonResponse({
+                    "status": "error",
+                    "message": f"Missing required field: {field}"
+                }, status=400)
+
+        # 获取应用信息
+        application = await config_registry.aget_application(data['application_name'])
+        if application is None:
+            return JsonResponse({
+                "status": "error",
+                "message": "Application not found"
+            }, status=404)
+
+        user = await request.auser()
+        # 验证用户是否有权限访问该应用
+        if not await entitlements.ahas_application(user, application.name):
+            return JsonResponse({
+                "status": "error",
+                "message": "Permission denied"
+            }, status=403)
+        agent = _create_agent(application, json.loads(data.get('data')), user.username)
+        if agent is None:
+            return JsonResponse({
+                "status": "error",
+                "message": "Unsupported application type"
+            }, status=400)
+        # 根据命令执行相应操作
+        if data['command'] == 'talk':
+            try:
+                lease = await aadmit(user.username, app=application.name)
+            except Rejected as error:
+                return rejected_response(error)
+            return await lease.ahold(await agent.aschedule_talk())
+        elif data['command'] == 'stop':
+            result = await sync_to_async(agent.stop)()
+            return JsonResponse(result)
+        else:
+            return JsonResponse({
+                "status": "error",
+                "message": "Invalid command"
+            }, status=400)
+    except Exception as e:
+        if lease is not None:
+            await lease.arelease()
+        return JsonResponse({
+            "status": "error",
+            "message": f"An error occurred: {str(e)}"
+        }, status=500)
+
 @csrf_exempt
 @login_required
+@superuser_check
 def createApp(request):
     """
     创建新应用接口
+    可选字段 usernames（用户名列表）和 department_names（部门列表）在创建的同时授予访问权限
     """
     if request.method != 'POST':
         return JsonResponse({
@@ -242,19 +315,14 @@ def createApp(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         name = data.get('name')
         api_url = data.get('api_url')
         api_key = data.get('api_key')
         app_type = data.get('type')
         icon = data.get('icon', 'MessageSquare')
+        usernames = data.get('usernames') or []
+        department_names = data.get('department_names') or []
         
         # 验证必填字段
         if not all([name, api_url, api_key, app_type]):
@@ -262,6 +330,14 @@ def createApp(request):
                 'status': 'error',
                 'message': '应用名称、API URL、API Key和类型不能为空'
             }, status=400)
+
+        users = Member.objects.filter(username__in=usernames)
+        missing_users = set(usernames) - set(users.values_list('username', flat=True))
+        if missing_users:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'以下用户不存在: {", ".join(sorted(missing_users))}'
+            }, status=400)
         
         # 检查应用名称是否已存在
         if Application.objects.filter(name=name).exists():
@@ -270,14 +346,23 @@ def createApp(request):
                 'message': '应用名称已存在'
             }, status=400)
         
-        # 创建应用
-        application = Application.objects.create(
-            name=name,
-            api_url=api_url,
-            api_key=api_key,
-            type=app_type,
-            icon=icon
-        )
+        # 创建应用，并在同一个事务中写入授权
+        with transaction.atomic():
+            application = Application.objects.create(
+                name=name,
+                api_url=api_url,
+                api_key=api_key,
+                type=app_type,
+                icon=icon
+            )
+            if usernames:
+                assign_memberships(users, [application.name], request.user)
+            ApplicationGrant.objects.bulk_create([
+                ApplicationGrant(department_name=department, application=application, granted_by=request.user)
+                for department in set(department_names) if department
+            ])
+        if usernames or department_names:
+            entitlements.invalidate()
         
         return JsonResponse({
             'status': 'success',
@@ -298,6 +383,7 @@ def createApp(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def updateApp(request):
     """
     更新应用接口
@@ -309,13 +395,6 @@ def updateApp(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         name = data.get('name')
         
@@ -364,6 +443,7 @@ def updateApp(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def deleteApp(request):
     """
     删除应用接口
@@ -375,13 +455,6 @@ def deleteApp(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         name = data.get('name')
         
@@ -0,0 +1,376 @@
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.contrib.auth.decorators import login_required
+from django.db import connection, transaction
+from django.db.models.constants import OnConflict
+from django.utils import timezone
+from ..models import Member, Application, Membership
+from ..auth_cache import auth_cache
+from ..entitlements import entitlements
+from ..passwords import hash_passwords
+from .login import superuser_check
+from .super import filter_users
+import csv
+import io
+import json
+
+BULK_ACTIONS = ('create', 'update', 'deactivate', 'delete')
+UPDATE_FIELDS = ('email', 'department_name', 'is_active')
+MEMBERSHIP_ACTIONS = ('assign', 'revoke')
+USER_FILTER_FIELDS = ('department', 'is_active', 'is_superuser', 'q')
+# CSV 中 applications 列填写该值表示清空用户的全部应用授权（空单元格表示不修改）
+CLEAR_APPLICATIONS = '-'
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', '是')
+
+
+def _parse_rows(request):
+    """
+    读取批量操作的用户列表，返回 (action, rows)
+    支持两种格式：
+    - JSON：{"action": "create", "users": [{"username": ..., "applications": [...]}, ...]}
+    - CSV 文件上传：表单字段 action + 文件字段 file，表头为字段名，applications 列用分号分隔；
+      空单元格视为未提供该字段（update 时保持原值），applications 列填 - 表示清空授权
+    """
+    if request.content_type == 'multipart/form-data':
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValueError('缺少上传文件 file')
+        text = io.TextIOWrapper(upload.file, encoding='utf-8-sig')
+        rows = []
+        for row in csv.DictReader(text):
+            row = {key.strip(): (value or '').strip() for key, value in row.items() if key}
+            row = {key: value for key, value in row.items() if value}
+            if 'applications' in row:
+                applications = row['applications']
+                row['applications'] = [] if applications == CLEAR_APPLICATIONS else [
+                    name.strip() for name in applications.split(';') if name.strip()
+                ]
+            rows.append(row)
+        return request.POST.get('action'), rows
+    data = json.loads(request.body)
+    users = data.get('users')
+    if not isinstance(users, list):
+        raise ValueError('users 必须是列表')
+    return data.get('action'), users
+
+
+def _validate(action, rows, request_user):
+    """
+    逐行校验，返回 (有效行, 错误列表)；错误中的 row 为从 1 开始的行号
+    """
+    errors = []
+    valid = []
+    usernames = [str(row.get('username') or '').strip() for row in rows]
+    existing = {
+        user.username: user
+        for user in Member.objects.filter(username__in=[name for name in usernames if name])
+    }
+    application_names = set()
+    for row in rows:
+        application_names.update(row.get('applications') or [])
+    known_applications = set(
+        Application.objects.filter(name__in=application_names).values_list('name', flat=True)
+    )
+    seen = set()
+    for index, (row, username) in enumerate(zip(rows, usernames), start=1):
+        def error(message):
+            errors.append({'row': index, 'username': username, 'message': message})
+
+        if not username:
+            error('用户名不能为空')
+            continue
+        if username in seen:
+            error('用户名重复')
+            continue
+        seen.add(username)
+        missing_apps = set(row.get('applications') or []) - known_applications
+        if missing_apps:
+            error(f'以下应用不存在: {", ".join(sorted(missing_apps))}')
+            continue
+        if action == 'create':
+            if username in existing:
+                error('用户名已存在')
+                continue
+            if not row.get('password') or not row.get('department_name'):
+                error('密码和部门名称不能为空')
+                continue
+        else:
+            user = existing.get(username)
+            if user is None:
+                error('用户不存在')
+                continue
+            # update 中把 is_active 设为 false 同样是停用
+            deactivating = action in ('deactivate', 'delete') or (
+                action == 'update' and 'is_active' in row and not _parse_bool(row['is_active'])
+            )
+            if deactivating:
+                if username == request_user.username:
+                    error('不能停用或删除当前登录的用户')
+                    continue
+                if user.is_superuser:
+                    error('不能停用或删除超级用户')
+                    continue
+            row = dict(row, user=user)
+        valid.append(dict(row, username=username))
+    return valid, errors
+
+
+def _grant(users_and_apps, granted_by):
+    """
+    批量写入用户-应用授权，users_and_apps 为 (用户, 应用名列表)
+    """
+    now = timezone.now()
+    memberships = [
+        Membership(member_id=user.pk, application_id=name, granted_at=now, granted_by=granted_by)
+        for user, application_names in users_and_apps
+        for name in application_names
+    ]
+    Membership.objects.bulk_create(memberships, ignore_conflicts=True, batch_size=1000)
+
+
+def assign_memberships(users, application_names, granted_by):
+    """
+    把 application_names 中的应用授予 users（Member 查询集）中的所有用户，已有的授权保持不变
+    用一条 INSERT ... SELECT 在数据库端生成 用户×应用 的组合，不把用户逐个读到内存中
+    """
+    user_sql, user_params = users.values('pk').query.sql_with_params()
+    app_sql, app_params = Application.objects.filter(name__in=application_names).values('pk').query.sql_with_params()
+    fields = [Membership._meta.get_field(name) for name in ('member', 'application', 'granted_at', 'granted_by')]
+    quote = connection.ops.quote_name
+    pk = quote('pk')
+    sql = (
+        f'{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} {quote(Membership._meta.db_table)} '
+        f'({", ".join(quote(field.column) for field in fields)}) '
+        f'SELECT u.{pk}, a.{pk}, %s, %s '
+        f'FROM ({user_sql}) u CROSS JOIN ({app_sql}) a '
+        f'{connection.ops.on_conflict_suffix_sql(fields, OnConflict.IGNORE, None, None)}'
+    )
+    granted_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (granted_at, granted_by.pk if granted_by else None, *user_params, *app_params))
+        return cursor.rowcount
+
+
+def _revoke_all(user_ids):
+    Membership.objects.filter(member_id__in=user_ids).delete()
+
+
+def _bulk_create(rows, granted_by):
+    passwords = hash_passwords([row['password'] for row in rows])
+    now = timezone.now()
+    users = [
+        Member(
+            username=Member.normalize_username(row['username']),
+            password=password,
+            email=Member.objects.normalize_email(row.get('email', '')),
+            department_name=row['department_name'],
+            is_active=_parse_bool(row.get('is_active', True)),
+            date_joined=now
+        )
+        for row, password in zip(rows, passwords)
+    ]
+    Member.objects.bulk_create(users, batch_size=1000)
+    # 部分数据库不会为 bulk_create 回填主键，重新查询一次
+    ids = dict(Member.objects.filter(username__in=[user.username for user in users]).values_list('username', 'id'))
+    for user in users:
+        user.pk = ids[user.username]
+    _grant(((user, row.get('applications') or []) for user, row in zip(users, rows)), granted_by)
+
+
+def _bulk_update(rows, granted_by):
+    users = []
+    fields = set()
+    for row in rows:
+        user = row['user']
+        for field in UPDATE_FIELDS:
+            if field in row:
+                value = _parse_bool(row[field]) if field == 'is_active' else row[field]
+                setattr(user, field, value)
+                fields.add(field)
+        users.append(user)
+    with_password = [row for row in rows if row.get('password')]
+    if with_password:
+        for row, password in zip(with_password, hash_passwords([row['password'] for row in with_password])):
+            row['user'].password = password
+        fields.add('password')
+    if fields:
+        Member.objects.bulk_update(users, sorted(fields), batch_size=1000)
+    # 提供了 applications 的行用新的应用列表替换原有授权
+    replaced = [row for row in rows if 'applications' in row]
+    if replaced:
+        _revoke_all([row['user'].pk for row in replaced])
+        _grant(((row['user'], row['applications']) for row in replaced), granted_by)
+
+
+@csrf_exempt
+@login_required
+@superuser_check
+def bulk_users(request):
+    """
+    批量用户操作接口（管理员专用）
+    action:
+        create: 创建用户，需要 username、password、department_name，可选 email、is_active、applications
+        update: 更新用户，可选 email、department_name、is_active、password、applications（替换原有授权）
+        deactivate: 停用用户
+        delete: 删除用户（与 delete_user 相同，停用并清空应用权限）
+    有效行在同一个事务中批量写入，无效行不影响其他行，逐行返回错误
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': '请使用POST方法'
+        }, status=405)
+
+    try:
+        try:
+            action, rows = _parse_rows(request)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'无法解析用户列表: {str(e)}'
+            }, status=400)
+        if action not in BULK_ACTIONS:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'操作类型必须是 {" / ".join(BULK_ACTIONS)} 之一'
+            }, status=400)
+
+        valid, errors = _validate(action, rows, request.user)
+        if valid:
+            with transaction.atomic():
+                if action == 'create':
+                    _bulk_create(valid, request.user)
+                elif action == 'update':
+                    _bulk_update(valid, request.user)
+                else:
+                    user_ids = [row['user'].pk for row in valid]
+                    Member.objects.filter(pk__in=user_ids).update(is_active=False)
+                    if action == 'delete':
+                        _revoke_all(user_ids)
+                # 直接写关联表不会触发 m2m_changed，需要手动让权限缓存失效
+                transaction.on_commit(entitlements.invalidate)
+                # bulk_update / update 不会触发 post_save，已缓存的登录用户也需要失效
+                transaction.on_commit(auth_cache.invalidate)
+
+        return JsonResponse({
+            'status': 'success',
+            'message': f'成功处理 {len(valid)} 个用户，失败 {len(errors)} 个',
+            'action': action,
+            'succeeded': [row['username'] for row in valid],
+            'errors': errors
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'批量操作失败: {str(e)}'
+        }, status=500)
+
+
+def _resolve_members(data):
+    """
+    根据 usernames 或 filter 解析目标用户，返回 (用户查询集, 不存在的用户名)
+    """
+    usernames = data.get('usernames')
+    user_filter = data.get('filter')
+    if bool(usernames) == bool(user_filter):
+        raise ValueError('usernames 与 filter 必须且只能提供一个')
+    if usernames:
+        if not isinstance(usernames, list):
+            raise ValueError('usernames 必须是列表')
+        users = Member.objects.filter(username__in=usernames)
+        return users, sorted(set(usernames) - set(users.values_list('username', flat=True)))
+    if not isinstance(user_filter, dict) or not set(user_filter) <= set(USER_FILTER_FIELDS):
+        raise ValueError(f'filter 只支持 {" / ".join(USER_FILTER_FIELDS)}')
+    return filter_users(Member.objects.all(), user_filter), []
+
+
+@csrf_exempt
+@login_required
+@superuser_check
+def bulk_memberships(request):
+    """
+    批量授予或撤销应用权限接口（管理员专用）
+    请求体格式：
+    {
+        "action": "assign" 或 "revoke",
+        "applications": ["应用1", "应用2"],
+        "usernames": ["用户1", "用户2"],  # 与 filter 二选一
+        "filter": {"department": "研发部", "is_active": true, "is_superuser": false, "q": "前缀"}
+    }
+    M 个应用 × N 个用户在同一个事务中用一条 INSERT ... SELECT 或一条 DELETE 完成，任一用户名不存在时不做任何修改
+    memberships 为实际新增或删除的授权数
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': '请使用POST方法'
+        }, status=405)
+
+    try:
+        data = json.loads(request.body)
+        action = data.get('action')
+        application_names = data.get('applications')
+        if action not in MEMBERSHIP_ACTIONS:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'操作类型必须是 {" / ".join(MEMBERSHIP_ACTIONS)} 之一'
+            }, status=400)
+        if not application_names or not isinstance(application_names, list):
+            return JsonResponse({
+                'status': 'error',
+                'message': '应用列表不能为空'
+            }, status=400)
+
+        missing_apps = set(application_names) - set(
+            Application.objects.filter(name__in=application_names).values_list('name', flat=True)
+        )
+        if missing_apps:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'以下应用不存在: {", ".join(sorted(missing_apps))}'
+            }, status=400)
+
+        try:
+            users, missing_users = _resolve_members(data)
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e)
+            }, status=400)
+        if missing_users:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'以下用户不存在: {", ".join(missing_users)}'
+            }, status=400)
+
+        with transaction.atomic():
+            user_count = users.count()
+            if action == 'assign':
+                affected = assign_memberships(users, application_names, request.user)
+            else:
+                affected, _ = Membership.objects.filter(
+                    member__in=users, application_id__in=application_names
+                ).delete()
+        # 直接写关联表不会触发 m2m_changed，需要手动让权限缓存失效
+        entitlements.invalidate()
+
+        return JsonResponse({
+            'status': 'success',
+            'message': f'已为 {user_count} 个用户{"授予" if action == "assign" else "撤销"} {len(application_names)} 个应用',
+            'action': action,
+            'users': user_count,
+            'applications': application_names,
+            'memberships': affected
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'批量授权失败: {str(e)}'
+        }, status=500)
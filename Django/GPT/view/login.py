@@ -1,7 +1,9 @@
 from django.http import JsonResponse, StreamingHttpResponse
 from django.contrib.auth import authenticate, login, logout
 import re
+import asyncio
 import json
+from functools import wraps
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from ..models import Member,Application,Model_info
@@ -11,6 +13,16 @@ from ..interface.dify_workflow import DifyWorkflow
 from ..interface.model_chat import ModelChat
 
 def login_check(view_func):
+    if asyncio.iscoroutinefunction(view_func):
+        # 异步视图中不能同步访问 request.user，需要使用 auser()
+        async def async_wrapper(request, *args, **kwargs):
+            user = await request.auser()
+            if user.is_authenticated:
+                return await view_func(request, *args, **kwargs)
+            else:
+                return StreamingHttpResponse({'message': '未登录，请先登录', 'status': 'error'}, status=401)
+        return async_wrapper
+
     def wrapper(request, *args, **kwargs):
         if request.user.is_authenticated:
             return view_func(request, *args, **kwargs)
@@ -18,6 +30,20 @@ def login_check(view_func):
             return StreamingHttpResponse({'message': '未登录，请先登录', 'status': 'error'}, status=401)
     return wrapper
 
+def superuser_check(view_func):
+    """
+    管理接口的超级用户校验，需放在 login_required 之后
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_superuser:
+            return JsonResponse({
+                'status': 'error',
+                'message': '需要超级用户权限'
+            }, status=403)
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
 @csrf_exempt
 def validate(request):
     if request.method == 'POST':
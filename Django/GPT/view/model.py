@@ -1,15 +1,54 @@
 from django.http import StreamingHttpResponse, JsonResponse
-from ..models import Model_info
 import json
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from ..interface.model_chat import ModelChat
+from ..admission import Rejected, aadmit, admit, rejected_response
+from ..config_registry import config_registry
+from ..load_shed import shed_load
+from ..conversations import conversation_store
+from ..models import Conversation
 from .login import login_check
 
+def _conversation_context(payload: dict, user, model: str):
+    """
+    payload 中带 message（本轮的新消息）时，由服务端保存的对话重建 messages，返回 (conversation_id, 历史条数)；
+    不带 conversation_id 时新建对话；对话不属于当前用户时抛出 Conversation.DoesNotExist。
+    没有 message 时沿用前端提交的完整 messages
+    """
+    if 'message' not in payload:
+        return None, 0
+    message = payload.pop('message')
+    if isinstance(message, str):
+        message = {'role': 'user', 'content': message}
+    conversation_id = payload.get('conversation_id')
+    if conversation_id:
+        if not Conversation.objects.filter(pk=conversation_id, member=user).exists():
+            raise Conversation.DoesNotExist
+        history = conversation_store.history(conversation_id)
+    else:
+        conversation_id = conversation_store.create(user, model)
+        history = []
+    payload['messages'] = history + [message]
+    return conversation_id, len(history)
+
+def _conversation_not_found():
+    return StreamingHttpResponse(
+        [json.dumps({
+            "status": "error",
+            "message": "Conversation not found"
+        })],
+        content_type='text/event-stream',
+        status=404
+    )
+
 @csrf_exempt
 @login_check
 @require_http_methods(['POST'])
+@shed_load
 def modelTalk(request):
+    lease = None
     try:
         data = request.POST.dict()
         required_fields = ['name', 'data', 'command']
@@ -23,46 +62,66 @@ def modelTalk(request):
                     content_type='text/event-stream',
                     status=400
                 )
-        if data['command'] == 'talk':
-            try:
-                model_info = Model_info.objects.get(show_name=data['name'])
-            except Model_info.DoesNotExist:
-                return StreamingHttpResponse(
-                    [json.dumps({
-                        "status": "error",
-                        "message": "Model not found"
-                    })],
-                    content_type='text/event-stream',
-                    status=404
-                )
-            agent = ModelChat(
-                model_name=model_info.model_name,
-                url=model_info.model_url,
-                api_key=model_info.model_key,
-                data=json.loads(data.get('data')),
-                user=request.user.username
-            )
-            response = agent.talk()
-            return response  # 直接返回agent.talk()的结果，因为它已经是StreamingHttpResponse
-        elif data['command'] == 'stop':
+        if data['command'] not in ('talk', 'stop'):
             return StreamingHttpResponse(
                 [json.dumps({
-                    "status": "success",
-                    "message": "Stop command received"
+                    "status": "error",
+                    "message": "Invalid command"
                 })],
                 content_type='text/event-stream',
-                status=200
+                status=400
             )
-        else:
+        model_info = config_registry.get_model(data['name'])
+        if model_info is None:
             return StreamingHttpResponse(
                 [json.dumps({
                     "status": "error",
-                    "message": "Invalid command"
+                    "message": "Model not found"
                 })],
                 content_type='text/event-stream',
-                status=400
+                status=404
+            )
+        payload = json.loads(data.get('data'))
+        conversation_id, history_size = None, 0
+        if data['command'] == 'talk':
+            try:
+                # 在建立对话和调用上游之前检查限速和并发数
+                lease = admit(request.user.username, model=data['name'])
+            except Rejected as error:
+                return rejected_response(error)
+            try:
+                conversation_id, history_size = _conversation_context(payload, request.user, data['name'])
+            except Conversation.DoesNotExist:
+                lease.release()
+                return _conversation_not_found()
+        agent = ModelChat(
+            model_name=model_info.model_name,
+            url=model_info.model_url,
+            api_key=model_info.model_key,
+            data=payload,
+            user=request.user.username,
+            conversation_id=conversation_id,
+            history_size=history_size,
+            context_window=model_info.context_window
+        )
+        if data['command'] == 'talk':
+            response = agent.schedule_talk()
+            if conversation_id is not None:
+                # 前端下一轮只需提交 conversation_id 和新消息
+                response['X-Conversation-Id'] = conversation_id
+            # 流结束时释放并发名额
+            return lease.hold(response)  # 直接返回agent.schedule_talk()的结果，因为它已经是StreamingHttpResponse
+        else:
+            # 停止命令可以在 data 中带上 talk 响应头 X-Stream-Id 返回的 stream_id，没有时停止当前用户在该模型下最近的流
+            result = agent.stop()
+            return StreamingHttpResponse(
+                [json.dumps(result)],
+                content_type='text/event-stream',
+                status=200 if result['status'] == 'success' else 404
             )
     except Exception as e:
+        if lease is not None:
+            lease.release()
         return StreamingHttpResponse(
             [json.dumps({
                 "status": "error",
@@ -71,3 +130,74 @@ def modelTalk(request):
             content_type='text/event-stream',
             status=500
         )
+
+@csrf_exempt
+@login_check
+@require_http_methods(['POST'])
+@shed_load
+async def modelTalkAsync(request):
+    """
+    modelTalk 的异步版本，ASGI 部署时由 urls.py 替换 modelTalk 路由
+    """
+    lease = None
+    try:
+        data = request.POST.dict()
+        required_fields = ['name', 'data', 'command']
+        for field in required_fields:
+            if field not in data:
+                return JsonResponse({
+                    "status": "error",
+                    "message": f"Missing required field: {field}"
+                }, status=400)
+        if data['command'] not in ('talk', 'stop'):
+            return JsonResponse({
+                "status": "error",
+                "message": "Invalid command"
+            }, status=400)
+        model_info = await config_registry.aget_model(data['name'])
+        if model_info is None:
+            return JsonResponse({
+                "status": "error",
+                "message": "Model not found"
+            }, status=404)
+        user = await request.auser()
+        payload = json.loads(data.get('data'))
+        conversation_id, history_size = None, 0
+        if data['command'] == 'talk':
+            try:
+                lease = await aadmit(user.username, model=data['name'])
+            except Rejected as error:
+                return rejected_response(error)
+            try:
+                conversation_id, history_size = await sync_to_async(_conversation_context)(payload, user, data['name'])
+            except Conversation.DoesNotExist:
+                await lease.arelease()
+                return JsonResponse({
+                    "status": "error",
+                    "message": "Conversation not found"
+                }, status=404)
+        agent = ModelChat(
+            model_name=model_info.model_name,
+            url=model_info.model_url,
+            api_key=model_info.model_key,
+            data=payload,
+            user=user.username,
+            conversation_id=conversation_id,
+            history_size=history_size,
+            context_window=model_info.context_window
+        )
+        if data['command'] == 'talk':
+            response = await agent.aschedule_talk()
+            if conversation_id is not None:
+                response['X-Conversation-Id'] = conversation_id
+            return await lease.ahold(response)
+        else:
+            result = await sync_to_async(agent.stop)()
+            return JsonResponse(result, status=200 if result['status'] == 'success' else 404)
+    except Exception as e:
+        if lease is not None:
+            await lease.arelease()
+        return JsonResponse({
+            "status": "error",
+            "message": f"An error occurred: {str(e)}"
+        }, status=500)
@@ -1,12 +1,25 @@
 from django.http import JsonResponse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
 from django.contrib.auth import authenticate, login
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
-from ..models import Member, Application, Model_info
+from ..models import Member, Application, ApplicationGrant, Model_info, UsageHourly
+from ..entitlements import entitlements
+from ..interface.http_pool import pool_stats
+from ..interface import openai_clients
+from ..metrics import metrics
+from .login import superuser_check
+from ..db_router import read_replica
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 import json
+import base64
+from datetime import datetime
+from django.db.models import Q, Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+from datetime import timedelta
+from django.db import transaction
 
 @csrf_exempt
 def super_login(request):
@@ -53,6 +66,7 @@ def super_login(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def create_user(request):
     """
     创建新用户接口
@@ -72,13 +86,6 @@ def create_user(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         username = data.get('username')
         password = data.get('password')
@@ -120,7 +127,7 @@ def create_user(request):
                         'status': 'error',
                         'message': f'以下应用不存在: {", ".join(missing_apps)}'
                     }, status=400)
-                user.application.set(applications)
+                user.application.set(applications, through_defaults={'granted_by': request.user})
             except Exception as e:
                 # 如果设置应用时出错，删除已创建的用户
                 user.delete()
@@ -135,7 +142,7 @@ def create_user(request):
             'user_id': user.id,
             'username': user.username,
             'department_name': user.department_name,
-            'applications': [app.name for app in user.application.all()]
+            'applications': list(user.application.values_list('name', flat=True))
         })
     except Exception as e:
         return JsonResponse({
@@ -145,6 +152,7 @@ def create_user(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def reset_password(request):
     """
     重置用户密码接口
@@ -156,13 +164,6 @@ def reset_password(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         username = data.get('username')
         new_password = data.get('new_password')
@@ -195,6 +196,7 @@ def reset_password(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def manage_user_applications(request):
     """
     管理用户应用权限接口
@@ -212,13 +214,6 @@ def manage_user_applications(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         username = data.get('username')
         action = data.get('action')
@@ -255,22 +250,16 @@ def manage_user_applications(request):
             
             # 执行添加或移除操作
             if action == 'add':
-                # 添加用户到应用的成员列表
-                for app in applications:
-                    app.member.add(user)
-                # 添加应用到用户的权限列表
-                user.application.add(*applications)
+                # 添加应用到用户的权限列表，并记录授权人
+                user.application.add(*applications, through_defaults={'granted_by': request.user})
                 message = '应用权限添加成功'
             else:
-                # 从应用的成员列表中移除用户
-                for app in applications:
-                    app.member.remove(user)
                 # 从用户的权限列表中移除应用
                 user.application.remove(*applications)
                 message = '应用权限移除成功'
             
             # 获取用户当前的所有应用
-            current_apps = [app.name for app in user.application.all()]
+            current_apps = list(user.application.values_list('name', flat=True))
             
             return JsonResponse({
                 'status': 'success',
@@ -291,8 +280,155 @@ def manage_user_applications(request):
             'message': f'操作失败: {str(e)}'
         }, status=500)
 
+def _grant_target(data):
+    """
+    解析部门/用户组授权的目标，返回 (查询条件, 新建记录的字段)；用户组不存在时抛出 Group.DoesNotExist
+    """
+    department_name = (data.get('department_name') or '').strip()
+    group_name = (data.get('group') or '').strip()
+    if bool(department_name) == bool(group_name):
+        raise ValueError('department_name 与 group 必须且只能提供一个')
+    if department_name:
+        return {'department_name': department_name, 'group__isnull': True}, {'department_name': department_name}
+    group = Group.objects.get(name=group_name)
+    return {'group': group}, {'group': group}
+
 @csrf_exempt
 @login_required
+@superuser_check
+def manage_department_applications(request):
+    """
+    管理部门或用户组的应用权限接口，一次授权覆盖部门/组内的所有用户
+    请求体格式：
+    {
+        "department_name": "部门名称",  # 与 group 二选一
+        "group": "用户组名称",
+        "action": "add" 或 "remove",
+        "applications": ["应用1", "应用2"]
+    }
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': '请使用POST方法'
+        }, status=405)
+
+    try:
+        data = json.loads(request.body)
+        action = data.get('action')
+        application_names = data.get('applications', [])
+
+        if not all([action, application_names]):
+            return JsonResponse({
+                'status': 'error',
+                'message': '操作类型和应用列表不能为空'
+            }, status=400)
+
+        if action not in ['add', 'remove']:
+            return JsonResponse({
+                'status': 'error',
+                'message': '操作类型必须是 add 或 remove'
+            }, status=400)
+
+        try:
+            target, fields = _grant_target(data)
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e)
+            }, status=400)
+        except Group.DoesNotExist:
+            return JsonResponse({
+                'status': 'error',
+                'message': '用户组不存在'
+            }, status=404)
+
+        found_apps = set(Application.objects.filter(name__in=application_names).values_list('name', flat=True))
+        missing_apps = set(application_names) - found_apps
+        if missing_apps:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'以下应用不存在: {", ".join(missing_apps)}'
+            }, status=400)
+
+        with transaction.atomic():
+            if action == 'add':
+                ApplicationGrant.objects.bulk_create(
+                    [ApplicationGrant(application_id=name, granted_by=request.user, **fields) for name in found_apps],
+                    ignore_conflicts=True
+                )
+                message = '应用权限添加成功'
+            else:
+                ApplicationGrant.objects.filter(application_id__in=found_apps, **target).delete()
+                message = '应用权限移除成功'
+        # bulk_create 不会触发 post_save，提交后手动让权限缓存失效
+        entitlements.invalidate()
+
+        current_apps = list(
+            ApplicationGrant.objects.filter(**target).order_by('application_id').values_list('application_id', flat=True)
+        )
+
+        return JsonResponse({
+            'status': 'success',
+            'message': message,
+            'department_name': fields.get('department_name', ''),
+            'group': fields['group'].name if 'group' in fields else '',
+            'current_applications': current_apps
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'操作失败: {str(e)}'
+        }, status=500)
+
+@login_required
+@superuser_check
+def get_department_grants(request):
+    """
+    获取所有部门和用户组的应用授权
+    可选查询参数 department_name / group 只返回指定部门或用户组
+    """
+    if request.method != 'GET':
+        return JsonResponse({
+            'status': 'error',
+            'message': '请使用GET方法'
+        }, status=405)
+
+    try:
+        grants = ApplicationGrant.objects.order_by('department_name', 'group__name', 'application_id')
+        if request.GET.get('department_name'):
+            grants = grants.filter(department_name=request.GET['department_name'], group__isnull=True)
+        if request.GET.get('group'):
+            grants = grants.filter(group__name=request.GET['group'])
+        grant_list = [
+            {
+                'department_name': department_name,
+                'group': group_name or '',
+                'application': application,
+                'granted_at': granted_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'granted_by': granted_by
+            }
+            for department_name, group_name, application, granted_at, granted_by in grants.values_list(
+                'department_name', 'group__name', 'application_id', 'granted_at', 'granted_by__username'
+            )
+        ]
+        return JsonResponse({
+            'status': 'success',
+            'message': '获取部门授权成功',
+            'grants': grant_list,
+            'total': len(grant_list)
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'获取部门授权失败: {str(e)}'
+        }, status=500)
+
+@csrf_exempt
+@login_required
+@superuser_check
 def get_user_applications(request):
     """
     获取用户应用权限接口
@@ -308,13 +444,6 @@ def get_user_applications(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         username = data.get('username')
         
@@ -329,19 +458,8 @@ def get_user_applications(request):
             # 获取用户
             user = Member.objects.get(username=username)
             
-            # 获取用户的所有应用
-            applications = user.application.all()
-            
-            # 构建应用详细信息列表
-            app_list = []
-            for app in applications:
-                app_info = {
-                    'name': app.name,
-                    'type': app.type,
-                    'icon': app.icon,
-                    'api_url': app.api_url
-                }
-                app_list.append(app_info)
+            # 获取用户的所有应用，只查询需要的字段
+            app_list = list(user.application.values('name', 'type', 'icon', 'api_url'))
             
             return JsonResponse({
                 'status': 'success',
@@ -366,6 +484,7 @@ def get_user_applications(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def get_application_users(request):
     """
     获取应用可用用户接口
@@ -381,13 +500,6 @@ def get_application_users(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         application_name = data.get('application_name')
         
@@ -402,8 +514,8 @@ def get_application_users(request):
             # 获取应用
             application = Application.objects.get(name=application_name)
             
-            # 获取应用的所有用户
-            users = application.member.all()
+            # 获取应用的所有用户，只查询需要的字段
+            users = application.member.only('username', 'email', 'department_name', 'is_active', 'date_joined')
             
             # 构建用户详细信息列表
             user_list = []
@@ -442,11 +554,57 @@ def get_application_users(request):
             'message': f'获取应用用户列表失败: {str(e)}'
         }, status=500)
 
+USERS_PAGE_SIZE = 100
+USERS_PAGE_MAX = 500
+USER_ORDERING_FIELDS = ('username', 'date_joined')
+# 前缀范围查询的上界
+PREFIX_END = '\U0010ffff'
+
+def _encode_cursor(value, last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, last_id]).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor: str):
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return value, int(last_id)
+    except Exception:
+        raise ValueError(cursor)
+
+def filter_users(users, params):
+    """
+    按 department / is_active / is_superuser / q 过滤用户，get_all_users 与批量授权共用
+    """
+    if params.get('department'):
+        users = users.filter(department_name=params['department'])
+    for flag in ('is_active', 'is_superuser'):
+        value = params.get(flag)
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        if value in ('true', 'false'):
+            users = users.filter(**{flag: value == 'true'})
+    if params.get('q'):
+        # 用范围查询代替 LIKE，前缀匹配可以直接使用索引
+        prefix = params['q']
+        users = users.filter(
+            Q(username__gte=prefix, username__lt=prefix + PREFIX_END)
+            | Q(email__gte=prefix, email__lt=prefix + PREFIX_END)
+        )
+    return users
+
 @login_required
+@superuser_check
+@read_replica
 def get_all_users(request):
     """
-    获取所有用户信息接口
-    返回所有用户的基本信息，包括用户名、部门等
+    获取用户信息接口（游标分页）
+    查询参数：
+        limit: 每页数量，默认 100，最大 500
+        after: 上一页返回的 next_cursor
+        ordering: username / -username / date_joined / -date_joined，默认 username
+        department: 部门名称
+        is_active / is_superuser: true 或 false
+        q: 用户名或邮箱前缀
+    返回的 next_cursor 为空时表示已经是最后一页
     """
     if request.method != 'GET':
         return JsonResponse({
@@ -455,19 +613,54 @@ def get_all_users(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
+        params = request.GET
+        try:
+            limit = min(max(int(params.get('limit', USERS_PAGE_SIZE)), 1), USERS_PAGE_MAX)
+        except ValueError:
             return JsonResponse({
                 'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
-        # 获取所有用户
-        users = Member.objects.all()
-        
+                'message': 'limit 必须是整数'
+            }, status=400)
+        ordering = params.get('ordering', 'username')
+        if ordering.lstrip('-') not in USER_ORDERING_FIELDS:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'不支持的排序字段: {ordering}'
+            }, status=400)
+
+        users = filter_users(Member.objects.all(), params)
+
+        # 按 (排序字段, id) 做键集分页，翻到第几页的开销都相同
+        field = ordering.lstrip('-')
+        descending = ordering.startswith('-')
+        if params.get('after'):
+            try:
+                value, last_id = _decode_cursor(params['after'])
+            except ValueError:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': '无效的游标'
+                }, status=400)
+            if field == 'date_joined':
+                value = datetime.fromisoformat(value)
+            op = 'lt' if descending else 'gt'
+            users = users.filter(
+                Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'id__{op}': last_id})
+            )
+        order_by = (f'-{field}', '-id') if descending else (field, 'id')
+        page = list(users.order_by(*order_by).only(
+            'id', 'username', 'email', 'department_name', 'is_active', 'date_joined', 'last_login', 'is_superuser'
+        )[:limit + 1])
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            last = page[-1]
+            value = getattr(last, field)
+            next_cursor = _encode_cursor(value.isoformat() if field == 'date_joined' else value, last.id)
+
         # 构建用户信息列表
         user_list = []
-        for user in users:
+        for user in page:
             user_info = {
                 'username': user.username,
                 'email': user.email,
@@ -483,7 +676,8 @@ def get_all_users(request):
             'status': 'success',
             'message': '获取用户列表成功',
             'users': user_list,
-            'total_users': len(user_list)
+            'total_users': len(user_list),
+            'next_cursor': next_cursor
         })
             
     except Exception as e:
@@ -493,7 +687,9 @@ def get_all_users(request):
         }, status=500) 
     
 @login_required
+@superuser_check
 @csrf_exempt
+@read_replica
 def get_model_info(request):
     """
     获取所有模型信息接口
@@ -506,13 +702,6 @@ def get_model_info(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         # 获取所有模型信息
         models = Model_info.objects.all()
         
@@ -527,7 +716,8 @@ def get_model_info(request):
                 'model_key': model.model_key,
                 'model_type': model.model_type,
                 'model_provider': model.model_provider,
-                'model_providerId': model.model_providerId
+                'model_providerId': model.model_providerId,
+                'context_window': model.context_window
             }
             model_list.append(model_info)
         
@@ -546,6 +736,7 @@ def get_model_info(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def update_user(request):
     """
     更新用户信息接口
@@ -565,13 +756,6 @@ def update_user(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         username = data.get('username')
         
@@ -612,7 +796,7 @@ def update_user(request):
                             'status': 'error',
                             'message': f'以下应用不存在: {", ".join(missing_apps)}'
                         }, status=400)
-                    user.application.set(applications)
+                    user.application.set(applications, through_defaults={'granted_by': request.user})
                 except Exception as e:
                     return JsonResponse({
                         'status': 'error',
@@ -630,7 +814,7 @@ def update_user(request):
                 'email': user.email,
                 'department_name': user.department_name,
                 'is_active': user.is_active,
-                'applications': [app.name for app in user.application.all()]
+                'applications': list(user.application.values_list('name', flat=True))
             }
         })
         
@@ -642,6 +826,7 @@ def update_user(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def delete_user(request):
     """
     删除用户接口（软删除，设置为非活跃状态）
@@ -657,13 +842,6 @@ def delete_user(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         username = data.get('username')
         
@@ -715,6 +893,7 @@ def delete_user(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def create_model(request):
     """
     创建新模型接口
@@ -726,7 +905,8 @@ def create_model(request):
         "model_key": "模型密钥",
         "model_type": "模型类型",
         "model_provider": "提供商",
-        "model_providerId": "提供商ID"
+        "model_providerId": "提供商ID",
+        "context_window": 上下文窗口 token 数（可选，0 表示不限制）
     }
     """
     if request.method != 'POST':
@@ -736,13 +916,6 @@ def create_model(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         show_name = data.get('show_name')
         model_name = data.get('model_name')
@@ -751,6 +924,7 @@ def create_model(request):
         model_type = data.get('model_type', '')
         model_provider = data.get('model_provider', '')
         model_providerId = data.get('model_providerId', '')
+        context_window = data.get('context_window', 0)
         
         # 验证必填字段
         if not all([show_name, model_name, model_url]):
@@ -758,6 +932,11 @@ def create_model(request):
                 'status': 'error',
                 'message': '显示名称、模型名称和模型URL不能为空'
             }, status=400)
+        if not isinstance(context_window, int) or context_window < 0:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'context_window 必须是非负整数'
+            }, status=400)
         
         # 检查显示名称是否已存在
         if Model_info.objects.filter(show_name=show_name).exists():
@@ -774,7 +953,8 @@ def create_model(request):
             model_key=model_key,
             model_type=model_type,
             model_provider=model_provider,
-            model_providerId=model_providerId
+            model_providerId=model_providerId,
+            context_window=context_window
         )
         
         return JsonResponse({
@@ -787,7 +967,8 @@ def create_model(request):
                 'model_url': model.model_url,
                 'model_type': model.model_type,
                 'model_provider': model.model_provider,
-                'model_providerId': model.model_providerId
+                'model_providerId': model.model_providerId,
+                'context_window': model.context_window
             }
         })
         
@@ -799,6 +980,7 @@ def create_model(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def update_model(request):
     """
     更新模型接口
@@ -810,13 +992,6 @@ def update_model(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         model_id = data.get('id')
         
@@ -834,6 +1009,8 @@ def update_model(request):
                 'message': '模型不存在'
             }, status=404)
         
+        old_client_key = (model.model_url, model.model_key)
+
         # 更新模型信息
         if 'show_name' in data:
             # 检查新的显示名称是否已被其他模型使用
@@ -855,8 +1032,18 @@ def update_model(request):
             model.model_provider = data['model_provider']
         if 'model_providerId' in data:
             model.model_providerId = data['model_providerId']
+        if 'context_window' in data:
+            if not isinstance(data['context_window'], int) or data['context_window'] < 0:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': 'context_window 必须是非负整数'
+                }, status=400)
+            model.context_window = data['context_window']
         
         model.save()
+        # 地址或密钥变化后，丢弃使用旧配置缓存的客户端
+        if old_client_key != (model.model_url, model.model_key):
+            openai_clients.invalidate(*old_client_key)
         
         return JsonResponse({
             'status': 'success',
@@ -868,7 +1055,8 @@ def update_model(request):
                 'model_url': model.model_url,
                 'model_type': model.model_type,
                 'model_provider': model.model_provider,
-                'model_providerId': model.model_providerId
+                'model_providerId': model.model_providerId,
+                'context_window': model.context_window
             }
         })
         
@@ -880,6 +1068,7 @@ def update_model(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def delete_model(request):
     """
     删除模型接口
@@ -891,13 +1080,6 @@ def delete_model(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         model_id = data.get('id')
         
@@ -911,6 +1093,7 @@ def delete_model(request):
             model = Model_info.objects.get(id=model_id)
             model_name = model.show_name
             model.delete()
+            openai_clients.invalidate(model.model_url, model.model_key)
             
             return JsonResponse({
                 'status': 'success',
@@ -929,8 +1112,125 @@ def delete_model(request):
             'message': f'删除模型失败: {str(e)}'
         }, status=500)
 
+@login_required
+@superuser_check
+def get_metrics(request):
+    """
+    获取网关运行指标接口（当前进程）
+    包括上游连接池的命中/未命中次数、请求数与新建连接数，用于调整连接池大小，
+    以及客户端断开、用户停止等流式对话计数
+    """
+    if request.method != 'GET':
+        return JsonResponse({
+            'status': 'error',
+            'message': '请使用GET方法'
+        }, status=405)
+
+    try:
+        return JsonResponse({
+            'status': 'success',
+            'message': '获取运行指标成功',
+            'http_pool': pool_stats(),
+            'metrics': metrics.snapshot()
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'获取运行指标失败: {str(e)}'
+        }, status=500)
+
+USAGE_GROUP_FIELDS = {
+    'user': 'username',
+    'app': 'app',
+    'model': 'model',
+    'hour': 'hour',
+    'day': 'day',
+}
+USAGE_MAX_ROWS = 1000
+
+def _parse_time(value: str):
+    """
+    解析 YYYY-MM-DD 或 ISO 格式的时间，未带时区时按当前时区处理
+    """
+    parsed = datetime.fromisoformat(value)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+@login_required
+@superuser_check
+@read_replica
+def get_usage(request):
+    """
+    查询 token 用量统计（基于按小时汇总的数据，不扫描原始记录）
+    查询参数：
+        start / end: 时间范围，YYYY-MM-DD 或 ISO 时间，默认最近 7 天
+        group_by: 逗号分隔的 user / app / model / hour / day，默认 user
+        username / app / model: 只统计指定用户、应用或模型
+    """
+    if request.method != 'GET':
+        return JsonResponse({
+            'status': 'error',
+            'message': '请使用GET方法'
+        }, status=405)
+
+    try:
+        params = request.GET
+        try:
+            end = _parse_time(params['end']) if params.get('end') else timezone.now()
+            start = _parse_time(params['start']) if params.get('start') else end - timedelta(days=7)
+        except ValueError:
+            return JsonResponse({
+                'status': 'error',
+                'message': '时间格式应为 YYYY-MM-DD 或 ISO 格式'
+            }, status=400)
+        group_by = [name.strip() for name in params.get('group_by', 'user').split(',') if name.strip()]
+        unknown = set(group_by) - set(USAGE_GROUP_FIELDS)
+        if unknown or not group_by:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'group_by 只支持 {" / ".join(USAGE_GROUP_FIELDS)}'
+            }, status=400)
+
+        rows = UsageHourly.objects.filter(hour__gte=start, hour__lt=end)
+        for field in ('username', 'app', 'model'):
+            if params.get(field):
+                rows = rows.filter(**{field: params[field]})
+        sums = {name: Sum(name) for name in ('requests', 'prompt_tokens', 'completion_tokens', 'total_tokens')}
+        totals = {name: value or 0 for name, value in rows.aggregate(**sums).items()}
+        if 'day' in group_by:
+            rows = rows.annotate(day=TruncDay('hour'))
+        fields = [USAGE_GROUP_FIELDS[name] for name in group_by]
+        time_fields = [field for field in fields if field in ('hour', 'day')]
+        rows = rows.values(*fields).annotate(**sums).order_by(*time_fields, '-total_tokens')
+
+        usage = []
+        for row in rows[:USAGE_MAX_ROWS]:
+            for field in time_fields:
+                row[field] = row[field].strftime('%Y-%m-%d %H:%M:%S' if field == 'hour' else '%Y-%m-%d')
+            usage.append(row)
+
+        return JsonResponse({
+            'status': 'success',
+            'message': '获取用量统计成功',
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'group_by': group_by,
+            'usage': usage,
+            'totals': totals,
+            'truncated': len(usage) >= USAGE_MAX_ROWS
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'获取用量统计失败: {str(e)}'
+        }, status=500)
+
 @csrf_exempt
 @login_required
+@superuser_check
 def get_env_config(request):
     """
     获取环境变量配置接口
@@ -943,13 +1243,6 @@ def get_env_config(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         import os
         from pathlib import Path
         
@@ -995,6 +1288,7 @@ def get_env_config(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def update_frontend_env(request):
     """
     更新前端环境变量接口
@@ -1019,13 +1313,6 @@ def update_frontend_env(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         env_vars = data.get('env_vars', {})
         
@@ -1089,6 +1376,7 @@ def update_frontend_env(request):
 
 @csrf_exempt
 @login_required
+@superuser_check
 def update_backend_env(request):
     """
     更新后端环境变量接口
@@ -1109,13 +1397,6 @@ def update_backend_env(request):
         }, status=405)
     
     try:
-        # 验证当前用户是否为超级用户
-        if not request.user.is_superuser:
-            return JsonResponse({
-                'status': 'error',
-                'message': '需要超级用户权限'
-            }, status=403)
-        
         data = json.loads(request.body)
         config = data.get('config', {})
         
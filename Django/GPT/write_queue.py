@@ -0,0 +1,106 @@
+"""
+SQLite 单写者队列
+SQLite 同一时刻只允许一个写事务，同一 worker 内的多个线程各自发起写入时会互相等待锁、甚至报 database is locked。
+开启 SQLITE_WRITE_QUEUE 后，会话、用量等高频小写入交给每个进程一个的写线程串行执行，
+队列中积压的写入合并到同一个事务中提交（每个写入一个保存点，互不影响）
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# 一个事务最多合并的写入数
+BATCH_SIZE = 100
+
+
+class WriteQueue:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < BATCH_SIZE:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            outcomes = []
+            try:
+                with transaction.atomic():
+                    for future, fn, args, kwargs in jobs:
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        try:
+                            with transaction.atomic():
+                                outcomes.append((future, fn(*args, **kwargs), None))
+                        except Exception as e:
+                            outcomes.append((future, None, e))
+            except Exception as e:
+                # 提交失败时整批写入都没有生效
+                logger.exception('写队列提交失败')
+                outcomes = [(future, None, error or e) for future, _, error in outcomes]
+            finally:
+                close_old_connections()
+            # 事务提交后再通知调用方
+            for future, result, error in outcomes:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def _inline(self) -> bool:
+        # 外层已在事务中时必须使用同一个连接，否则会等待自己持有的锁
+        return not settings.SQLITE_WRITE_QUEUE or connection.in_atomic_block
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        提交写入，返回 Future
+        """
+        future = Future()
+        if self._inline():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._ensure_thread()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """
+        提交写入并等待完成，返回 fn 的返回值或抛出其异常
+        """
+        if self._inline():
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    def defer(self, fn, *args, **kwargs):
+        """
+        提交写入但不等待结果，失败时只记录日志
+        """
+        future = self.submit(fn, *args, **kwargs)
+        future.add_done_callback(_log_failure)
+
+
+def _log_failure(future: Future):
+    if future.exception() is not None:
+        logger.error('延迟写入失败', exc_info=future.exception())
+
+
+write_queue = WriteQueue()
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# ASGI 下使用异步视图转发 appTalk/modelTalk 的流式响应
+os.environ.setdefault('ASYNC_STREAMING', 'True')
 
 application = get_asgi_application()
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import json
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -68,7 +70,15 @@ CORS_ALLOW_HEADERS = [
     'x-requested-with',
     'cookie',
 ]
+# 前端停止生成时需要读取 talk 响应头中的 stream_id
+CORS_EXPOSE_HEADERS = ['X-Stream-Id', 'X-Conversation-Id']
 SESSION_COOKIE_AGE = 86400
+# 会话引擎：默认使用带进程内缓存的数据库会话；
+# 设为 django.contrib.sessions.backends.signed_cookies 时会话保存在签名 Cookie 中，不再查询数据库，
+# 但登出只能清除浏览器中的 Cookie，已泄露的 Cookie 在过期前仍然有效（修改密码、停用用户后会立即失效）
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'GPT.session_store')
+# 已登录用户从进程内缓存解析，不必每个请求都查询用户表
+AUTHENTICATION_BACKENDS = ['GPT.auth_backend.CachedModelBackend']
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -100,6 +110,97 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'backend.wsgi.application'
 
+# 上游 HTTP 连接池（按 应用 + 上游地址 隔离，每个进程一份）
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))              # 每个连接池保持的最大连接数
+HTTP_POOL_BLOCK = os.environ.get('HTTP_POOL_BLOCK', 'False') == 'True'          # 连接耗尽时是否阻塞等待空闲连接
+HTTP_POOL_KEEPALIVE = int(os.environ.get('HTTP_POOL_KEEPALIVE', '60'))          # 连接池空闲超过该秒数后重建
+HTTP_POOL_ASYNC_MAXSIZE = int(os.environ.get('HTTP_POOL_ASYNC_MAXSIZE', '500')) # 异步模式下每个连接池的最大并发连接数
+
+# 转发上游 SSE 时单次读取的缓冲区上限（字节），有数据即返回，不会等待缓冲区填满
+SSE_READ_SIZE = int(os.environ.get('SSE_READ_SIZE', '65536'))
+
+# ModelChat 复用的 OpenAI 客户端数量上限（按 model_url + model_key 缓存）
+OPENAI_CLIENT_CACHE_SIZE = int(os.environ.get('OPENAI_CLIENT_CACHE_SIZE', '32'))
+
+# 通过 backend/asgi.py 启动时默认开启，appTalk/modelTalk 将使用异步视图转发流式响应
+ASYNC_STREAMING = os.environ.get('ASYNC_STREAMING', 'False') == 'True'
+
+# 同一台机器上各 worker 共享的运行时状态（进行中的流等），与业务数据库分开存放
+GATEWAY_STORE_PATH = os.environ.get('GATEWAY_STORE_PATH', str(BASE_DIR / 'gateway.sqlite3'))
+GATEWAY_STORE_TIMEOUT = float(os.environ.get('GATEWAY_STORE_TIMEOUT', '5'))
+# 转发流的 worker 检查停止命令的间隔（秒）
+STREAM_CANCEL_POLL_INTERVAL = float(os.environ.get('STREAM_CANCEL_POLL_INTERVAL', '0.05'))
+# 超过该时间（秒）的流登记记录视为异常退出的遗留数据并清理
+STREAM_REGISTRY_TTL = int(os.environ.get('STREAM_REGISTRY_TTL', '3600'))
+# 应用/模型配置缓存检查共享版本号的间隔（秒），即其他 worker 修改配置后最长的生效延迟
+CONFIG_VERSION_CHECK_INTERVAL = float(os.environ.get('CONFIG_VERSION_CHECK_INTERVAL', '1'))
+# 会话和登录用户在每个 worker 内的缓存时间（秒）与数量上限
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '30'))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '10000'))
+# 对话准入控制（同一台机器上所有 worker 共享计数）：每分钟请求数、突发上限（默认等于每分钟请求数）和并发流上限，0 表示不限制
+ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE', '60'))
+ADMISSION_USER_BURST = float(os.environ.get('ADMISSION_USER_BURST', '20'))
+ADMISSION_USER_CONCURRENCY = int(os.environ.get('ADMISSION_USER_CONCURRENCY', '4'))
+ADMISSION_APP_RATE = float(os.environ.get('ADMISSION_APP_RATE', '0'))
+ADMISSION_APP_BURST = float(os.environ.get('ADMISSION_APP_BURST', '0'))
+ADMISSION_APP_CONCURRENCY = int(os.environ.get('ADMISSION_APP_CONCURRENCY', '0'))
+ADMISSION_MODEL_RATE = float(os.environ.get('ADMISSION_MODEL_RATE', '0'))
+ADMISSION_MODEL_BURST = float(os.environ.get('ADMISSION_MODEL_BURST', '0'))
+ADMISSION_MODEL_CONCURRENCY = int(os.environ.get('ADMISSION_MODEL_CONCURRENCY', '0'))
+# 并发数超限时建议客户端等待的秒数（Retry-After）
+ADMISSION_RETRY_AFTER = float(os.environ.get('ADMISSION_RETRY_AFTER', '2'))
+# 过载保护：同一台机器上所有 worker 同时处理的对话数（0 表示不限制，计数保存在 GATEWAY_STORE_PATH）、等待空位的队列长度、最长等待秒数（包括 X-Request-Start 报告的 backlog 等待时间）
+LOAD_SHED_MAX_ACTIVE = int(os.environ.get('LOAD_SHED_MAX_ACTIVE', '64'))
+LOAD_SHED_QUEUE_DEPTH = int(os.environ.get('LOAD_SHED_QUEUE_DEPTH', '64'))
+LOAD_SHED_MAX_WAIT = float(os.environ.get('LOAD_SHED_MAX_WAIT', '15'))
+# 排队请求检查其他 worker 是否让出空位的间隔秒数
+LOAD_SHED_POLL_INTERVAL = float(os.environ.get('LOAD_SHED_POLL_INTERVAL', '0.05'))
+# 过载时建议客户端等待的秒数（Retry-After）
+LOAD_SHED_RETRY_AFTER = int(os.environ.get('LOAD_SHED_RETRY_AFTER', '5'))
+# 上游并发槽位：每个上游（按 url）同时转发的对话数，0 表示不限制；UPSTREAM_SLOTS_OVERRIDES 为 JSON，按 url 单独设置，如 {"http://localhost:11434/v1": 2}
+UPSTREAM_SLOTS = int(os.environ.get('UPSTREAM_SLOTS', '0'))
+UPSTREAM_SLOTS_OVERRIDES = json.loads(os.environ.get('UPSTREAM_SLOTS_OVERRIDES', '{}'))
+# 排队时各优先级类别的权重（JSON），交互式对话默认得到批量工作流 4 倍的槽位
+UPSTREAM_CLASS_WEIGHTS = json.loads(os.environ.get('UPSTREAM_CLASS_WEIGHTS', '{"interactive": 4, "batch": 1}'))
+# 等待上游槽位的最长秒数，超时返回 503；等待其他 worker 归还槽位时的轮询间隔（秒）
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', '30'))
+UPSTREAM_POLL_INTERVAL = float(os.environ.get('UPSTREAM_POLL_INTERVAL', '0.05'))
+# 每个 worker 最多缓存多少个用户的应用权限
+ENTITLEMENT_CACHE_SIZE = int(os.environ.get('ENTITLEMENT_CACHE_SIZE', '4096'))
+
+# 流式导出每次从数据库读取的行数
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '2000'))
+
+# 批量导入用户时，超过该数量的密码交给进程池并行哈希；进程数为 0 时使用 CPU 核数
+PASSWORD_HASH_INLINE_LIMIT = int(os.environ.get('PASSWORD_HASH_INLINE_LIMIT', '8'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '0'))
+
+# token 用量在内存中缓冲，后台线程每隔该秒数批量写入；设为 0 时只在缓冲区满时写入
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', '5'))
+# 缓冲区达到该条数时立即写入
+USAGE_BUFFER_SIZE = int(os.environ.get('USAGE_BUFFER_SIZE', '1000'))
+# 调用模型时要求上游在流的最后返回 usage（stream_options.include_usage），上游不支持时关闭
+MODEL_STREAM_USAGE = os.environ.get('MODEL_STREAM_USAGE', 'True') == 'True'
+
+# Model_info.context_window 中为模型回复预留的 token 数，其余为对话历史的预算（预留最多占窗口的一半）
+CONTEXT_RESERVE_TOKENS = int(os.environ.get('CONTEXT_RESERVE_TOKENS', '1024'))
+# 安装了 tiktoken 时用于计数的编码，留空或未安装时按字符数估算
+CONTEXT_TOKENIZER = os.environ.get('CONTEXT_TOKENIZER', 'cl100k_base')
+# 进程内缓存的消息 token 数条数
+CONTEXT_TOKEN_CACHE_SIZE = int(os.environ.get('CONTEXT_TOKEN_CACHE_SIZE', '50000'))
+
+# 对话消息由后台线程写入，有新消息后等待该秒数再写入以便合并；设为负数时同步视图在对话结束时直接写入
+CONVERSATION_FLUSH_DELAY = float(os.environ.get('CONVERSATION_FLUSH_DELAY', '0.05'))
+# 数据库不可用时内存中最多保留的待写入消息条数
+CONVERSATION_BUFFER_SIZE = int(os.environ.get('CONVERSATION_BUFFER_SIZE', '10000'))
+
+# Dify 应用参数缓存：TTL 内直接使用缓存，超过 TTL 但未超过 STALE 时返回旧数据并在后台刷新（秒）
+DIFY_PARAMETERS_TTL = int(os.environ.get('DIFY_PARAMETERS_TTL', '300'))
+DIFY_PARAMETERS_STALE = int(os.environ.get('DIFY_PARAMETERS_STALE', '86400'))
+DIFY_PARAMETERS_TIMEOUT = float(os.environ.get('DIFY_PARAMETERS_TIMEOUT', '10'))
+# 缓存缺失时，等待其他 worker 拉取应用参数的轮询间隔（秒）
+DIFY_PARAMETERS_POLL_INTERVAL = float(os.environ.get('DIFY_PARAMETERS_POLL_INTERVAL', '0.05'))
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -107,10 +208,36 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', str(BASE_DIR / 'db.sqlite3')),
     }
 }
 
+# 配置了 replica 数据库时，标记为 @read_replica 的只读接口从副本读取
+DATABASE_ROUTERS = ['GPT.db_router.ReadReplicaRouter']
+
+# SQLite 生产模式：多个 gunicorn worker 并发写时避免 database is locked
+SQLITE_PRODUCTION = os.environ.get('SQLITE_PRODUCTION', 'False') == 'True'
+if SQLITE_PRODUCTION:
+    DATABASES['default']['OPTIONS'] = {
+        # 等待写锁的秒数
+        'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', '20')),
+        # 写事务开始时立即获取写锁，不会在事务中途因锁升级失败而报错
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'          # 读写互不阻塞
+            'PRAGMA synchronous=NORMAL;'        # WAL 模式下只在检查点时刷盘
+            'PRAGMA mmap_size=268435456;'       # 256MB 内存映射读取
+            'PRAGMA cache_size=-65536;'         # 每个连接 64MB 页缓存
+            'PRAGMA temp_store=MEMORY;'
+        ),
+    }
+    # 保持数据库连接，避免每个请求重新打开文件和执行上面的 PRAGMA
+    CONN_MAX_AGE = int(os.environ.get('CONN_MAX_AGE', '600'))
+    DATABASES['default']['CONN_MAX_AGE'] = CONN_MAX_AGE
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+# 会话、用量等高频小写入交给每个进程一个的写线程串行执行，生产模式下默认开启
+SQLITE_WRITE_QUEUE = os.environ.get('SQLITE_WRITE_QUEUE', str(SQLITE_PRODUCTION)) == 'True'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -0,0 +1,70 @@
+"""
+生产环境配置，在 backend/settings.py 的基础上用环境变量覆盖
+DATABASE_ENGINE=postgresql 时使用带连接池的 PostgreSQL（需要 pip install "psycopg[binary,pool]"），
+同时配置了 POSTGRES_REPLICA_HOST 时只读接口的查询发往只读副本；否则使用 SQLite 生产模式
+"""
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+os.environ.setdefault('SQLITE_PRODUCTION', 'True')
+
+from .settings import *  # noqa: E402,F401,F403
+from .settings import DATABASES
+
+DEBUG = os.environ.get('DJANGO_DEBUG', 'False') == 'True'
+
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY')
+if not SECRET_KEY:
+    raise ImproperlyConfigured('生产环境必须通过 DJANGO_SECRET_KEY 设置密钥')
+
+if os.environ.get('DJANGO_ALLOWED_HOSTS'):
+    ALLOWED_HOSTS = os.environ['DJANGO_ALLOWED_HOSTS'].split(',')
+if os.environ.get('CORS_ALLOWED_ORIGINS'):
+    CORS_ALLOWED_ORIGINS = os.environ['CORS_ALLOWED_ORIGINS'].split(',')
+    CSRF_TRUSTED_ORIGINS = CORS_ALLOWED_ORIGINS
+
+STATIC_ROOT = os.environ.get('DJANGO_STATIC_ROOT', str(BASE_DIR / 'staticfiles'))  # noqa: F405
+
+
+def _postgres(prefix: str, defaults: dict = None) -> dict:
+    """
+    从 {prefix}_HOST / _PORT / _DB / _USER / _PASSWORD 读取 PostgreSQL 连接配置，未设置的项使用 defaults
+    """
+    defaults = defaults or {}
+
+    def env(name, default=None):
+        return os.environ.get(f'{prefix}_{name}', defaults.get(name, default))
+
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'HOST': env('HOST', 'localhost'),
+        'PORT': env('PORT', '5432'),
+        'NAME': env('DB', 'upa_chatter'),
+        'USER': env('USER', 'upa_user'),
+        'PASSWORD': env('PASSWORD', ''),
+        # 使用连接池时不能再设置 CONN_MAX_AGE
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(env('POOL_MIN_SIZE', '2')),     # 每个 worker 保持的最少连接数
+                'max_size': int(env('POOL_MAX_SIZE', '10')),    # 每个 worker 最多打开的连接数
+                'timeout': float(env('POOL_TIMEOUT', '10')),    # 等待空闲连接的秒数
+            },
+        },
+    }
+
+
+if os.environ.get('DATABASE_ENGINE') == 'postgresql':
+    DATABASES['default'] = _postgres('POSTGRES')
+    # PostgreSQL 支持并发写入，不需要单写者队列
+    SQLITE_WRITE_QUEUE = os.environ.get('SQLITE_WRITE_QUEUE', 'False') == 'True'
+    primary = {
+        name: os.environ[f'POSTGRES_{name}'] for name in ('PORT', 'DB', 'USER', 'PASSWORD')
+        if f'POSTGRES_{name}' in os.environ
+    }
+    if os.environ.get('POSTGRES_REPLICA_HOST'):
+        # 副本的库名、用户、密码默认与主库相同
+        DATABASES['replica'] = _postgres('POSTGRES_REPLICA', primary)
+        # 测试时副本指向测试主库
+        DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
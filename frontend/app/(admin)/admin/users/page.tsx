@@ -2,6 +2,7 @@
 
 import { useState, useEffect } from 'react';
 import { getCookie } from '@/lib/utils/cookies';
+import { fetchAllUsers } from '@/lib/utils/admin-users';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Label } from '@/components/ui/label';
@@ -99,25 +100,7 @@ export default function UsersManagePage() {
   const fetchUsers = async () => {
     try {
       setLoading(true);
-      const response = await fetch('http://localhost:8000/GPT/get_all_users', {
-        method: 'GET',
-        credentials: 'include',
-        headers: {
-          'Content-Type': 'application/json',
-          'X-CSRFToken': getCookie('csrftoken') || '',
-        },
-      });
-
-      if (!response.ok) {
-        throw new Error(`请求失败: ${response.status}`);
-      }
-
-      const data = await response.json();
-      if (data.status === 'success') {
-        setUsers(data.users);
-      } else {
-        throw new Error(data.message || '获取用户列表失败');
-      }
+      setUsers(await fetchAllUsers<User>());
     } catch (error) {
       console.error('获取用户列表失败:', error);
       toast.error('获取用户列表失败');
@@ -22,6 +22,10 @@ import {
 import { Badge } from '@/components/ui/badge';
 import { Search, Users, UserPlus, UserMinus } from 'lucide-react';
 import { toast } from 'sonner';
+import { fetchUsersPage } from '@/lib/utils/admin-users';
+
+// 可添加用户每次只加载一页，搜索由后端按用户名或邮箱前缀过滤
+const CANDIDATES_PAGE_SIZE = 50;
 
 interface User {
   username: string;
@@ -46,6 +50,8 @@ export function ApplicationUsersDialog({
 }: ApplicationUsersDialogProps) {
   const [users, setUsers] = useState<User[]>([]);
   const [allUsers, setAllUsers] = useState<User[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [loading, setLoading] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
   const [selectedUsers, setSelectedUsers] = useState<Set<string>>(new Set());
@@ -83,26 +89,21 @@ export function ApplicationUsersDialog({
     }
   };
 
-  // 获取所有用户列表
-  const fetchAllUsers = async () => {
+  // 获取可添加的用户，after 为空时从第一页重新加载
+  const loadUsers = async (after: string | null = null) => {
     try {
-      const response = await fetch('http://localhost:8000/GPT/get_all_users', {
-        method: 'GET',
-        credentials: 'include',
-        headers: {
-          'Content-Type': 'application/json',
-          'X-CSRFToken': getCookie('csrftoken') || '',
-        },
+      setLoadingMore(true);
+      const page = await fetchUsersPage<User>({
+        after,
+        q: searchTerm.trim(),
+        limit: CANDIDATES_PAGE_SIZE,
       });
-
-      const data = await response.json();
-      if (data.status === 'success') {
-        setAllUsers(data.users);
-      } else {
-        throw new Error(data.message || '获取用户列表失败');
-      }
+      setAllUsers((prev) => (after ? [...prev, ...page.users] : page.users));
+      setNextCursor(page.nextCursor);
     } catch (error) {
       console.error('获取用户列表失败:', error);
+    } finally {
+      setLoadingMore(false);
     }
   };
 
@@ -174,22 +175,26 @@ export function ApplicationUsersDialog({
       user.department_name.toLowerCase().includes(searchTerm.toLowerCase())
   );
 
-  // 过滤未拥有权限的用户
+  // 过滤未拥有权限的用户（搜索已由后端完成）
   const availableUsers = allUsers.filter(
-    (user) =>
-      !users.some((appUser) => appUser.username === user.username) &&
-      (user.username.toLowerCase().includes(searchTerm.toLowerCase()) ||
-        user.email.toLowerCase().includes(searchTerm.toLowerCase()) ||
-        user.department_name.toLowerCase().includes(searchTerm.toLowerCase()))
+    (user) => !users.some((appUser) => appUser.username === user.username)
   );
 
   useEffect(() => {
     if (open) {
       fetchApplicationUsers();
-      fetchAllUsers();
     }
   }, [open, applicationName]);
 
+  // 搜索词变化后稍等再请求，避免每输入一个字符就查询一次
+  useEffect(() => {
+    if (!open) {
+      return;
+    }
+    const timer = setTimeout(() => loadUsers(), 300);
+    return () => clearTimeout(timer);
+  }, [open, searchTerm]);
+
   return (
     <Dialog open={open} onOpenChange={onOpenChange}>
       <DialogContent className="max-w-4xl max-h-[80vh]">
@@ -375,6 +380,18 @@ export function ApplicationUsersDialog({
                     ))}
                   </TableBody>
                 </Table>
+                {nextCursor && (
+                  <div className="flex justify-center p-2">
+                    <Button
+                      size="sm"
+                      variant="ghost"
+                      onClick={() => loadUsers(nextCursor)}
+                      disabled={loadingMore}
+                    >
+                      {loadingMore ? '加载中...' : '加载更多'}
+                    </Button>
+                  </div>
+                )}
               </div>
             </div>
           </div>
@@ -0,0 +1,66 @@
+import { getCookie } from '@/lib/utils/cookies';
+
+const USERS_PAGE_SIZE = 500;
+
+export interface UsersPage<T> {
+  users: T[];
+  nextCursor: string | null;
+}
+
+/**
+ * 读取 get_all_users 的一页
+ * q 为用户名或邮箱前缀，由后端过滤；nextCursor 为空时表示已经是最后一页
+ */
+export async function fetchUsersPage<T>({
+  after,
+  q,
+  limit = USERS_PAGE_SIZE,
+}: { after?: string | null; q?: string; limit?: number } = {}): Promise<
+  UsersPage<T>
+> {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (after) {
+    params.set('after', after);
+  }
+  if (q) {
+    params.set('q', q);
+  }
+  const response = await fetch(
+    `http://localhost:8000/GPT/get_all_users?${params.toString()}`,
+    {
+      method: 'GET',
+      credentials: 'include',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-CSRFToken': getCookie('csrftoken') || '',
+      },
+    }
+  );
+
+  if (!response.ok) {
+    throw new Error(`请求失败: ${response.status}`);
+  }
+
+  const data = await response.json();
+  if (data.status !== 'success') {
+    throw new Error(data.message || '获取用户列表失败');
+  }
+  return { users: data.users, nextCursor: data.next_cursor };
+}
+
+/**
+ * 按游标逐页读取 get_all_users，返回全部用户
+ * 后端每页的开销固定，不再一次性序列化整张用户表
+ */
+export async function fetchAllUsers<T>(): Promise<T[]> {
+  const users: T[] = [];
+  let cursor: string | null = null;
+
+  do {
+    const page: UsersPage<T> = await fetchUsersPage<T>({ after: cursor });
+    users.push(...page.users);
+    cursor = page.nextCursor;
+  } while (cursor);
+
+  return users;
+}
@@ -40,12 +40,26 @@ start_backend() {
         echo "🌐 使用 Gunicorn 启动 Django..."
         # 设置 DJANGO_SETTINGS_MODULE 环境变量来指定配置文件
         export DJANGO_SETTINGS_MODULE=backend.settings_production
-        nohup gunicorn --bind 0.0.0.0:8000 backend.wsgi:application \
-            --workers 4 \
-            --timeout 120 \
-            --access-logfile logs/access.log \
-            --error-logfile logs/error.log \
-            > logs/gunicorn.log 2>&1 &
+        # SQLite 生产模式：WAL、长连接和单写者队列，多个 worker 并发写时不会报 database is locked
+        export SQLITE_PRODUCTION=${SQLITE_PRODUCTION:-True}
+        if [ "$BACKEND_ASGI" = "1" ]; then
+            # ASGI 模式：appTalk/modelTalk 使用异步视图，单个 worker 可同时转发大量流式响应
+            echo "⚡ 使用 ASGI 模式 (Uvicorn worker)，需要安装: pip install uvicorn"
+            nohup gunicorn --bind 0.0.0.0:8000 backend.asgi:application \
+                -k uvicorn.workers.UvicornWorker \
+                --workers 4 \
+                --timeout 120 \
+                --access-logfile logs/access.log \
+                --error-logfile logs/error.log \
+                > logs/gunicorn.log 2>&1 &
+        else
+            nohup gunicorn --bind 0.0.0.0:8000 backend.wsgi:application \
+                --workers 4 \
+                --timeout 120 \
+                --access-logfile logs/access.log \
+                --error-logfile logs/error.log \
+                > logs/gunicorn.log 2>&1 &
+        fi
         BACKEND_PID=$!
         echo "✅ 后端服务已启动 (PID: $BACKEND_PID) - 端口: 8000"
     else